@@ -0,0 +1,232 @@
+# /autotune.py
+
+# Finds the fastest llama.cpp runtime settings for a GGUF model on this host and stores
+# them in data/autotune.json, keyed by model file and host. ModelLoader applies the stored
+# settings on later loads.
+#
+#   python autotune.py                # tune the "chat" model
+#   python autotune.py --quick        # fewer candidates
+#   python autotune.py --show         # print what is stored for this host
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import time
+
+TUNING_PATH = "data/autotune.json"
+# Llama() keyword arguments the tuner decides
+RUNTIME_KEYS = ("n_threads", "n_threads_batch", "n_batch", "use_mmap", "use_mlock",
+                "type_k", "type_v", "flash_attn")
+# Workload the score is modelled on: one chat turn's prompt suffix and reply
+PROMPT_TOKENS = 256
+GENERATE_TOKENS = 64
+
+
+def model_fingerprint(path):
+    # Name, size and the first and last MB; hashing a multi-GB file in full would be slow
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(f"{os.path.basename(path)}:{size}".encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(1024 * 1024))
+        if size > 2 * 1024 * 1024:
+            f.seek(-1024 * 1024, os.SEEK_END)
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_fingerprint():
+    from model_loader import physical_memory_bytes
+
+    try:
+        import llama_cpp
+        backend = getattr(llama_cpp, "__version__", "unknown")
+    except ImportError:
+        backend = "none"
+    memory = physical_memory_bytes() or 0
+    parts = [cpu_model(), str(os.cpu_count()), f"{round(memory / 2 ** 30)}GB", platform.machine(), backend]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16], parts
+
+
+def _read_tunings(path=TUNING_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_tuning(model_path, path=TUNING_PATH):
+    # Stored Llama() kwargs for this model on this host, or {}
+    if not os.path.exists(path) or not os.path.exists(model_path):
+        return {}
+    entry = _read_tunings(path).get(model_fingerprint(model_path), {}).get(host_fingerprint()[0])
+    return dict(entry["params"]) if entry else {}
+
+
+def save_tuning(model_path, params, results, path=TUNING_PATH):
+    tunings = _read_tunings(path)
+    host_key, host_parts = host_fingerprint()
+    tunings.setdefault(model_fingerprint(model_path), {})[host_key] = {
+        "model": os.path.basename(model_path),
+        "host": host_parts,
+        "params": params,
+        "prompt_tokens_per_s": results["prompt_tokens_per_s"],
+        "generate_tokens_per_s": results["generate_tokens_per_s"],
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tunings, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def resolve_kv_types(params):
+    # JSON stores KV cache types by name ("f16", "q8_0"); Llama() wants GGML type ids
+    import llama_cpp
+
+    resolved = dict(params)
+    for key in ("type_k", "type_v"):
+        if isinstance(resolved.get(key), str):
+            resolved[key] = getattr(llama_cpp, f"GGML_TYPE_{resolved[key].upper()}")
+    return resolved
+
+
+def measure(model_path, n_ctx, params):
+    from llama_cpp import Llama
+
+    started = time.perf_counter()
+    # CPU-only: with layers offloaded these settings barely matter
+    model = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=0, verbose=False, **resolve_kv_types(params))
+    load = time.perf_counter() - started
+    try:
+        # Deterministic filler prompt, long enough to exercise prompt batching
+        text = " ".join(f"The lighthouse keeper counted {i} ships before dawn." for i in range(200))
+        tokens = model.tokenize(text.encode("utf-8"))[:PROMPT_TOKENS]
+
+        model.reset()
+        started = time.perf_counter()
+        model.eval(tokens)
+        prompt_time = time.perf_counter() - started
+
+        # Token-by-token decode of a fixed sequence measures generation without sampling noise
+        started = time.perf_counter()
+        for token in tokens[:GENERATE_TOKENS]:
+            model.eval([token])
+        generate_time = time.perf_counter() - started
+    finally:
+        if hasattr(model, "close"):
+            model.close()
+
+    prompt_tps = len(tokens) / prompt_time
+    generate_tps = GENERATE_TOKENS / generate_time
+    return {
+        "load_s": load,
+        "prompt_tokens_per_s": prompt_tps,
+        "generate_tokens_per_s": generate_tps,
+        # Seconds for one modelled chat turn; lower is better
+        "turn_s": PROMPT_TOKENS / prompt_tps + GENERATE_TOKENS / generate_tps
+    }
+
+
+def thread_candidates(quick=False):
+    logical = os.cpu_count() or 1
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = logical
+    # Generation is memory-bound and often peaks below the core count
+    candidates = {available, max(1, available // 2), max(1, available - 1)}
+    if not quick:
+        candidates |= {max(1, available // 4), max(1, (available * 3) // 4)}
+    return sorted(candidates)
+
+
+def sweep(model_path, n_ctx, quick=False, log=print):
+    # Coordinate descent: tune one setting at a time, keeping the best of the previous steps
+    best = {"use_mmap": True, "use_mlock": False}
+    best_result = None
+
+    def trial(params):
+        nonlocal best, best_result
+        try:
+            result = measure(model_path, n_ctx, params)
+        except Exception as e:
+            log(f"  {params}: failed ({e})")
+            return
+        log(f"  {params}: prompt {result['prompt_tokens_per_s']:.1f} tok/s, "
+            f"generate {result['generate_tokens_per_s']:.1f} tok/s, turn {result['turn_s']:.2f}s")
+        if best_result is None or result["turn_s"] < best_result["turn_s"]:
+            best, best_result = dict(params), result
+
+    log("Threads")
+    for n in thread_candidates(quick):
+        trial({**best, "n_threads": n, "n_threads_batch": n})
+    if not quick:
+        # Prompt evaluation is compute-bound and may want more threads than generation
+        for n in thread_candidates():
+            if n > best.get("n_threads", 0):
+                trial({**best, "n_threads_batch": n})
+
+    log("Batch size")
+    for n_batch in ((256, 512) if quick else (128, 256, 512, 1024)):
+        trial({**best, "n_batch": n_batch})
+
+    log("Memory mapping")
+    for use_mmap, use_mlock in ((True, True), (False, False)):
+        trial({**best, "use_mmap": use_mmap, "use_mlock": use_mlock})
+
+    log("KV cache type")
+    # A quantized V cache needs flash attention in llama.cpp
+    trial({**best, "type_k": "q8_0", "type_v": "q8_0", "flash_attn": True})
+    if not quick:
+        trial({**best, "type_k": "q8_0"})
+        trial({**best, "flash_attn": True})
+
+    return best, best_result
+
+
+def main(argv=None):
+    from model_loader import ModelLoader
+
+    parser = argparse.ArgumentParser(description="Tune llama.cpp runtime settings for this host")
+    parser.add_argument("--model", default="chat", help="ModelLoader key of a GGUF model")
+    parser.add_argument("--quick", action="store_true", help="try fewer candidates")
+    parser.add_argument("--show", action="store_true", help="print the stored settings and exit")
+    args = parser.parse_args(argv)
+
+    config = ModelLoader().model_configs[args.model]
+    if config.type != "gguf":
+        raise SystemExit(f"{args.model} is not a GGUF model")
+    if not os.path.exists(config.path):
+        raise SystemExit(f"GGUF model not found at {config.path}")
+
+    if args.show:
+        print(json.dumps(load_tuning(config.path), indent=2))
+        return
+
+    print(f"Tuning {config.path} on {cpu_model()} ({os.cpu_count()} logical CPUs)")
+    best, result = sweep(config.path, config.params.get("n_ctx", 2048), args.quick)
+    if result is None:
+        raise SystemExit("No configuration could be loaded")
+    save_tuning(config.path, best, result)
+    print(f"Best: {best}")
+    print(f"  prompt {result['prompt_tokens_per_s']:.1f} tok/s, generate {result['generate_tokens_per_s']:.1f} tok/s")
+    print(f"Saved to {TUNING_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# /benchmarks/run.py
+
+# Hot-path benchmarks. Run from the repository root:
+#   python -m benchmarks.run                      # stub backends, no model files needed
+#   python -m benchmarks.run --real               # also time the real chat/image models
+#   python -m benchmarks.run -o new.json --compare old.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.stubs import StubModelLoader, StubImageGenerator, install_torch_shim
+from chatbot import AIChatbot
+from database import DatabaseManager
+from profile_manager import ProfileManager
+
+HISTORY_TURNS = [0, 100, 1000, 5000]
+SESSION_SIZES = [10, 100, 1000]
+SESSION_COUNTS = [10, 100, 1000]
+
+
+def measure(fn, repeat=20, warmup=2):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        "mean_ms": statistics.fmean(times),
+        "p50_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "min_ms": times[0],
+        "repeat": repeat
+    }
+
+
+def fill_history(bot, turns):
+    bot.reset_chat()
+    for i in range(turns):
+        bot.chat_history.append(f":User  Question {i} about the weather, books and travel plans?")
+        bot.chat_history.append(f"Chatbot: Answer {i}: it depends on the season and on what you enjoy.")
+
+
+def bench_chat(workdir):
+    db = DatabaseManager(os.path.join(workdir, "chat.db"))
+    pm = ProfileManager(db)
+    pm.set_current_profile("chatbot", "Bench", {"personality": "friendly", "interests": ["tea"] * 20})
+    pm.set_current_profile("user", "Guest", {"name": "User", "bio": "benchmark"})
+    loader = StubModelLoader(state_cache_dir=os.path.join(workdir, "kv_cache"))
+    bot = AIChatbot(pm, model_loader=loader)
+
+    results = {"build_prompt": {}, "respond": {}}
+    for turns in HISTORY_TURNS:
+        fill_history(bot, turns)
+        results["build_prompt"][str(turns)] = measure(lambda: bot.build_prompt("What should I read next?"))
+
+        # respond() appends two lines per call; keep the history at the target length
+        def respond():
+            bot.respond("What should I read next?")
+            del bot.chat_history[-2:]
+        results["respond"][str(turns)] = measure(respond, repeat=10)
+    bot.scheduler.shutdown()
+    db.close()
+    return results
+
+
+def bench_database(workdir):
+    results = {"save_session": {}, "load_session": {}, "append_turn": {}, "list_sessions": {}}
+    for size in SESSION_SIZES:
+        db = DatabaseManager(os.path.join(workdir, f"db_size_{size}.db"))
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i} " + "lorem ipsum " * 8}
+            for i in range(size)
+        ]
+        counter = iter(range(10 ** 9))
+        results["save_session"][str(size)] = measure(
+            lambda: db.save_chat_session(f"s{next(counter)}", "Default", "Guest", messages), repeat=10
+        )
+        session_id = db.save_chat_session("target", "Default", "Guest", messages)
+        results["load_session"][str(size)] = measure(lambda: db.load_chat_messages(session_id))
+        turn = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        results["append_turn"][str(size)] = measure(lambda: db.append_chat_messages(session_id, turn))
+        db.close()
+
+    for count in SESSION_COUNTS:
+        db = DatabaseManager(os.path.join(workdir, f"db_count_{count}.db"))
+        messages = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi there"}]
+        for i in range(count):
+            db.save_chat_session(f"session {i}", "Default", "Guest", messages)
+        results["list_sessions"][str(count)] = measure(lambda: db.list_chat_sessions(limit=50))
+        db.close()
+    return results
+
+
+def bench_profiles(workdir):
+    db = DatabaseManager(os.path.join(workdir, "profiles.db"))
+    pm = ProfileManager(db)
+    for i in range(50):
+        pm.save_profile("chatbot", f"bot {i}", {"personality": "curious", "index": i})
+    pm.set_current_profile("chatbot", "bot 0", pm.get_profile_data("chatbot", "bot 0"))
+
+    def lookups():
+        for i in range(50):
+            pm.get_profile_data("chatbot", f"bot {i}")
+
+    results = {
+        "get_profile_data_x50": measure(lookups),
+        "get_profile_options": measure(lambda: pm.get_profile_options("chatbot")),
+        "get_prompt_fragment": measure(lambda: pm.get_prompt_fragment("chatbot"), repeat=1000),
+        "db_get_profile_x50": measure(lambda: [db.get_profile("chatbot", f"bot {i}") for i in range(50)])
+    }
+    db.close()
+    return results
+
+
+def bench_images(workdir):
+    shimmed = install_torch_shim()
+    cwd = os.getcwd()
+    # ImageGenerator writes into ./generated_images
+    os.chdir(workdir)
+    try:
+        db = DatabaseManager(os.path.join(workdir, "images.db"))
+        ig = StubImageGenerator(db)
+        seeds = iter(range(10 ** 9))
+        results = {
+            "torch_shim": shimmed,
+            "generate_miss": measure(lambda: ig.generate_image("a castle at dusk", seed=next(seeds), steps=20)),
+            "generate_hit": measure(lambda: ig.generate_image("a castle at dusk", seed=0, steps=20)),
+            "queue_round_trip": measure(
+                lambda: ig.submit("a castle at dusk", seed=next(seeds), steps=20).result(30), repeat=10
+            ),
+        }
+        started = time.perf_counter()
+        jobs = [ig.submit(f"prompt {i}", seed=next(seeds), steps=20) for i in range(32)]
+        for job in jobs:
+            job.result(60)
+        results["queue_32_jobs_s"] = time.perf_counter() - started
+        results["queue_stats"] = ig.queue.stats()
+        ig.writer.flush()
+        ig.close()
+        db.close()
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def bench_real_chat(workdir, prompts=3):
+    db = DatabaseManager(os.path.join(workdir, "real_chat.db"))
+    bot = AIChatbot(ProfileManager(db))
+    runs = []
+    for i in range(prompts):
+        started = time.perf_counter()
+        first = None
+        pieces = 0
+        for _ in bot.respond_stream(f"Tell me a short story about a lighthouse, part {i + 1}."):
+            if first is None:
+                first = time.perf_counter() - started
+            pieces += 1
+        total = time.perf_counter() - started
+        decode = total - (first or 0)
+        runs.append({
+            "time_to_first_token_s": first,
+            "tokens": pieces,
+            "tokens_per_s": (pieces - 1) / decode if pieces > 1 and decode > 0 else 0.0,
+            "total_s": total
+        })
+    bot.scheduler.shutdown()
+    return {"load_s": bot.load_seconds, "runs": runs}
+
+
+def bench_real_images(workdir, images=2):
+    from image_generator import ImageGenerator
+
+    cwd = os.getcwd()
+    # Keep renders out of the real generated_images directory
+    os.chdir(workdir)
+    try:
+        db = DatabaseManager(os.path.join(workdir, "real_images.db"))
+        ig = ImageGenerator(db=db)
+        return _time_real_images(ig, images)
+    finally:
+        os.chdir(cwd)
+
+
+def _time_real_images(ig, images):
+    started = time.perf_counter()
+    ig.get_pipeline("stable_diffusion")
+    load = time.perf_counter() - started
+    runs = []
+    for seed in range(images):
+        started = time.perf_counter()
+        ig.generate_image("A lighthouse on a cliff at sunset", seed=seed, steps=20)
+        runs.append(time.perf_counter() - started)
+    ig.close()
+    return {"load_s": load, "profile": ig.profile.as_metadata(), "seconds_per_image": runs}
+
+
+def environment():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "git_revision": revision,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+
+def flatten(results, prefix=""):
+    # {"chat": {"build_prompt": {"100": {"mean_ms": 1.2}}}} -> {"chat.build_prompt.100": 1.2}
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict) and "mean_ms" in value:
+            flat[name] = value["mean_ms"]
+        elif isinstance(value, dict):
+            flat.update(flatten(value, name))
+    return flat
+
+
+def compare(old, new):
+    old_flat, new_flat = flatten(old["results"]), flatten(new["results"])
+    print(f"{'benchmark':60} {'old ms':>10} {'new ms':>10} {'change':>8}")
+    for name in sorted(set(old_flat) & set(new_flat)):
+        before, after = old_flat[name], new_flat[name]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:60} {before:10.3f} {after:10.3f} {change:+7.1f}%")
+
+
+SUITES = {
+    "chat": bench_chat,
+    "database": bench_database,
+    "profiles": bench_profiles,
+    "images": bench_images,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chat, database and image hot paths")
+    parser.add_argument("--only", nargs="+", choices=sorted(SUITES), help="run only these suites")
+    parser.add_argument("--real", action="store_true", help="also benchmark the real models")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="print the change against an earlier results file")
+    args = parser.parse_args(argv)
+
+    report = {"environment": environment(), "results": {}}
+    with tempfile.TemporaryDirectory(prefix="ai-waifu-bench-") as workdir:
+        for name in args.only or SUITES:
+            print(f"Running {name}...", file=sys.stderr)
+            report["results"][name] = SUITES[name](workdir)
+        if args.real:
+            print("Running real chat model...", file=sys.stderr)
+            report["results"]["real_chat"] = bench_real_chat(workdir)
+            print("Running real image model...", file=sys.stderr)
+            report["results"]["real_images"] = bench_real_images(workdir)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# /benchmarks/stubs.py
+
+# Deterministic stand-ins for the llama.cpp and diffusers backends, so the code around
+# inference can be timed on any CPU-only machine without model files.
+
+import sys
+import types
+import zlib
+
+from model_loader import ModelLoader
+from image_generator import ImageGenerator
+
+
+class StubState:
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.llama_state_size = len(tokens) * 1024
+
+
+class StubLlama:
+    # Mirrors the parts of llama_cpp.Llama that AIChatbot uses: ~4 bytes per token,
+    # prefix reuse across calls and a fixed reply
+    reply = " Sure, tell me more about that."
+
+    def __init__(self, n_ctx=2048):
+        self.n_ctx = n_ctx
+        self.tokens = []
+        self.evaluated = 0
+
+    @property
+    def n_tokens(self):
+        return len(self.tokens)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [zlib.crc32(text[i:i + 4]) for i in range(0, len(text), 4)]
+        return ([1] if add_bos else []) + tokens
+
+    def save_state(self):
+        return StubState(self.tokens)
+
+    def load_state(self, state):
+        self.tokens = list(state.tokens)
+
+    def create_completion(self, prompt, max_tokens=16, stop=None, stream=False, **kwargs):
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        common = 0
+        for a, b in zip(tokens, self.tokens):
+            if a != b:
+                break
+            common += 1
+        self.evaluated += len(tokens) - common
+        self.tokens = tokens
+
+        pieces = self.reply.split(" ")[1:][:max_tokens]
+        if not stream:
+            return {"choices": [{"text": "".join(" " + p for p in pieces), "finish_reason": "stop"}]}
+        return ({"choices": [{"text": " " + p, "finish_reason": None}]} for p in pieces)
+
+
+class StubModelLoader(ModelLoader):
+    def __init__(self, state_cache_dir=None):
+        super().__init__(memory_budget_mb=None)
+        params = self.model_configs["chat"].params
+        # Serial scheduling: the batched decoder needs the real low-level llama.cpp API
+        params["n_parallel"] = 1
+        params["state_cache_dir"] = state_cache_dir
+
+    def estimate_memory(self, model_key):
+        return 0
+
+    def _load(self, model_key):
+        if model_key != "chat":
+            raise ValueError(f"No stub for model {model_key}")
+        return StubLlama(self.model_configs["chat"].params["n_ctx"])
+
+
+class StubPipeline:
+    # Returns flat images whose colour depends on the prompt; no denoising work
+    device = "cpu"
+    tokenizer = text_encoder = unet = vae = None
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def enable_attention_slicing(self):
+        pass
+
+    def register_modules(self, **modules):
+        for name, module in modules.items():
+            setattr(self, name, module)
+
+    def __call__(self, prompt=None, negative_prompt=None, num_inference_steps=30, width=512,
+                 height=512, generator=None, callback_on_step_end=None, **kwargs):
+        from PIL import Image
+
+        for step in range(num_inference_steps):
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, 0, {})
+        images = []
+        for text in prompt:
+            crc = zlib.crc32(text.encode("utf-8"))
+            images.append(Image.new("RGB", (width, height), (crc & 255, crc >> 8 & 255, crc >> 16 & 255)))
+        return types.SimpleNamespace(images=images)
+
+
+class StubImageGenerator(ImageGenerator):
+    def __init__(self, db, **kwargs):
+        kwargs.setdefault("profile", "cpu-fp32")
+        super().__init__(db=db, **kwargs)
+
+    def _load_sd_model(self):
+        return self.profile.apply(StubPipeline())
+
+    def _load_wd_model(self):
+        return self.profile.apply(StubPipeline())
+
+
+def install_torch_shim():
+    # ImageGenerator imports torch for seeds and dtypes. Without a torch install, a minimal
+    # CPU shim stands in; with one, the real module is used.
+    try:
+        import torch  # noqa: F401
+        return False
+    except ImportError:
+        pass
+
+    class Generator:
+        def __init__(self, device="cpu"):
+            self._seed = 0
+
+        def seed(self):
+            return 0
+
+        def manual_seed(self, seed):
+            self._seed = seed
+            return self
+
+    torch = types.ModuleType("torch")
+    torch.Generator = Generator
+    torch.float32, torch.float16, torch.bfloat16 = "float32", "float16", "bfloat16"
+    torch.channels_last = "channels_last"
+    torch.cuda = types.SimpleNamespace(is_available=lambda: False, empty_cache=lambda: None)
+    torch.set_num_threads = lambda n: None
+    sys.modules["torch"] = torch
+    return True
@@ -0,0 +1,157 @@
+# /chat_state.py
+
+# Server-side conversations, one per browser client. The UI keeps only a session token in
+# the browser; the history lives here in an LRU bounded by count and size. Idle
+# conversations beyond the cap are spilled to SQLite and rehydrated when their client
+# returns, so memory doesn't grow with the number of users. The chatbot and user profiles
+# are not part of this state: ProfileManager.current_profiles is still shared by all clients.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import uuid
+
+import metrics
+
+MB = 1024 * 1024
+
+
+class ChatState:
+    def __init__(self, token, history=None, history_start=0, session_key=None,
+                 session_id=None, session_name=None, autosaved=False):
+        self.token = token
+        self.history = history or []  # prompt lines, see AIChatbot.format_message
+        self.history_start = history_start
+        # Key of this conversation's KV state in the model; changes when it is reset
+        self.session_key = session_key or uuid.uuid4().hex
+        self.session_id = session_id  # saved chat session the turns are appended to
+        self.session_name = session_name
+        self.autosaved = autosaved  # session_name was made up by autosave, not chosen
+
+    @property
+    def nbytes(self):
+        # Rough resident size: the text plus per-line object overhead
+        return 256 + sum(len(line) + 64 for line in self.history)
+
+    def to_dict(self):
+        return {
+            "history": self.history,
+            "history_start": self.history_start,
+            "session_key": self.session_key,
+            "session_id": self.session_id,
+            "session_name": self.session_name,
+            "autosaved": self.autosaved
+        }
+
+    @classmethod
+    def from_dict(cls, token, data):
+        return cls(token, **data)
+
+
+class ChatStateStore:
+    def __init__(self, db, max_states=1000, max_bytes=64 * MB, max_age_days=30):
+        self.db = db
+        self.max_states = max_states
+        self.max_bytes = max_bytes
+        self._states = OrderedDict()  # token -> ChatState, least recently used first
+        self._sizes = {}
+        self._pins = {}
+        self._lock = threading.RLock()
+        self.size = 0
+        self.spilled = 0
+        self.rehydrated = 0
+        # Clients that never came back
+        db.prune_client_states(max_age_days)
+
+        metrics.gauge("chat_states_resident", "Client conversations held in memory", fn=lambda: len(self._states))
+        metrics.gauge("chat_states_resident_bytes", "Estimated size of resident conversations",
+                      fn=lambda: self.size)
+
+    @staticmethod
+    def new_token():
+        return uuid.uuid4().hex
+
+    def get(self, token):
+        # Resident, spilled or new; the caller should hold it with use() while mutating it
+        with self._lock:
+            state = self._states.get(token)
+            if state is not None:
+                self._states.move_to_end(token)
+                return state
+
+            data = self.db.take_client_state(token)
+            if data is not None:
+                state = ChatState.from_dict(token, data)
+                self.rehydrated += 1
+            else:
+                state = ChatState(token)
+            self._states[token] = state
+            self._account(token)
+            self._evict()
+            return state
+
+    @contextmanager
+    def use(self, token):
+        # Pinned states are never spilled, so a turn in progress can't be lost
+        with self._lock:
+            # Pinned before get(), whose eviction pass could otherwise drop this very state
+            self._pins[token] = self._pins.get(token, 0) + 1
+            try:
+                state = self.get(token)
+            except BaseException:
+                self._unpin(token)
+                raise
+        try:
+            yield state
+        finally:
+            with self._lock:
+                self._unpin(token)
+                if token in self._states:
+                    # The history may have grown during the turn
+                    self._account(token)
+                    self._evict()
+
+    def _unpin(self, token):
+        if self._pins.get(token, 0) > 1:
+            self._pins[token] -= 1
+        else:
+            self._pins.pop(token, None)
+
+    def _account(self, token):
+        size = self._states[token].nbytes
+        self.size += size - self._sizes.get(token, 0)
+        self._sizes[token] = size
+
+    def _evict(self):
+        spill = []
+        for token in list(self._states):
+            if len(self._states) <= self.max_states and self.size <= self.max_bytes:
+                break
+            if self._pins.get(token):
+                continue
+            state = self._states.pop(token)
+            self.size -= self._sizes.pop(token)
+            # Empty conversations aren't worth a row
+            if state.history or state.session_id is not None:
+                spill.append((token, state.to_dict()))
+        if spill:
+            self.db.save_client_states(spill)
+            self.spilled += len(spill)
+
+    def flush(self):
+        # Spill everything that's resident, e.g. before shutdown
+        with self._lock:
+            states = [(token, state.to_dict()) for token, state in self._states.items()
+                      if state.history or state.session_id is not None]
+            if states:
+                self.db.save_client_states(states)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": len(self._states),
+                "resident_bytes": self.size,
+                "pinned": len(self._pins),
+                "spilled": self.spilled,
+                "rehydrated": self.rehydrated
+            }
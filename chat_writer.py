@@ -0,0 +1,161 @@
+# /chat_writer.py
+
+# Write-behind persistence of chat turns. The response path only enqueues; a background
+# thread gathers the turns that arrive within `interval` (or up to `max_batch` of them) and
+# commits them in one transaction. With WAL and synchronous=NORMAL a commit doesn't fsync,
+# so a crash of the app loses at most the turns still queued, and the lag stats say how many.
+
+from collections import deque
+import atexit
+import queue
+import threading
+import time
+
+import metrics
+
+_STOP = object()
+
+
+class ChatWriter:
+    def __init__(self, db, interval=0.5, max_batch=64, profile_manager=None):
+        self.db = db
+        # Through the manager when there is one, so its profile caches see created profiles
+        self._create_session = (profile_manager or db).create_chat_session
+        self.interval = interval
+        self.max_batch = max_batch
+        self.commits = 0
+        self.written = 0
+        self.failed = 0
+        self.last_commit_s = 0.0
+        self.last_lag_s = 0.0
+        self.max_lag_s = 0.0
+        self._lag_total = 0.0
+        self._queue = queue.Queue()
+        self._enqueued = deque()  # enqueue times of uncommitted turns, oldest first
+        self._lock = threading.Lock()
+
+        metrics.gauge("chat_persist_backlog", "Chat turns waiting to be committed", fn=lambda: self.backlog)
+        metrics.gauge("chat_persist_lag_current_seconds", "Age of the oldest uncommitted chat turn",
+                      fn=lambda: self.lag)
+
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    @property
+    def backlog(self):
+        with self._lock:
+            return len(self._enqueued)
+
+    @property
+    def lag(self):
+        # Seconds the oldest queued turn has been waiting; 0 when everything is on disk
+        with self._lock:
+            return time.monotonic() - self._enqueued[0] if self._enqueued else 0.0
+
+    def append(self, state, messages, chatbot_profile, user_profile):
+        # The target session is captured now; turns of a not yet saved conversation create
+        # (or, after a restart, find) the session named state.session_name
+        now = time.monotonic()
+        with self._lock:
+            self._enqueued.append(now)
+        self._queue.put((state, state.session_id, state.session_name, messages,
+                         chatbot_profile, user_profile, now))
+
+    def flush(self):
+        self._queue.join()
+
+    def shutdown(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self):
+        commits = max(self.commits, 1)
+        return {
+            "backlog": self.backlog,
+            "lag_s": self.lag,
+            "last_lag_s": self.last_lag_s,
+            "max_lag_s": self.max_lag_s,
+            "avg_lag_s": self._lag_total / self.written if self.written else 0.0,
+            "commits": self.commits,
+            "turns_written": self.written,
+            "turns_per_commit": self.written / commits,
+            "failed": self.failed,
+            "last_commit_ms": self.last_commit_s * 1000
+        }
+
+    def _write(self, turn, created):
+        state, session_id, session_name, messages, chatbot_profile, user_profile, _ = turn
+        if session_id is None:
+            session_id = created.get(session_name)
+        if session_id is None:
+            session_id = self._create_session(session_name, chatbot_profile, user_profile)
+            created[session_name] = session_id
+        self.db.append_chat_messages(session_id, messages)
+
+    def _committed(self, turns, created):
+        now = time.monotonic()
+        for state, session_id, session_name, *_ in turns:
+            # Unless the conversation was saved under another name in the meantime
+            if state.session_id is None and state.session_name == session_name and session_name in created:
+                state.session_id = created[session_name]
+        with self._lock:
+            for turn in turns:
+                lag = now - turn[-1]
+                self._enqueued.popleft()
+                self.last_lag_s = lag
+                self.max_lag_s = max(self.max_lag_s, lag)
+                self._lag_total += lag
+                metrics.histogram("chat_persist_lag_seconds").observe(lag)
+            self.written += len(turns)
+
+    def _commit(self, turns):
+        started = time.perf_counter()
+        created = {}
+        try:
+            with self.db.transaction():
+                for turn in turns:
+                    self._write(turn, created)
+        except Exception as e:
+            # Retry one by one so a single bad turn doesn't take the group with it
+            print(f"Group commit of {len(turns)} chat turns failed, retrying individually: {e}")
+            for turn in turns:
+                created = {}
+                try:
+                    with self.db.transaction():
+                        self._write(turn, created)
+                except Exception as e:
+                    self.failed += 1
+                    print(f"Failed to save chat turn for {turn[2] or turn[1]}: {e}")
+                    with self._lock:
+                        self._enqueued.popleft()
+                    continue
+                self._committed([turn], created)
+                self.commits += 1
+        else:
+            self._committed(turns, created)
+            self.commits += 1
+        self.last_commit_s = time.perf_counter() - started
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while batch[-1] is not _STOP and len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            turns = [item for item in batch if item is not _STOP]
+            try:
+                if turns:
+                    self._commit(turns)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if batch[-1] is _STOP:
+                return
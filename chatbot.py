@@ -2,14 +2,37 @@
 
 from model_loader import ModelLoader
 from profile_manager import ProfileManager
-import json
+from context_window import ContextWindow
+from kv_cache import SessionStateCache
+from autotune import model_fingerprint
+from scheduler import RequestScheduler
+from chat_state import ChatState
+import metrics
 import gc
+import os
+import threading
+import time
+import uuid
 
 class AIChatbot:
-    def __init__(self, profile_manager: ProfileManager):
+    def __init__(self, profile_manager: ProfileManager, background=False, model_loader=None, autosave=False):
         self.pm = profile_manager
-        self.model_loader = ModelLoader()
-        self.chat_history = []
+        self.model_loader = model_loader or ModelLoader()
+        # With autosave every turn is persisted by a background writer (see chat_writer.py)
+        self.writer = None
+        if autosave:
+            from chat_writer import ChatWriter
+            self.writer = ChatWriter(profile_manager.db, profile_manager=profile_manager)
+        # Conversation used when a caller doesn't pass its own (see chat_state.py)
+        self.state = ChatState(None)
+        self._active_session = None
+        self._requests = {}
+        self.model = None
+        self.scheduler = None
+        self.ready = threading.Event()
+        self.load_error = None
+        self.load_seconds = None
+        self.ready_at = None
         
         # Default system prompt template
         self.system_template = """[System Context]
@@ -24,45 +47,298 @@ class AIChatbot:
 [Current Interaction]
 User : {user_input}
 Chatbot: """
-        self.load_model()
+        self.stop = ["\nUser", ":User", "\n[Current Interaction]"]
+        if background:
+            # Let the caller (the UI) come up while the model warms up
+            threading.Thread(target=self._warm_up, name="chat-warm-up", daemon=True).start()
+        else:
+            self.load_model()
 
+    def _warm_up(self):
+        try:
+            self.load_model()
+            # One tiny generation pages the mmapped weights in before the first real request
+            "".join(self.scheduler.submit("warm-up", "Hello", max_tokens=1))
+        except Exception as e:
+            self.load_error = e
+            self.ready.set()
+
+    @property
+    def chat_history(self):
+        return self.state.history
+
+    @chat_history.setter
+    def chat_history(self, history):
+        self.state.history = history
+
+    def wait_until_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise TimeoutError("Chat model is still loading.")
+        if self.load_error:
+            raise RuntimeError(f"Chat model failed to load: {self.load_error}")
+
+    @metrics.timed("chat_load_model")
     def load_model(self):
-        self.model = self.model_loader.load_model()
+        started = time.perf_counter()
+        if self.scheduler:
+            self.scheduler.shutdown()
+            if isinstance(self.scheduler, RequestScheduler):
+                self.model_loader.unpin("chat")
+
+        config = self.model_loader.model_configs["chat"]
+        params = config.params
+        self.n_ctx = params["n_ctx"]
+        self.max_tokens = params.get("max_tokens", 256)
+        self._active_session = None
+        if params.get("workers"):
+            self._start_workers(config)
+        else:
+            self._start_scheduler(config)
+        self.context_window = ContextWindow(
+            tokenizer=self.model,
+            max_tokens=params.get("history_tokens", self.n_ctx // 2)
+        )
+        self.ready_at = time.perf_counter()
+        self.load_seconds = self.ready_at - started
+        self.ready.set()
+
+    def _start_scheduler(self, config):
+        params = config.params
+        # Pinned for as long as the scheduler owns it, so residency management never evicts it
+        self.model = self.model_loader.pin("chat")
         if not self.model:
             raise RuntimeError("Model not loaded. Please check the model path.")
 
-    def build_prompt(self, user_input):
-        chatbot_profile = self.pm.get_current_profiles()['chatbot']
-        user_profile = self.pm.get_current_profiles()['user']
-        history = "\n".join(self.chat_history)
+        self.state_cache = SessionStateCache(
+            max_bytes=params.get("state_cache_mb", 1024) * 1024 * 1024,
+            spill_dir=params.get("state_cache_dir"),
+            max_disk_bytes=params.get("state_cache_disk_mb", 4096) * 1024 * 1024,
+            # Spilled states are pickles; only ever load those of this exact model file
+            namespace=model_fingerprint(config.path) if os.path.exists(config.path) else os.path.basename(config.path)
+        )
+        # Every request goes through the scheduler, which owns the model from its own thread
+        # Speculative decoding runs inside create_completion, i.e. on the serial path
+        n_parallel = 1 if params.get("speculative") else params.get("n_parallel", 1)
+        self.scheduler = RequestScheduler(
+            self.model,
+            self._stream_completion,
+            n_parallel=n_parallel,
+            n_ctx=self.n_ctx,
+            n_batch=params.get("n_batch", 512),
+            # Batched slots park and restore their sessions' KV cells here too
+            state_cache=self.state_cache
+        )
+
+    def _start_workers(self, config):
+        from llama_cpp import Llama
+        from worker_pool import WorkerPool
+
+        if not os.path.exists(config.path):
+            raise FileNotFoundError(f"GGUF model not found at {config.path}")
+        # The replicas own the weights; this process only tokenizes to budget the prompt
+        self.model = Llama(model_path=config.path, vocab_only=True, verbose=False)
+        self.scheduler = WorkerPool(
+            config.params["workers"],
+            loader_class=type(self.model_loader),
+            overrides=config.params
+        )
+        try:
+            self.scheduler.wait_ready()
+        except Exception:
+            # Don't leave replicas restarting behind a failed load
+            self.scheduler.shutdown()
+            raise
+
+    def history_budget(self, fixed_prompt, user_input):
+        # Whatever the fixed sections, the new input and the reply don't need is left for history.
+        # The fixed sections only change with the profiles, so their count stays cached.
+        fixed_tokens = self.context_window.count_tokens(fixed_prompt)
+        input_tokens = self.context_window.count_tokens(user_input)
+        return self.n_ctx - self.max_tokens - fixed_tokens - input_tokens
+
+    @metrics.timed("chat_build_prompt")
+    def build_prompt(self, user_input, state=None):
+        state = state or self.state
+        sections = {
+            "chatbot_profile": self.pm.get_prompt_fragment('chatbot'),
+            "user_profile": self.pm.get_prompt_fragment('user')
+        }
 
-        return self.system_template.format(
-            chatbot_profile=json.dumps(chatbot_profile['data']),
-            user_profile=json.dumps(user_profile['data']),
-            history=history,
-            user_input=user_input
+        fixed_prompt = self.system_template.format(history="", user_input="", **sections)
+        state.history_start = self.context_window.window_start(
+            state.history,
+            self.history_budget(fixed_prompt, user_input),
+            state.history_start
         )
+        history = "\n".join(self.context_window.render(state.history, state.history_start))
+
+        return self.system_template.format(history=history, user_input=user_input, **sections)
+
+    def respond(self, user_input, state=None):
+        return "".join(self.respond_stream(user_input, state)).strip()
 
-    def respond(self, user_input):
+    def respond_stream(self, user_input, state=None):
+        state = state or self.state
+        self.wait_until_ready()
         if not self.model:
             raise RuntimeError("No model loaded to generate a response.")
-        
-        prompt = self.build_prompt(user_input)
-        response = self.model.generate_response(prompt)
-        self.chat_history.append(f":User  {user_input}")
-        self.chat_history.append(f"Chatbot: {response}")
-        
-        return response
 
-    def save_chat_history(self, session_name):
-        self.pm.save_chat_session(session_name, self.chat_history)
+        prompt = self.build_prompt(user_input, state)
+        request = self.scheduler.submit(
+            state.session_key,
+            prompt,
+            max_tokens=self.max_tokens,
+            stop=self.stop
+        )
+        # Per conversation, not per session key: two clients may have the same session loaded
+        self._requests[state] = request
+        chunks = []
+        failed = False
+        started = time.perf_counter()
+        try:
+            with metrics.span("chat_respond"):
+                for delta in request:
+                    if not chunks:
+                        metrics.histogram("chat_time_to_first_token_seconds").observe(
+                            time.perf_counter() - started
+                        )
+                    chunks.append(delta)
+                    yield delta
+        except Exception:
+            # A failed turn is neither added to the history nor persisted
+            failed = True
+            raise
+        finally:
+            # Runs on normal end, cancel() and when the consumer drops the generator
+            request.cancel()
+            if self._requests.get(state) is request:
+                del self._requests[state]
+            if not failed:
+                self._commit_turn(state, user_input, "".join(chunks).strip())
+
+    def speculative_stats(self):
+        # Draft acceptance counters, or None without speculative decoding
+        draft = getattr(self.model, "draft_model", None)
+        return draft.stats() if hasattr(draft, "stats") else None
+
+    def cancel(self, state=None):
+        request = self._requests.get(state or self.state)
+        if request:
+            request.cancel()
+
+    def _stream_completion(self, request):
+        # Serial path, called from the scheduler thread
+        self._activate_session(request.session_key)
+        # llama.cpp only evaluates the tokens after the longest prefix already in its KV cache
+        stream = self.model.create_completion(
+            request.prompt,
+            max_tokens=request.max_tokens,
+            stop=request.stop,
+            temperature=request.temperature,
+            top_k=request.top_k,
+            top_p=request.top_p,
+            min_p=request.min_p,
+            repeat_penalty=request.repeat_penalty,
+            stream=True
+        )
+        try:
+            for chunk in stream:
+                yield chunk["choices"][0]["text"]
+        finally:
+            stream.close()
+
+    def _commit_turn(self, state, user_input, response):
+        state.history.append(f":User  {user_input}")
+        state.history.append(f"Chatbot: {response}")
+        messages = [
+            {"role": "user", "content": user_input},
+            {"role": "assistant", "content": response}
+        ]
+        if self.writer is not None:
+            if state.session_id is None and state.session_name is None:
+                state.session_name = self.autosave_name(state, user_input)
+                state.autosaved = True
+            profiles = self.pm.current_profiles
+            self.writer.append(state, messages, profiles['chatbot']['name'], profiles['user']['name'])
+        elif state.session_id is not None:
+            self.pm.append_chat_messages(messages, session_id=state.session_id)
+
+    @staticmethod
+    def autosave_name(state, first_input):
+        # Stable for the conversation, so turns queued before a restart land in the same session
+        title = " ".join(first_input.split())[:40] or "Chat"
+        return f"{title} · {state.session_key[:6]}"
+
+    def _activate_session(self, session_key):
+        # Park the outgoing session's evaluated prefix and restore the incoming one
+        if self._active_session == session_key:
+            return
+        if self._active_session is not None and self.model.n_tokens:
+            self.state_cache.put(self._active_session, self.model.save_state())
+
+        state = self.state_cache.get(session_key)
+        if state is not None:
+            self.model.load_state(state)
+        self._active_session = session_key
+
+    @staticmethod
+    def format_message(message):
+        # History line for a stored {"role", "content"} message
+        if message["role"] == "user":
+            return f":User  {message['content']}"
+        if message["role"] == "assistant":
+            return f"Chatbot: {message['content']}"
+        return message["content"]
+
+    def save_chat_history(self, session_name, state=None):
+        state = state or self.state
+        if self.writer is not None:
+            # Queued turns land first, or the writer would append them again after this save
+            self.writer.flush()
+        # An autosaved session takes the chosen name instead of being copied
+        replace_session_id = state.session_id if state.autosaved else None
+        state.session_id = self.pm.save_chat_session(
+            session_name, state.history, replace_session_id=replace_session_id
+        )
+        state.session_name = session_name
+        state.autosaved = False
+
+    def load_chat_history(self, session_id, state=None):
+        state = state or self.state
+        state.history = [
+            self.format_message(message) for message in self.pm.load_chat_history(session_id)
+        ]
+        state.history_start = 0
+        # Its own KV state per client; the token keeps two browsers on one session apart
+        state.session_key = f"session-{session_id}-{state.token}"
+        state.session_id = session_id
+        state.session_name = self.pm.current_session
+        state.autosaved = False
 
-    def load_chat_history(self, session_id):
-        self.chat_history = self.pm.load_chat_history(session_id)
+    def reset_chat(self, state=None):
+        state = state or self.state
+        # An unsaved conversation can't be switched back to, so don't park its state
+        if self._active_session == state.session_key and not state.session_key.startswith("session-"):
+            self._active_session = None
+        state.history = []
+        state.history_start = 0
+        state.session_key = uuid.uuid4().hex
+        state.session_id = None
+        state.session_name = None
+        state.autosaved = False
 
-    def reset_chat(self):
-        self.chat_history = []
+    def get_chat_history(self, state=None):
+        return (state or self.state).history.copy()
 
-    def get_chat_history(self):
-        return self.chat_history.copy()
+    def get_chat_pairs(self, state=None):
+        # (user, chatbot) pairs for gr.Chatbot
+        pairs = []
+        for message in (state or self.state).history:
+            if message.startswith(":User  "):
+                pairs.append([message[len(":User  "):], None])
+            elif message.startswith("Chatbot: ") and pairs and pairs[-1][1] is None:
+                pairs[-1][1] = message[len("Chatbot: "):]
+            else:
+                pairs.append([None, message])
+        return pairs
 
@@ -0,0 +1,3 @@
+# /conftest.py
+
+# Lets tests import the top-level modules when pytest runs from the repository root
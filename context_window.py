@@ -0,0 +1,70 @@
+# /context_window.py
+
+from collections import OrderedDict
+
+
+class ContextWindow:
+    def __init__(self, tokenizer=None, max_tokens=1024, fold_dropped=True,
+                 low_water=0.75, cache_size=4096):
+        # tokenizer is the loaded Llama (anything with .tokenize(bytes, add_bos=...))
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.fold_dropped = fold_dropped
+        # On overflow the window slides down to this fraction of the budget, so the
+        # prompt prefix (and the model's KV cache for it) stays stable for several turns
+        self.low_water = low_water
+        self.cache_size = cache_size
+        self._token_counts = OrderedDict()
+
+    def count_tokens(self, text):
+        count = self._token_counts.get(text)
+        if count is not None:
+            self._token_counts.move_to_end(text)
+            return count
+
+        if self.tokenizer is not None:
+            count = len(self.tokenizer.tokenize(text.encode("utf-8"), add_bos=False))
+        else:
+            # Rough estimate when no tokenizer is available (~4 chars per token)
+            count = max(1, len(text) // 4)
+
+        self._token_counts[text] = count
+        if len(self._token_counts) > self.cache_size:
+            self._token_counts.popitem(last=False)
+        return count
+
+    def fold_marker(self, n_dropped):
+        return f"[{n_dropped} earlier messages omitted]"
+
+    def _turn_cost(self, turn):
+        # Each turn costs its tokens plus the joining newline
+        return self.count_tokens(turn) + 1
+
+    def _marker_cost(self, start):
+        if not start or not self.fold_dropped:
+            return 0
+        return self._turn_cost(self.fold_marker(start))
+
+    def window_start(self, turns, budget=None, start=0):
+        # Index of the oldest turn to keep. Pass the previous start back in so only
+        # the kept turns are counted and the window doesn't move while it still fits.
+        budget = self.max_tokens if budget is None else min(budget, self.max_tokens)
+        if budget <= 0:
+            return len(turns)
+
+        start = min(start, len(turns))
+        used = sum(self._turn_cost(turn) for turn in turns[start:])
+        if used + self._marker_cost(start) <= budget:
+            return start
+
+        target = budget * self.low_water
+        while start < len(turns) and used + self._marker_cost(start) > target:
+            used -= self._turn_cost(turns[start])
+            start += 1
+        return start
+
+    def render(self, turns, start):
+        window = list(turns[start:])
+        if start and self.fold_dropped:
+            window.insert(0, self.fold_marker(start))
+        return window
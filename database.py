@@ -2,18 +2,158 @@
 
 import sqlite3
 import json
+import threading
+from contextlib import contextmanager
 from pathlib import Path
+import metrics
+
+SCHEMA_VERSION = 4
+# Sessions of a deleted profile move to these
+DEFAULT_PROFILES = {'chatbot': 'Default', 'user': 'Guest'}
+
+# Prefixes of the plain-text history lines AIChatbot keeps in memory
+ROLE_PREFIXES = [(":User  ", "user"), ("User: ", "user"), ("Chatbot: ", "assistant")]
+
+def normalize_messages(messages):
+    # Accepts history lines, (user, chatbot) pairs from the UI or role/content dicts
+    rows = []
+    for message in messages:
+        if isinstance(message, dict):
+            rows.append((message["role"], message["content"]))
+        elif isinstance(message, (list, tuple)):
+            if message[0] is not None:
+                rows.append(("user", message[0]))
+            if len(message) > 1 and message[1] is not None:
+                rows.append(("assistant", message[1]))
+        else:
+            for prefix, role in ROLE_PREFIXES:
+                if message.startswith(prefix):
+                    rows.append((role, message[len(prefix):]))
+                    break
+            else:
+                rows.append(("system", message))
+    return rows
 
 class DatabaseManager:
-    def __init__(self):
-        self.db_path = Path("data/chat_data.db")
+    # Schema setup runs once per database file per process
+    _initialized = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, db_path="data/chat_data.db", busy_timeout=5.0):
+        self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(self.db_path)
-        self._init_tables()
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        with DatabaseManager._init_lock:
+            key = str(self.db_path.resolve())
+            if key not in DatabaseManager._initialized:
+                self._init_tables()
+                DatabaseManager._initialized.add(key)
+
+        cursor = self.conn.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'
+        ''')
+        self.fts_enabled = cursor.fetchone() is not None
+
+    @property
+    def conn(self):
+        # One connection per thread: sqlite3 connections must not be shared across
+        # Gradio worker threads, and each keeps its own prepared-statement cache
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            isolation_level=None,  # transactions are explicit, see transaction()
+            check_same_thread=False,
+            cached_statements=256
+        )
+        # WAL lets readers run alongside a writer; NORMAL only fsyncs at checkpoints
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        # Off by default in SQLite; chat_messages relies on ON DELETE CASCADE
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn
+        if conn.in_transaction:
+            # Nested calls join the outer transaction
+            yield conn.cursor()
+            return
+
+        # IMMEDIATE takes the write lock up front, so concurrent writers wait on
+        # busy_timeout instead of failing halfway through with "database is locked"
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
 
     def _init_tables(self):
-        cursor = self.conn.cursor()
-        
+        with self.transaction() as cursor:
+            self._create_tables(cursor)
+            self._migrate(cursor)
+            self._create_search_index(cursor)
+
+    def _create_search_index(self, cursor):
+        # Full-text index over chat_messages.content, kept in sync by triggers
+        cursor.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'
+        ''')
+        exists = cursor.fetchone() is not None
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+                    content,
+                    content = 'chat_messages',
+                    content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5; search_messages falls back to LIKE
+            return
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF content ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+                INSERT INTO chat_messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        if not exists:
+            # Index messages stored before the index existed
+            cursor.execute('''
+                INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')
+            ''')
+
+    def _create_tables(self, cursor):
         # Chatbot Profiles Table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS chatbot_profiles (
@@ -50,9 +190,118 @@ class DatabaseManager:
                 FOREIGN KEY(user_profile_id) REFERENCES user_profiles(id)
             )
         ''')
-        
-        self.conn.commit()
 
+        # Chat Messages Table (one row per message, appended per turn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(session_id, seq),
+                FOREIGN KEY(session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+            )
+        ''')
+
+        # Session browser: recency order, keyset pagination and name type-ahead
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at
+            ON chat_sessions(updated_at DESC, id DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_name_nocase
+            ON chat_sessions(session_name COLLATE NOCASE)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_chatbot_profile
+            ON chat_sessions(chatbot_profile_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_profile
+            ON chat_sessions(user_profile_id)
+        ''')
+
+        # Conversations of browser clients that were idle long enough to leave memory (chat_state.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS client_states (
+                token TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Generated Images Table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generated_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                prompt TEXT NOT NULL,
+                negative_prompt TEXT,
+                model TEXT NOT NULL,
+                parameters TEXT NOT NULL,
+                path TEXT NOT NULL,
+                content_key TEXT,
+                thumbnail_path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    def _migrate(self, cursor):
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+
+        if version < 1:
+            # Move JSON message blobs into chat_messages
+            cursor.execute('''
+                SELECT id, messages FROM chat_sessions
+                WHERE messages != '[]'
+            ''')
+            for session_id, blob in cursor.fetchall():
+                rows = normalize_messages(json.loads(blob))
+                cursor.execute('DELETE FROM chat_messages WHERE session_id = ?', (session_id,))
+                cursor.executemany('''
+                    INSERT INTO chat_messages (session_id, seq, role, content)
+                    VALUES (?, ?, ?, ?)
+                ''', [(session_id, seq, role, content) for seq, (role, content) in enumerate(rows)])
+            cursor.execute("UPDATE chat_sessions SET messages = '[]'")
+
+        if version < 2:
+            # Content-addressed image cache; older rows keep a NULL key
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(generated_images)')]
+            if 'content_key' not in columns:
+                cursor.execute('ALTER TABLE generated_images ADD COLUMN content_key TEXT')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_generated_images_content_key
+                ON generated_images(content_key)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_generated_images_path
+                ON generated_images(path)
+            ''')
+
+        if version < 3:
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(generated_images)')]
+            if 'thumbnail_path' not in columns:
+                cursor.execute('ALTER TABLE generated_images ADD COLUMN thumbnail_path TEXT')
+
+        if version < 4:
+            # Foreign keys weren't enforced before; point sessions of deleted profiles at the defaults
+            for entity_type in DEFAULT_PROFILES:
+                dangling = cursor.execute(f'''
+                    SELECT 1 FROM chat_sessions
+                    WHERE {entity_type}_profile_id NOT IN (SELECT id FROM {entity_type}_profiles)
+                    LIMIT 1
+                ''').fetchone()
+                if dangling:
+                    default_id = self._default_profile_id(cursor, entity_type)
+                    cursor.execute(f'''
+                        UPDATE chat_sessions SET {entity_type}_profile_id = ?
+                        WHERE {entity_type}_profile_id NOT IN (SELECT id FROM {entity_type}_profiles)
+                    ''', (default_id,))
+
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    @metrics.timed("db_query", query="get_profiles")
     def get_profiles(self, entity_type):
         cursor = self.conn.cursor()
         cursor.execute(f'''
@@ -62,51 +311,159 @@ class DatabaseManager:
         ''')
         return {row[0]: json.loads(row[1]) for row in cursor.fetchall()}
 
-    def save_profile(self, entity_type, name, data):
+    @metrics.timed("db_query", query="get_profile")
+    def get_profile(self, entity_type, name):
         cursor = self.conn.cursor()
         cursor.execute(f'''
-            INSERT INTO {entity_type}_profiles (name, data, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(name) DO UPDATE SET
-                data = excluded.data,
-                updated_at = CURRENT_TIMESTAMP
-        ''', (name, json.dumps(data)))
-        self.conn.commit()
+            SELECT data FROM {entity_type}_profiles WHERE name = ?
+        ''', (name,))
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
 
-    def delete_profile(self, entity_type, name):
+    @metrics.timed("db_query", query="get_profile_names")
+    def get_profile_names(self, entity_type):
         cursor = self.conn.cursor()
         cursor.execute(f'''
-            DELETE FROM {entity_type}_profiles 
-            WHERE name = ?
+            SELECT name 
+            FROM {entity_type}_profiles 
+            ORDER BY updated_at DESC
+        ''')
+        return [row[0] for row in cursor.fetchall()]
+
+    @metrics.timed("db_query", query="save_profile")
+    def save_profile(self, entity_type, name, data):
+        with self.transaction() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {entity_type}_profiles (name, data, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(name) DO UPDATE SET
+                    data = excluded.data,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (name, json.dumps(data)))
+
+    @metrics.timed("db_query", query="delete_profile")
+    def delete_profile(self, entity_type, name):
+        with self.transaction() as cursor:
+            row = cursor.execute(f'''
+                SELECT id FROM {entity_type}_profiles WHERE name = ?
+            ''', (name,)).fetchone()
+            if row is None:
+                return
+            # Keep the profile's chat sessions, under the default profile
+            cursor.execute(f'''
+                UPDATE chat_sessions SET {entity_type}_profile_id = ?
+                WHERE {entity_type}_profile_id = ?
+            ''', (self._default_profile_id(cursor, entity_type), row[0]))
+            cursor.execute(f'''
+                DELETE FROM {entity_type}_profiles 
+                WHERE id = ?
+            ''', (row[0],))
+
+    def _default_profile_id(self, cursor, entity_type):
+        name = DEFAULT_PROFILES[entity_type]
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO {entity_type}_profiles (name, data) VALUES (?, '{{}}')
         ''', (name,))
-        self.conn.commit()
+        return cursor.execute(f'''
+            SELECT id FROM {entity_type}_profiles WHERE name = ?
+        ''', (name,)).fetchone()[0]
 
-    def save_chat_session(self, session_name, chatbot_profile, user_profile, messages):
-        cursor = self.conn.cursor()
-        
-        # Get profile IDs
-        cursor.execute('''
-            SELECT id FROM chatbot_profiles WHERE name = ?
-        ''', (chatbot_profile,))
-        chatbot_id = cursor.fetchone()[0]
-        
+    @metrics.timed("db_query", query="create_chat_session")
+    def create_chat_session(self, session_name, chatbot_profile, user_profile):
+        with self.transaction() as cursor:
+            # Sessions can be started before the default profiles were ever saved
+            for entity_type, name in (('chatbot', chatbot_profile), ('user', user_profile)):
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO {entity_type}_profiles (name, data) VALUES (?, '{{}}')
+                ''', (name,))
+
+            # Get profile IDs
+            cursor.execute('''
+                SELECT id FROM chatbot_profiles WHERE name = ?
+            ''', (chatbot_profile,))
+            chatbot_id = cursor.fetchone()[0]
+
+            cursor.execute('''
+                SELECT id FROM user_profiles WHERE name = ?
+            ''', (user_profile,))
+            user_id = cursor.fetchone()[0]
+
+            # Save session (messages live in chat_messages; the legacy column stays empty)
+            cursor.execute('''
+                INSERT INTO chat_sessions 
+                (session_name, chatbot_profile_id, user_profile_id, messages, updated_at)
+                VALUES (?, ?, ?, '[]', CURRENT_TIMESTAMP)
+                ON CONFLICT(session_name) DO UPDATE SET
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (session_name, chatbot_id, user_id))
+
+            cursor.execute('''
+                SELECT id FROM chat_sessions WHERE session_name = ?
+            ''', (session_name,))
+            session_id = cursor.fetchone()[0]
+
+        return session_id
+
+    def _append_rows(self, cursor, session_id, rows, start_seq):
+        cursor.executemany('''
+            INSERT INTO chat_messages (session_id, seq, role, content)
+            VALUES (?, ?, ?, ?)
+        ''', [
+            (session_id, start_seq + i, role, content)
+            for i, (role, content) in enumerate(rows)
+        ])
         cursor.execute('''
-            SELECT id FROM user_profiles WHERE name = ?
-        ''', (user_profile,))
-        user_id = cursor.fetchone()[0]
-        
-        # Save session
-        cursor.execute('''
-            INSERT INTO chat_sessions 
-            (session_name, chatbot_profile_id, user_profile_id, messages, updated_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(session_name) DO UPDATE SET
-                messages = excluded.messages,
-                updated_at = CURRENT_TIMESTAMP
-        ''', (session_name, chatbot_id, user_id, json.dumps(messages)))
-        
-        self.conn.commit()
+            UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (session_id,))
+
+    @metrics.timed("db_query", query="append_chat_messages")
+    def append_chat_messages(self, session_id, messages):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT COALESCE(MAX(seq) + 1, 0) FROM chat_messages WHERE session_id = ?
+            ''', (session_id,))
+            next_seq = cursor.fetchone()[0]
+            self._append_rows(cursor, session_id, normalize_messages(messages), next_seq)
+
+    @metrics.timed("db_query", query="save_chat_session")
+    def save_chat_session(self, session_name, chatbot_profile, user_profile, messages, replace_session_id=None):
+        rows = normalize_messages(messages)
+        with self.transaction() as cursor:
+            if replace_session_id is not None:
+                # Saved under the new name in place of that session (e.g. an autosaved one), not beside it
+                taken = cursor.execute('''
+                    SELECT id FROM chat_sessions WHERE session_name = ?
+                ''', (session_name,)).fetchone()
+                if taken is None:
+                    cursor.execute('''
+                        UPDATE chat_sessions SET session_name = ? WHERE id = ?
+                    ''', (session_name, replace_session_id))
+                elif taken[0] != replace_session_id:
+                    # The named session is overwritten; this one's messages go by ON DELETE CASCADE
+                    cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (replace_session_id,))
 
+            session_id = self.create_chat_session(session_name, chatbot_profile, user_profile)
+
+            # Keep the stored messages that still match, rewrite from the first difference on
+            cursor.execute('''
+                SELECT role, content FROM chat_messages
+                WHERE session_id = ? ORDER BY seq
+            ''', (session_id,))
+            stored = cursor.fetchall()
+            common = 0
+            for old, new in zip(stored, rows):
+                if tuple(old) != new:
+                    break
+                common += 1
+            if common < len(stored):
+                cursor.execute('''
+                    DELETE FROM chat_messages WHERE session_id = ? AND seq >= ?
+                ''', (session_id, common))
+            self._append_rows(cursor, session_id, rows[common:], common)
+
+        return session_id
+
+    @metrics.timed("db_query", query="load_chat_sessions")
     def load_chat_sessions(self):
         cursor = self.conn.cursor()
         cursor.execute('''
@@ -120,18 +477,236 @@ class DatabaseManager:
             FROM chat_sessions cs
             JOIN chatbot_profiles cp ON cs.chatbot_profile_id = cp.id
             JOIN user_profiles up ON cs.user_profile_id = up.id
-            ORDER BY cs.updated_at DESC
+            ORDER BY cs.updated_at DESC, cs.id DESC
         ''')
         return cursor.fetchall()
 
-    def load_chat_messages(self, session_id):
+    @metrics.timed("db_query", query="get_session")
+    def get_session(self, session_id):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT 
+                cs.id,
+                cs.session_name,
+                cp.name AS chatbot_profile,
+                up.name AS user_profile,
+                cs.created_at,
+                cs.updated_at
+            FROM chat_sessions cs
+            JOIN chatbot_profiles cp ON cs.chatbot_profile_id = cp.id
+            JOIN user_profiles up ON cs.user_profile_id = up.id
+            WHERE cs.id = ?
+        ''', (session_id,))
+        return cursor.fetchone()
+
+    @metrics.timed("db_query", query="list_chat_sessions")
+    def list_chat_sessions(self, limit=50, after=None, query=None):
+        # One page in load_chat_sessions order. after is the (updated_at, id) of the
+        # last row of the previous page; query matches session names by prefix.
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append('(cs.updated_at, cs.id) < (?, ?)')
+            params.extend(after)
+        if query:
+            conditions.append('cs.session_name >= ? COLLATE NOCASE AND cs.session_name < ? COLLATE NOCASE')
+            params.extend([query, query + '\U0010ffff'])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT 
+                cs.id,
+                cs.session_name,
+                cp.name AS chatbot_profile,
+                up.name AS user_profile,
+                cs.created_at,
+                cs.updated_at
+            FROM chat_sessions cs
+            JOIN chatbot_profiles cp ON cs.chatbot_profile_id = cp.id
+            JOIN user_profiles up ON cs.user_profile_id = up.id
+            {where}
+            ORDER BY cs.updated_at DESC, cs.id DESC
+            LIMIT ?
+        ''', (*params, limit))
+        return cursor.fetchall()
+
+    @metrics.timed("db_query", query="load_chat_messages")
+    def load_chat_messages(self, session_id, limit=None, before_seq=None):
+        # Whole session by default; with limit, the newest messages before before_seq
+        cursor = self.conn.cursor()
+        if limit is None:
+            cursor.execute('''
+                SELECT seq, role, content FROM chat_messages
+                WHERE session_id = ? ORDER BY seq
+            ''', (session_id,))
+            rows = cursor.fetchall()
+        else:
+            if before_seq is None:
+                before_seq = self.count_chat_messages(session_id)
+            cursor.execute('''
+                SELECT seq, role, content FROM chat_messages
+                WHERE session_id = ? AND seq < ?
+                ORDER BY seq DESC LIMIT ?
+            ''', (session_id, before_seq, limit))
+            rows = cursor.fetchall()[::-1]
+        return [{"seq": seq, "role": role, "content": content} for seq, role, content in rows]
+
+    @staticmethod
+    def _fts_query(text):
+        # Quote every term so user input can't form FTS syntax; the last term
+        # also matches as a prefix for search-as-you-type
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if terms:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    @metrics.timed("db_query", query="search_messages")
+    def search_messages(self, text, limit=20):
+        if not text.strip():
+            return []
+        cursor = self.conn.cursor()
+        if self.fts_enabled:
+            cursor.execute('''
+                SELECT 
+                    m.session_id,
+                    cs.session_name,
+                    m.seq,
+                    m.role,
+                    snippet(chat_messages_fts, 0, '[', ']', '…', 12) AS snippet,
+                    bm25(chat_messages_fts) AS rank
+                FROM chat_messages_fts
+                JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+                JOIN chat_sessions cs ON cs.id = m.session_id
+                WHERE chat_messages_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (self._fts_query(text), limit))
+        else:
+            cursor.execute('''
+                SELECT 
+                    m.session_id,
+                    cs.session_name,
+                    m.seq,
+                    m.role,
+                    substr(m.content, 1, 120) AS snippet,
+                    0 AS rank
+                FROM chat_messages m
+                JOIN chat_sessions cs ON cs.id = m.session_id
+                WHERE m.content LIKE ?
+                ORDER BY m.id DESC
+                LIMIT ?
+            ''', (f"%{text.strip()}%", limit))
+        return [
+            {
+                "session_id": row[0],
+                "session_name": row[1],
+                "seq": row[2],
+                "role": row[3],
+                "snippet": row[4],
+                "rank": row[5]
+            }
+            for row in cursor.fetchall()
+        ]
+
+    @metrics.timed("db_query", query="count_chat_messages")
+    def count_chat_messages(self, session_id):
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT messages FROM chat_sessions WHERE id = ?
+            SELECT COALESCE(MAX(seq) + 1, 0) FROM chat_messages WHERE session_id = ?
         ''', (session_id,))
-        result = cursor.fetchone()
-        return json.loads(result[0]) if result else []
+        return cursor.fetchone()[0]
+
+    @metrics.timed("db_query", query="save_client_states")
+    def save_client_states(self, states):
+        # states: (token, data) pairs, written in one transaction
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO client_states (token, data, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(token) DO UPDATE SET
+                    data = excluded.data,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', [(token, json.dumps(data)) for token, data in states])
+
+    @metrics.timed("db_query", query="take_client_state")
+    def take_client_state(self, token):
+        # Removes and returns a spilled client state; it lives in memory again from here
+        with self.transaction() as cursor:
+            cursor.execute('''
+                SELECT data FROM client_states WHERE token = ?
+            ''', (token,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('DELETE FROM client_states WHERE token = ?', (token,))
+        return json.loads(row[0])
+
+    @metrics.timed("db_query", query="prune_client_states")
+    def prune_client_states(self, max_age_days=30):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM client_states WHERE updated_at < datetime('now', ?)
+            ''', (f"-{int(max_age_days)} days",))
+            return cursor.rowcount
+
+    @metrics.timed("db_query", query="save_image_metadata")
+    def save_image_metadata(self, prompt, negative_prompt, model, parameters, path, content_key=None,
+                            thumbnail_path=None):
+        with self.transaction() as cursor:
+            if content_key is not None:
+                # A re-render of an evicted or lost image replaces its old row
+                cursor.execute('DELETE FROM generated_images WHERE content_key = ?', (content_key,))
+            cursor.execute('''
+                INSERT INTO generated_images 
+                (prompt, negative_prompt, model, parameters, path, content_key, thumbnail_path, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (prompt, negative_prompt, model, json.dumps(parameters), path, content_key, thumbnail_path))
+            return cursor.lastrowid
+
+    @metrics.timed("db_query", query="find_image")
+    def find_image(self, content_key):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, prompt, negative_prompt, model, parameters, path, created_at
+            FROM generated_images
+            WHERE content_key = ?
+        ''', (content_key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "prompt": row[1],
+            "negative_prompt": row[2],
+            "model": row[3],
+            "parameters": json.loads(row[4]),
+            "path": row[5],
+            "created_at": row[6]
+        }
+
+    @metrics.timed("db_query", query="delete_images")
+    def delete_images(self, paths):
+        if not paths:
+            return
+        with self.transaction() as cursor:
+            cursor.executemany('DELETE FROM generated_images WHERE path = ?', [(p,) for p in paths])
+
+    @metrics.timed("db_query", query="get_generation_history")
+    def get_generation_history(self, limit=10):
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT prompt, model, path, created_at, thumbnail_path
+            FROM generated_images 
+            ORDER BY created_at DESC 
+            LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
 
     def close(self):
-        self.conn.close()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
@@ -0,0 +1,90 @@
+# /execution_profile.py
+import os
+from dataclasses import dataclass, asdict, replace
+from typing import Optional
+
+@dataclass
+class ExecutionProfile:
+    name: str
+    device: str
+    dtype: str  # torch dtype name, resolved when torch is imported
+    channels_last: bool = False
+    attention_slicing: bool = False
+    num_threads: Optional[int] = None
+    compile: bool = False
+
+    def torch_dtype(self):
+        import torch
+
+        return getattr(torch, self.dtype)
+
+    def configure_torch(self):
+        import torch
+
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+    def apply(self, pipe):
+        # Post-load tuning of a diffusers pipeline
+        import torch
+
+        if self.channels_last:
+            for component in ("unet", "vae"):
+                module = getattr(pipe, component, None)
+                if module is not None:
+                    module.to(memory_format=torch.channels_last)
+        if self.attention_slicing:
+            pipe.enable_attention_slicing()
+        if self.compile and hasattr(torch, "compile"):
+            pipe.unet = torch.compile(pipe.unet)
+        return pipe
+
+    def as_metadata(self):
+        return asdict(self)
+
+PROFILES = {
+    "cuda-fp16": ExecutionProfile("cuda-fp16", "cuda", "float16"),
+    # Half precision is slow or unsupported on most CPUs; fp32 is the safe default
+    "cpu-fp32": ExecutionProfile("cpu-fp32", "cpu", "float32", channels_last=True, attention_slicing=True),
+    # Only worth it on CPUs with native bf16 (AVX512-BF16 / AMX)
+    "cpu-bf16": ExecutionProfile("cpu-bf16", "cpu", "bfloat16", channels_last=True, attention_slicing=True),
+}
+
+def cpu_flags():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+def cpu_threads():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def detect_profile(name=None, num_threads=None, compile=None):
+    # name: a PROFILES key or "auto"; defaults to $AI_WAIFU_IMAGE_PROFILE
+    name = name or os.environ.get("AI_WAIFU_IMAGE_PROFILE", "auto")
+    if compile is None:
+        compile = os.environ.get("AI_WAIFU_IMAGE_COMPILE", "") == "1"
+
+    if name == "auto":
+        import torch
+
+        if torch.cuda.is_available():
+            name = "cuda-fp16"
+        elif {"avx512_bf16", "amx_bf16"} & cpu_flags():
+            name = "cpu-bf16"
+        else:
+            name = "cpu-fp32"
+    if name not in PROFILES:
+        raise ValueError(f"Unknown execution profile: {name}")
+
+    profile = replace(PROFILES[name], compile=compile)
+    if profile.device == "cpu":
+        profile.num_threads = num_threads or cpu_threads()
+    return profile
@@ -0,0 +1,135 @@
+# /image_cache.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+MB = 1024 * 1024
+# Bump when anything that changes the rendered pixels stops being part of the key
+KEY_VERSION = 1
+
+
+def content_key(prompt, negative_prompt, model_name, steps, cfg_scale, width, height, seed,
+                device="", dtype=""):
+    # Same inputs on the same kind of device and dtype render the same image
+    params = {
+        "v": KEY_VERSION,
+        "prompt": prompt,
+        "negative_prompt": negative_prompt or "",
+        "model": model_name,
+        "steps": int(steps),
+        "cfg_scale": float(cfg_scale),
+        "width": int(width),
+        "height": int(height),
+        "seed": int(seed),
+        "device": device,
+        "dtype": dtype
+    }
+    blob = json.dumps(params, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, db, output_dir="generated_images", max_bytes=2048 * MB):
+        self.db = db
+        self.output_dir = output_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._files = {}  # path -> (size with its thumbnail, last used)
+        self.thumbnail_dir = os.path.join(output_dir, "thumbnails")
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        for entry in os.scandir(output_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                self._files[entry.path] = (stat.st_size + self._thumbnail_size(entry.path), stat.st_mtime)
+        # Thumbnails whose image is gone would otherwise sit outside the bound
+        thumbnails = {self.thumbnail_path(path) for path in self._files}
+        for entry in os.scandir(self.thumbnail_dir):
+            if entry.is_file() and entry.path not in thumbnails:
+                os.remove(entry.path)
+        self.size = sum(size for size, _ in self._files.values())
+
+    def path_for(self, key, ext="png"):
+        return os.path.join(self.output_dir, f"{key}.{ext}")
+
+    def thumbnail_path(self, path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.thumbnail_dir, f"{stem}.jpg")
+
+    def _thumbnail_size(self, path):
+        try:
+            return os.stat(self.thumbnail_path(path)).st_size
+        except FileNotFoundError:
+            return 0
+
+    def lookup(self, key):
+        # (image, row) for a previous render with this key, or None
+        from PIL import Image
+
+        row = self.db.find_image(key)
+        if row is None or not os.path.exists(row["path"]):
+            if row is not None:
+                # File was removed behind our back; forget the stale row
+                self.db.delete_images([row["path"]])
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with Image.open(row["path"]) as image:
+            image.load()
+        # mtime doubles as the last-used time, so the LRU order survives restarts
+        now = time.time()
+        try:
+            os.utime(row["path"], (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if row["path"] in self._files:
+                self._files[row["path"]] = (self._files[row["path"]][0], now)
+        return image, row
+
+    def add(self, path):
+        # Account for a file just written into the cache directory, then enforce the size bound
+        stat = os.stat(path)
+        size = stat.st_size + self._thumbnail_size(path)
+        with self._lock:
+            old_size, _ = self._files.get(path, (0, 0))
+            self._files[path] = (size, stat.st_mtime)
+            self.size += size - old_size
+        self.evict()
+
+    def evict(self):
+        # Least recently used files go first, along with their history rows
+        with self._lock:
+            if self.size <= self.max_bytes:
+                return
+            victims = []
+            for path, (size, _) in sorted(self._files.items(), key=lambda item: item[1][1]):
+                if self.size <= self.max_bytes:
+                    break
+                victims.append(path)
+                self.size -= size
+                del self._files[path]
+
+        for path in victims:
+            for victim in (path, self.thumbnail_path(path)):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+        self.db.delete_images(victims)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "size_mb": self.size / MB,
+                "max_mb": self.max_bytes / MB,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -1,102 +1,425 @@
 # /image_generator.py
-import torch
-from diffusers import StableDiffusionPipeline, EulerAncestralDiscreteScheduler
-from PIL import Image
-import os
-from datetime import datetime
+import gc
+import inspect
+import sys
+import threading
+import time
 from database import DatabaseManager
-import json
+import metrics
+from execution_profile import detect_profile
+from image_cache import ImageCache, content_key, MB
+from image_queue import ImageJob, ImageJobQueue, RenderAborted
+from latent_preview import latents_to_image
+from image_writer import ImageWriter
+from prompt_cache import PromptEmbeddingCache
+
+# Components that SD-1.x pipelines can share when their weights match
+SHARED_COMPONENTS = ("tokenizer", "text_encoder", "vae")
+# Parameters of an SD-1.x pipeline (UNet, CLIP text encoder, VAE), to reserve budget before a load
+PIPELINE_PARAMS = 1_070_000_000
 
 class ImageGenerator:
-    def __init__(self):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.models = {
-            "stable_diffusion": self._load_sd_model(),
-            "waifu_diffusion": self._load_wd_model()
+    def __init__(self, background=False, db=None, max_batch=4, preload=(), idle_timeout=None,
+                 profile=None, cache_mb=2048, embedding_cache_size=256, image_format="png",
+                 model_loader=None):
+        self.device = None
+        # With a ModelLoader, pipelines count against its memory budget and can be evicted by it
+        self.model_loader = model_loader
+        # Execution profile name ("auto", "cuda-fp16", "cpu-fp32", "cpu-bf16"); resolved on load
+        self.profile_name = profile
+        self.profile = None
+        self.models = {}
+        self.loaders = {
+            "stable_diffusion": self._load_sd_model,
+            "waifu_diffusion": self._load_wd_model
         }
         self.output_dir = "generated_images"
-        self.db = DatabaseManager()
-        os.makedirs(self.output_dir, exist_ok=True)
+        self.db = db or DatabaseManager()
+        # Finished renders are keyed by their parameters; the directory is kept under cache_mb
+        self.cache = ImageCache(self.db, self.output_dir, cache_mb * MB)
+        # Files, thumbnails and metadata rows are written after the image is returned
+        self.writer = ImageWriter(self.db, self.cache, image_format)
+        # Text-encoder outputs per (pipeline, prompt); negative prompts repeat almost always
+        self.embeddings = PromptEmbeddingCache(embedding_cache_size)
+        # Worker queue is started on the first submit()
+        self.max_batch = max_batch
+        self.queue = None
+        self._queue_lock = threading.Lock()
+
+        # Pipelines load on first use; an idle one is dropped after idle_timeout seconds
+        self.preload = tuple(preload)
+        self.idle_timeout = idle_timeout
+        self.last_used = {}
+        self.in_use = {}
+        self.load_times = {}
+        self.shared = {}
+        self._models_lock = threading.RLock()
+        metrics.gauge("image_pipelines_loaded", "Diffusion pipelines resident", fn=lambda: len(self.models))
+
+        self.ready = threading.Event()
+        self.load_error = None
+        self.load_seconds = None
+        if background:
+            threading.Thread(target=self._warm_up, name="image-warm-up", daemon=True).start()
+        else:
+            self.load_models()
+        if idle_timeout:
+            threading.Thread(target=self._reap_idle, name="image-idle-reaper", daemon=True).start()
+
+    def load_models(self, names=None):
+        # torch/diffusers are only imported once pipelines are actually needed
+        started = time.perf_counter()
+        self.profile = detect_profile(self.profile_name)
+        self.profile.configure_torch()
+        self.device = self.profile.device
+        for name in (self.preload if names is None else names):
+            self.get_pipeline(name)
+        self.load_seconds = time.perf_counter() - started
+        self.ready.set()
+
+    def _warm_up(self):
+        try:
+            self.load_models()
+        except Exception as e:
+            self.load_error = e
+            self.ready.set()
+
+    def wait_until_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise TimeoutError("Image models are still loading.")
+        if self.load_error:
+            raise RuntimeError(f"Image models failed to load: {self.load_error}")
+
+    def is_loaded(self, model_name):
+        return model_name in self.models
+
+    def get_pipeline(self, model_name):
+        # ModelLoader is never called with _models_lock held: its evictions call back into
+        # unload_pipeline, which takes that lock
+        if model_name not in self.loaders:
+            raise ValueError(f"Invalid model name: {model_name}")
+        with self._models_lock:
+            pipe = self.models.get(model_name)
+            if pipe is not None:
+                self.last_used[model_name] = time.monotonic()
+        if pipe is not None:
+            if self.model_loader:
+                self.model_loader.touch(self._budget_key(model_name))
+            return pipe
+
+        self._reserve(model_name, self._estimate_pipeline())
+        try:
+            with self._models_lock:
+                if model_name not in self.models:
+                    started = time.perf_counter()
+                    with metrics.span("image_pipeline_load", model=model_name):
+                        pipe = self.loaders[model_name]()
+                    self._share_components(model_name, pipe)
+                    self.models[model_name] = pipe
+                    self.load_times[model_name] = time.perf_counter() - started
+                self.last_used[model_name] = time.monotonic()
+                pipe = self.models[model_name]
+                size = self._measure_pipeline(model_name)
+        except BaseException:
+            if self.model_loader:
+                self.model_loader.unload_model(self._budget_key(model_name))
+            raise
+        self._reserve(model_name, size)
+        return pipe
+
+    @staticmethod
+    def _budget_key(model_name):
+        return f"image:{model_name}"
+
+    def _estimate_pipeline(self):
+        dtype = self.profile.dtype if self.profile else "float32"
+        return PIPELINE_PARAMS * (4 if dtype == "float32" else 2)
+
+    def _measure_pipeline(self, model_name):
+        # Bytes only this pipeline holds; components shared with another resident one don't
+        # come back when it is unloaded. Falls back to the estimate for non-torch pipelines.
+        pipe = self.models[model_name]
+        others = {
+            id(getattr(other, component, None))
+            for name, other in self.models.items() if name != model_name
+            for component in SHARED_COMPONENTS
+        }
+        size = 0
+        for component in getattr(pipe, "components", {}).values():
+            if id(component) in others or not hasattr(component, "parameters"):
+                continue
+            size += sum(p.numel() * p.element_size() for p in component.parameters())
+        return size or self._estimate_pipeline()
+
+    def _reserve(self, model_name, nbytes):
+        if self.model_loader is None:
+            return
+        self.model_loader.reserve(
+            self._budget_key(model_name),
+            nbytes,
+            unload=lambda: self.unload_pipeline(model_name),
+            busy=lambda: self.in_use.get(model_name, 0) > 0
+        )
+
+    def _acquire(self, model_name):
+        while True:
+            pipe = self.get_pipeline(model_name)
+            with self._models_lock:
+                # It may have been evicted between loading and taking the lock
+                if self.models.get(model_name) is pipe:
+                    self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+                    return pipe
+
+    def _release(self, model_name):
+        with self._models_lock:
+            self.in_use[model_name] -= 1
+            self.last_used[model_name] = time.monotonic()
+
+    @staticmethod
+    def _same_component(a, b):
+        if a is b:
+            return True
+        if type(a) is not type(b):
+            return False
+        if hasattr(a, "get_vocab"):
+            return a.get_vocab() == b.get_vocab()
+        if not hasattr(a, "state_dict"):
+            return False
+
+        import torch
+
+        left, right = a.state_dict(), b.state_dict()
+        if left.keys() != right.keys():
+            return False
+        return all(
+            left[k].shape == right[k].shape and left[k].dtype == right[k].dtype
+            and torch.equal(left[k], right[k])
+            for k in left
+        )
+
+    def _share_components(self, model_name, pipe):
+        # Swap in an already-resident copy of any component with identical weights,
+        # so the duplicate is freed and both pipelines use one set of tensors
+        for component in SHARED_COMPONENTS:
+            mine = getattr(pipe, component, None)
+            if mine is None:
+                continue
+            for other_name, other in self.models.items():
+                theirs = getattr(other, component, None)
+                if theirs is not None and self._same_component(mine, theirs):
+                    pipe.register_modules(**{component: theirs})
+                    self.shared.setdefault(component, set()).update((model_name, other_name))
+                    break
+
+    def unload_pipeline(self, model_name):
+        with self._models_lock:
+            if model_name not in self.models:
+                return False
+            if self.in_use.get(model_name):
+                raise RuntimeError(f"Pipeline {model_name} is in use and cannot be unloaded")
+            del self.models[model_name]
+            self.last_used.pop(model_name, None)
+            self.embeddings.drop(model_name)
+            for users in self.shared.values():
+                users.discard(model_name)
+
+        if self.model_loader:
+            # A no-op when the loader itself is evicting this pipeline
+            self.model_loader.unload_model(self._budget_key(model_name))
+        gc.collect()
+        # Only touch torch if it was already imported by a load
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def _reap_idle(self):
+        interval = max(1.0, min(60.0, self.idle_timeout / 2))
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._models_lock:
+                idle = [
+                    name for name, used in self.last_used.items()
+                    if not self.in_use.get(name) and now - used >= self.idle_timeout
+                ]
+            for name in idle:
+                try:
+                    self.unload_pipeline(name)
+                except RuntimeError:
+                    pass
 
     def _load_sd_model(self):
-        return StableDiffusionPipeline.from_pretrained(
+        from diffusers import StableDiffusionPipeline
+
+        pipe = StableDiffusionPipeline.from_pretrained(
             "CompVis/stable-diffusion-v1-4",
-            torch_dtype=torch.float16,
+            torch_dtype=self.profile.torch_dtype(),
             safety_checker=None,
             requires_safety_checker=False
         ).to(self.device)
+        return self.profile.apply(pipe)
 
     def _load_wd_model(self):
+        from diffusers import StableDiffusionPipeline, EulerAncestralDiscreteScheduler
+
         pipe = StableDiffusionPipeline.from_pretrained(
             "hakurei/waifu-diffusion",
-            torch_dtype=torch.float16
+            torch_dtype=self.profile.torch_dtype()
         )
         pipe.scheduler = EulerAncestralDiscreteScheduler.from_config(pipe.scheduler.config)
-        return pipe.to(self.device)
+        return self.profile.apply(pipe.to(self.device))
 
-    def generate_image(self, prompt, negative_prompt="", model_name="stable_diffusion", 
-                      steps=30, cfg_scale=7.5, width=512, height=512, seed=None):
-        # Validate input
-        if model_name not in self.models:
-            raise ValueError(f"Invalid model name: {model_name}")
-        if steps < 1 or steps > 100:
+    def _validate(self, job):
+        if job.model_name not in self.loaders:
+            raise ValueError(f"Invalid model name: {job.model_name}")
+        if job.steps < 1 or job.steps > 100:
             raise ValueError("Steps must be between 1-100")
-        
-        # Set up generator
-        generator = torch.Generator(self.device)
-        if seed is None:
-            seed = generator.seed()
-        generator = generator.manual_seed(seed)
-        
-        # Generate image
-        pipe = self.models[model_name]
-        image = pipe(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=int(steps),
-            guidance_scale=cfg_scale,
-            width=width,
-            height=height,
-            generator=generator
-        ).images[0]
-        
-        # Save and log
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"{timestamp}_{hash(prompt) % 1000}.png"
-        path = os.path.join(self.output_dir, filename)
-        image.save(path)
-        
-        # Store metadata
-        self.db.conn.cursor().execute('''
-            INSERT INTO generated_images 
-            (prompt, negative_prompt, model, parameters, path, created_at)
-            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            prompt,
-            negative_prompt,
-            model_name,
-            json.dumps({
-                "steps": steps,
-                "cfg_scale": cfg_scale,
-                "width": width,
-                "height": height,
-                "seed": seed
-            }),
-            path
-        ))
-        self.db.conn.commit()
-        
-        return image, path
+
+    @metrics.timed("image_generate_batch")
+    def generate_batch(self, jobs):
+        # Render compatible jobs (same model, size, steps and cfg) in a single pipeline call
+        import torch
+
+        self.wait_until_ready()
+        first = jobs[0]
+        for job in jobs:
+            self._validate(job)
+            if job.batch_key != first.batch_key:
+                raise ValueError("Jobs in one batch must share model, size, steps and cfg")
+
+        # One generator per image keeps every seed reproducible on its own
+        generators = []
+        for job in jobs:
+            generator = torch.Generator(self.device)
+            if job.seed is None:
+                job.seed = generator.seed()
+            generators.append(generator.manual_seed(job.seed))
+
+        # Identical earlier renders are served from disk; only the rest reach the pipeline
+        results = [None] * len(jobs)
+        keys = [self._content_key(job) for job in jobs]
+        for i, key in enumerate(keys):
+            pending = self.writer.pending(key)
+            if pending is not None:
+                jobs[i].cached = True
+                results[i] = pending
+                continue
+            hit = self.cache.lookup(key)
+            if hit is not None:
+                image, row = hit
+                jobs[i].cached = True
+                results[i] = (image, row["path"])
+        misses = [i for i, result in enumerate(results) if result is None]
+        metrics.counter("image_cache_hits_total").inc(len(jobs) - len(misses))
+        metrics.counter("image_cache_misses_total").inc(len(misses))
+        if not misses:
+            return results
+
+        pipe = self._acquire(first.model_name)
+        try:
+            prompts = [jobs[i].prompt for i in misses]
+            negative_prompts = [jobs[i].negative_prompt for i in misses]
+            if self.embeddings.supports(pipe):
+                text_inputs = {
+                    "prompt_embeds": self.embeddings.encode(first.model_name, pipe, prompts),
+                    "negative_prompt_embeds": self.embeddings.encode(first.model_name, pipe, negative_prompts)
+                }
+            else:
+                text_inputs = {"prompt": prompts, "negative_prompt": negative_prompts}
+            if "callback_on_step_end" in inspect.signature(pipe.__call__).parameters:
+                text_inputs["callback_on_step_end"] = self._step_callback([jobs[i] for i in misses])
+            with metrics.span("image_inference", model=first.model_name):
+                images = pipe(
+                    **text_inputs,
+                    num_inference_steps=first.steps,
+                    guidance_scale=first.cfg_scale,
+                    width=first.width,
+                    height=first.height,
+                    generator=[generators[i] for i in misses]
+                ).images
+        finally:
+            self._release(first.model_name)
+
+        for i, image in zip(misses, images):
+            job = jobs[i]
+            if job.aborted:
+                # Stopped from a preview while the rest of its batch finished; nothing to keep
+                results[i] = (None, None)
+                continue
+            # Named by content key so the same request finds it again; written in the background
+            path = self.cache.path_for(keys[i], self.writer.extension)
+            self.writer.write(
+                keys[i],
+                image,
+                path,
+                job.prompt,
+                job.negative_prompt,
+                job.model_name,
+                {
+                    "steps": job.steps,
+                    "cfg_scale": job.cfg_scale,
+                    "width": job.width,
+                    "height": job.height,
+                    "seed": job.seed,
+                    "batch_size": len(misses),
+                    "execution_profile": self.profile.as_metadata()
+                }
+            )
+            results[i] = (image, path)
+        return results
+
+    @staticmethod
+    def _step_callback(jobs):
+        # Runs after every denoising step: publishes latent previews and stops the
+        # pipeline once every job in the batch has been cancelled
+        def callback(pipe, step, timestep, callback_kwargs):
+            if all(job.aborted for job in jobs):
+                raise RenderAborted("Render cancelled")
+            latents = callback_kwargs.get("latents")
+            done = step + 1
+            if latents is not None:
+                for i, job in enumerate(jobs):
+                    if job.preview_every and done % job.preview_every == 0 and not job.aborted:
+                        job.set_preview(latents_to_image(latents[i]), done)
+            return callback_kwargs
+        return callback
+
+    def _content_key(self, job):
+        return content_key(
+            job.prompt, job.negative_prompt, job.model_name, job.steps, job.cfg_scale,
+            job.width, job.height, job.seed, self.profile.device, self.profile.dtype
+        )
+
+    def submit(self, prompt, **kwargs):
+        # Queue a render on the background worker and return its ImageJob handle
+        with self._queue_lock:
+            if self.queue is None:
+                self.queue = ImageJobQueue(self, max_batch=self.max_batch)
+        return self.queue.submit(prompt, **kwargs)
+
+    @metrics.timed("image_generate")
+    def generate_image(self, prompt, negative_prompt="", model_name="stable_diffusion", 
+                      steps=30, cfg_scale=7.5, width=512, height=512, seed=None,
+                      preview_every=0, on_preview=None):
+        # on_preview(job, image, step) is called every preview_every steps; returning False
+        # stops the render and raises RenderAborted
+        job = ImageJob(prompt, negative_prompt, model_name, steps, cfg_scale, width, height, seed,
+                       preview_every, on_preview)
+        job.start()
+        result = self.generate_batch([job])[0]
+        if job.aborted:
+            raise RenderAborted("Render cancelled")
+        return result
 
     def get_generation_history(self, limit=10):
-        cursor = self.db.conn.cursor()
-        cursor.execute('''
-            SELECT prompt, model, path, created_at 
-            FROM generated_images 
-            ORDER BY created_at DESC 
-            LIMIT ?
-        ''', (limit,))
-        return cursor.fetchall()
+        return self.db.get_generation_history(limit)
+
+    def close(self):
+        # Finish queued renders' writes before the process goes away
+        if self.queue is not None:
+            self.queue.shutdown()
+        self.writer.shutdown()
 
 if __name__ == "__main__":
     # Test generation
@@ -0,0 +1,228 @@
+# /image_queue.py
+
+from collections import deque
+import threading
+import time
+import metrics
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class RenderAborted(Exception):
+    pass
+
+
+class ImageJob:
+    def __init__(self, prompt, negative_prompt="", model_name="stable_diffusion",
+                 steps=30, cfg_scale=7.5, width=512, height=512, seed=None,
+                 preview_every=0, on_preview=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt or ""
+        self.model_name = model_name
+        self.steps = int(steps)
+        self.cfg_scale = float(cfg_scale)
+        self.width = int(width)
+        self.height = int(height)
+        self.seed = seed
+        self.status = QUEUED
+        self.image = None
+        self.path = None
+        self.error = None
+        self.batch_size = 0
+        self.cached = False
+        # Every preview_every steps a cheap latent preview is stored (and passed to on_preview,
+        # which can return False to stop the render)
+        self.preview_every = int(preview_every or 0)
+        self.on_preview = on_preview
+        self.preview = None
+        self.preview_step = 0
+        self._abort = False
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def batch_key(self):
+        # Jobs with the same key can share one pipeline call
+        return (self.model_name, self.width, self.height, self.steps, self.cfg_scale)
+
+    @property
+    def wait_time(self):
+        end = self.started_at if self.started_at is not None else time.perf_counter()
+        return end - self.enqueued_at
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def aborted(self):
+        return self._abort
+
+    def cancel(self):
+        # A queued job is dropped; a running one is stopped at its next denoising step
+        with self._lock:
+            if self.status == RUNNING:
+                self._abort = True
+                return True
+            if self.status != QUEUED:
+                return self.status == CANCELLED
+            self.status = CANCELLED
+            self.finished_at = time.perf_counter()
+        self._done.set()
+        return True
+
+    def set_preview(self, image, step):
+        self.preview = image
+        self.preview_step = step
+        if self.on_preview is not None and self.on_preview(self, image, step) is False:
+            self._abort = True
+
+    def start(self):
+        with self._lock:
+            if self.status != QUEUED:
+                return False
+            self.status = RUNNING
+            self.started_at = time.perf_counter()
+            return True
+
+    def finish(self, image=None, path=None, error=None):
+        with self._lock:
+            if self._done.is_set():
+                return
+            if self._abort:
+                image = path = error = None
+            self.image = image
+            self.path = path
+            self.error = error
+            if self._abort:
+                self.status = CANCELLED
+            else:
+                self.status = FAILED if error is not None else DONE
+            self.finished_at = time.perf_counter()
+        self._done.set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Image job is still running.")
+        if self.status == CANCELLED:
+            raise RuntimeError("Image job was cancelled.")
+        if self.error is not None:
+            raise self.error
+        return self.image, self.path
+
+
+class ImageJobQueue:
+    def __init__(self, generator, max_batch=4, batch_window=0.05):
+        # generator.generate_batch(jobs) renders a list of compatible jobs in one pipeline call
+        self.generator = generator
+        self.max_batch = max_batch
+        # Short pause after the first job arrives so concurrent submissions can join its batch
+        self.batch_window = batch_window
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._active = []
+        self._finished = deque(maxlen=256)
+        self.total_jobs = 0
+        self.total_batches = 0
+
+        metrics.gauge("image_queue_depth", "Image jobs waiting for the worker", fn=lambda: self.queue_depth)
+
+        self._thread = threading.Thread(target=self._run, name="image-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, **kwargs):
+        job = ImageJob(prompt, **kwargs)
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Image queue is shut down")
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def position(self, job):
+        with self._cond:
+            try:
+                return self._pending.index(job)
+            except ValueError:
+                return None
+
+    @property
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            now = time.perf_counter()
+            recent = [t for t in self._finished if now - t <= 60.0]
+            return {
+                "queue_depth": len(self._pending),
+                "active": len(self._active),
+                "images_per_minute": len(recent),
+                "avg_batch_size": self.total_jobs / self.total_batches if self.total_batches else 0.0,
+                "total_jobs": self.total_jobs,
+                "total_batches": self.total_batches
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            for job in self._pending:
+                job.finish(error=RuntimeError("Image queue is shut down"))
+            self._pending.clear()
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+    def _next_batch(self):
+        with self._cond:
+            while self._running and not self._pending:
+                self._cond.wait()
+            if not self._running:
+                return []
+            if len(self._pending) < self.max_batch and self.batch_window:
+                self._cond.wait(self.batch_window)
+                if not self._running or not self._pending:
+                    return []
+
+            # Oldest job picks the settings; compatible jobs behind it ride along
+            key = self._pending[0].batch_key
+            batch, rest = [], deque()
+            while self._pending:
+                job = self._pending.popleft()
+                if job.status == CANCELLED:
+                    continue
+                if job.batch_key == key and len(batch) < self.max_batch and job.start():
+                    batch.append(job)
+                else:
+                    rest.append(job)
+            self._pending = rest
+            self._active = batch
+            for job in batch:
+                metrics.histogram("image_queue_wait_seconds").observe(job.wait_time)
+            return batch
+
+    def _run(self):
+        while self._running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                results = self.generator.generate_batch(batch)
+                for job, (image, path) in zip(batch, results):
+                    job.batch_size = len(batch)
+                    job.finish(image, path)
+            except Exception as e:
+                for job in batch:
+                    job.finish(error=e)
+            with self._cond:
+                self._active = []
+                self.total_jobs += len(batch)
+                self.total_batches += 1
+                now = time.perf_counter()
+                self._finished.extend(now for job in batch if job.status == DONE)
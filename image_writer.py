@@ -0,0 +1,98 @@
+# /image_writer.py
+
+import atexit
+import os
+import queue
+import threading
+
+_STOP = object()
+
+# Pillow format name and save options per output format
+FORMATS = {
+    "png": ("PNG", {}),
+    "webp": ("WEBP", {"lossless": True, "quality": 100, "method": 4}),
+}
+
+
+class ImageWriter:
+    def __init__(self, db, cache, image_format="png", thumbnail_size=256):
+        # Encoding, thumbnails and metadata inserts happen here instead of on the render path
+        if image_format not in FORMATS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.db = db
+        self.cache = cache
+        self.image_format = image_format
+        self.thumbnail_size = thumbnail_size
+        self.written = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        # content key -> (image, path) until the file and its row exist
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="image-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    @property
+    def extension(self):
+        return self.image_format
+
+    def pending(self, key):
+        with self._lock:
+            return self._pending.get(key)
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def write(self, key, image, path, prompt, negative_prompt, model_name, parameters):
+        with self._lock:
+            self._pending[key] = (image, path)
+        self._queue.put((key, image, path, prompt, negative_prompt, model_name, parameters))
+
+    def flush(self):
+        self._queue.join()
+
+    def shutdown(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _save(self, key, image, path, prompt, negative_prompt, model_name, parameters):
+        format_name, options = FORMATS[self.image_format]
+        tmp_path = f"{path}.tmp"
+        image.save(tmp_path, format_name, **options)
+        os.replace(tmp_path, path)
+
+        thumbnail_path = self.cache.thumbnail_path(path)
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        thumbnail.save(thumbnail_path, "JPEG", quality=85)
+
+        self.db.save_image_metadata(
+            prompt,
+            negative_prompt,
+            model_name,
+            parameters,
+            path,
+            content_key=key,
+            thumbnail_path=thumbnail_path
+        )
+        self.cache.add(path)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._save(*item)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed to write image {item[2]}: {e}")
+            finally:
+                if item is not _STOP:
+                    with self._lock:
+                        self._pending.pop(item[0], None)
+                self._queue.task_done()
@@ -0,0 +1,102 @@
+# /kv_cache.py
+
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import pickle
+
+
+class SessionStateCache:
+    def __init__(self, max_bytes=1024 * 1024 * 1024, spill_dir=None, namespace="",
+                 max_disk_bytes=4 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        # Spilled states are only valid for the model that produced them
+        self.namespace = namespace
+        self.size = 0
+        self.disk_size = 0
+        self._states = OrderedDict()
+        self._spilled = OrderedDict()  # spill file -> bytes, least recently written first
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            # Files from earlier runs count against the disk cap, oldest pruned first
+            files = [(path.stat().st_mtime, path) for path in self.spill_dir.glob("*.state")]
+            for _, path in sorted(files):
+                self._spilled[path] = path.stat().st_size
+                self.disk_size += self._spilled[path]
+            self._prune_disk()
+
+    @staticmethod
+    def state_size(state):
+        size = getattr(state, "llama_state_size", 0)
+        for name in ("input_ids", "scores"):
+            size += getattr(getattr(state, name, None), "nbytes", 0)
+        return size
+
+    def _spill_path(self, key):
+        digest = hashlib.sha1(f"{self.namespace}:{key}".encode("utf-8")).hexdigest()
+        return self.spill_dir / f"{digest}.state"
+
+    def __contains__(self, key):
+        return key in self._states or bool(self.spill_dir and self._spill_path(key) in self._spilled)
+
+    def get(self, key):
+        if key in self._states:
+            self._states.move_to_end(key)
+            return self._states[key][0]
+
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(key)
+        if path not in self._spilled:
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except OSError:
+            state = None
+        self._drop_spilled(path)
+        if state is not None:
+            self.put(key, state)
+        return state
+
+    def put(self, key, state):
+        self.discard(key)
+        size = self.state_size(state)
+        self._states[key] = (state, size)
+        self.size += size
+
+        # Evict least recently used states, spilling them to disk when configured
+        while self.size > self.max_bytes and len(self._states) > 1:
+            old_key, (old_state, old_size) = self._states.popitem(last=False)
+            self.size -= old_size
+            if self.spill_dir:
+                self._spill(old_key, old_state)
+
+    def _spill(self, key, state):
+        path = self._spill_path(key)
+        with open(path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spilled[path] = path.stat().st_size
+        self.disk_size += self._spilled[path]
+        self._prune_disk()
+
+    def _prune_disk(self):
+        # Spilled states of clients that never come back go, least recently written first
+        while self.disk_size > self.max_disk_bytes and self._spilled:
+            self._drop_spilled(next(iter(self._spilled)))
+
+    def _drop_spilled(self, path):
+        size = self._spilled.pop(path, None)
+        if size is not None:
+            self.disk_size -= size
+        path.unlink(missing_ok=True)
+
+    def discard(self, key):
+        if key in self._states:
+            _, size = self._states.pop(key)
+            self.size -= size
+        if self.spill_dir:
+            self._drop_spilled(self._spill_path(key))
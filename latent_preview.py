@@ -0,0 +1,24 @@
+# /latent_preview.py
+
+# Linear map from the 4 SD-1.x latent channels to RGB; a rough but nearly free stand-in
+# for the VAE decoder, good enough to judge composition mid-run
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def latents_to_image(latents, scale=4):
+    # latents: (4, h, w) tensor for one image; returns a PIL image at scale x latent size
+    import torch
+    from PIL import Image
+
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum("chw,cr->hwr", latents.float(), factors)
+    pixels = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+    image = Image.fromarray(pixels)
+    if scale > 1:
+        image = image.resize((image.width * scale, image.height * scale), Image.BILINEAR)
+    return image
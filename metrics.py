@@ -0,0 +1,318 @@
+# /metrics.py
+
+# In-process metrics: counters, latency histograms, gauges and timing spans.
+# Off unless AI_WAIFU_METRICS=1 (or enable() is called); while off, every hook is a
+# flag check and nothing is recorded. AI_WAIFU_METRICS_PORT=<port> also starts the
+# HTTP endpoint (/metrics in Prometheus format, / as plain text).
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import multiprocessing
+import os
+import threading
+import time
+
+# Seconds; covers a SQLite point query up to a long CPU render
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_enabled = os.environ.get("AI_WAIFU_METRICS", "") == "1"
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    # Prometheus label values escape backslash, double quote and newline
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    body = ",".join(f'{name}="{_escape(value)}"' for name, value in key)
+    return "{" + body + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help="", fn=None):
+        self.name = name
+        self.help = help
+        # fn() is read at scrape time, so a callback gauge costs nothing in between
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                return [(self.name, (), self.fn())]
+            except Exception:
+                return []
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def summary(self, **labels):
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            if not series:
+                return None
+            return {"count": series[-1], "sum": series[-2], "avg": series[-2] / series[-1]}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key + (("le", bound),), cumulative))
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), series[-1]))
+                samples.append((f"{self.name}_sum", key, series[-2]))
+                samples.append((f"{self.name}_count", key, series[-1]))
+        return samples
+
+
+class _Noop:
+    # Stand-in handed out while metrics are off, so hot paths skip the registry
+    def inc(self, amount=1, **labels):
+        pass
+
+    def observe(self, value, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+    def summary(self, **labels):
+        return None
+
+
+_NOOP = _Noop()
+
+
+class Registry:
+    def __init__(self, recent_spans=200):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.recent_spans = deque(maxlen=recent_spans)
+
+    def _get(self, cls, name, help, **kwargs):
+        # Lookups of existing metrics don't need the lock
+        metric = self._metrics.get(name)
+        if metric is not None:
+            return metric
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def gauge(self, name, help="", fn=None):
+        metric = self._get(Gauge, name, help)
+        if fn is not None:
+            # The newest owner (e.g. a reloaded scheduler) takes over the callback
+            metric.fn = fn
+        return metric
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics():
+            samples = metric.samples()
+            if not samples:
+                continue
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in samples:
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def render_text(self):
+        lines = []
+        for metric in self.metrics():
+            if isinstance(metric, Histogram):
+                with metric._lock:
+                    series = dict(metric._series)
+                for key, values in series.items():
+                    count, total = values[-1], values[-2]
+                    lines.append(
+                        f"{metric.name}{_format_labels(key)} count={count} "
+                        f"avg={total / count * 1000:.2f}ms total={total:.3f}s"
+                    )
+            else:
+                for name, key, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+        if self.recent_spans:
+            lines.append("")
+            lines.append("# recent spans (newest last)")
+            for name, labels, started, duration, thread in list(self.recent_spans):
+                stamp = time.strftime("%H:%M:%S", time.localtime(started))
+                lines.append(f"{stamp} {thread:>16} {name}{_format_labels(labels)} {duration * 1000:.2f}ms")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help=""):
+    if not _enabled:
+        return _NOOP
+    return REGISTRY.counter(name, help)
+
+
+def histogram(name, help="", buckets=DEFAULT_BUCKETS):
+    if not _enabled:
+        return _NOOP
+    return REGISTRY.histogram(name, help, buckets)
+
+
+def gauge(name, help="", fn=None):
+    return REGISTRY.gauge(name, help, fn)
+
+
+@contextmanager
+def span(name, **labels):
+    # Times the block into the <name>_seconds histogram and the recent-span log
+    if not _enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        histogram(f"{name}_seconds").observe(duration, **labels)
+        REGISTRY.recent_spans.append((
+            name, _label_key(labels), time.time() - duration, duration,
+            threading.current_thread().name
+        ))
+
+
+def timed(name, **labels):
+    # Decorator form of span(); when metrics are off the call goes straight through
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = REGISTRY.render_prometheus()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path in ("/", "/text"):
+            body = REGISTRY.render_text()
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9464, host="127.0.0.1"):
+    # Local-only by default; returns the server so callers can shut it down
+    enable()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+# Only the main process serves; spawned chat workers import this module too
+if os.environ.get("AI_WAIFU_METRICS_PORT") and multiprocessing.current_process().name == "MainProcess":
+    serve(int(os.environ["AI_WAIFU_METRICS_PORT"]))
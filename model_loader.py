@@ -1,10 +1,21 @@
 # /model_loader.py
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from llama_cpp import Llama
+import gc
 import os
-from typing import Union
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Union
 from dataclasses import dataclass
+from execution_profile import detect_profile
+from autotune import RUNTIME_KEYS, load_tuning, resolve_kv_types
+import metrics
+
+# Heavy backends are imported on first use, so the GGUF path never pulls in
+# torch/transformers and importing this module stays cheap
+if TYPE_CHECKING:
+    from transformers import AutoModelForCausalLM
+    from llama_cpp import Llama
 
 @dataclass
 class ModelConfig:
@@ -13,71 +24,296 @@ class ModelConfig:
     type: str  # "gguf" or "transformers"
     params: dict
 
+MB = 1024 * 1024
+# KV cache cost per context token for a 7B GQA model at f16 (2 * 32 layers * 1024 * 2 bytes)
+KV_BYTES_PER_TOKEN = 128 * 1024
+
+def physical_memory_bytes():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class ExternalModel:
+    # Memory held outside this loader (e.g. ImageGenerator's pipelines) that counts against
+    # its budget. Evicting it asks the owner to unload; busy() keeps it resident while in use.
+    def __init__(self, unload, busy=None):
+        self.unload = unload
+        self.busy = busy or (lambda: False)
+
+    def close(self):
+        self.unload()
+
 class ModelLoader:
-    def __init__(self):
-        self.loaded_models = {}
+    def __init__(self, memory_budget_mb=None):
+        # Least recently used first
+        self.loaded_models = OrderedDict()
+        self.model_sizes = {}
+        self.pins = {}
         self.current_model = None
+        self.current_model_key = None
+        self._lock = threading.RLock()
+
+        if memory_budget_mb is None:
+            total = physical_memory_bytes()
+            self.memory_budget = int(total * 0.8) if total else None
+        else:
+            self.memory_budget = memory_budget_mb * MB
+
+        metrics.gauge("models_loaded", "Models resident in this process", fn=lambda: len(self.loaded_models))
+        metrics.gauge("models_resident_bytes", "Estimated memory held by loaded models",
+                      fn=lambda: self.resident_bytes)
+
         self.model_configs = {
             "chat": ModelConfig(
                 name="Mistral-7B-Instruct",
                 path="gguf/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
                 type="gguf",
-                params={"n_ctx": 2048, "n_gpu_layers": 33}
+                params={
+                    "n_ctx": 2048,
+                    # None offloads every layer when llama.cpp was built with GPU support
+                    "n_gpu_layers": None,
+                    "max_tokens": 256,  # reserved for the reply
+                    "history_tokens": 1024,  # upper bound for conversation history
+                    "state_cache_mb": 1024,  # per-session KV states kept in RAM
+                    "state_cache_dir": "data/kv_cache",  # spill target for evicted states
+                    "state_cache_disk_mb": 4096,  # cap on spilled states, oldest pruned first
+                    "n_parallel": 4,  # sequences decoded together by the request scheduler
+                    "n_batch": 512,
+                    # e.g. {"mode": "prompt_lookup"} or {"mode": "draft", "path": "gguf/<small>.gguf"};
+                    # see speculative.py. Requests are then decoded one at a time.
+                    "speculative": None,
+                    # >0 serves chat from that many worker processes (see worker_pool.py)
+                    "workers": 0,
+                    # Apply the settings stored by autotune.py for this model and host
+                    "autotune": True
+                }
             ),
             "image": ModelConfig(
                 name="Stable-Diffusion",
                 path="CompVis/stable-diffusion-v1-4",
                 type="transformers",
-                params={"variant": "fp16", "torch_dtype": torch.float16}
+                # dtype comes from the host's execution profile (see execution_profile.py)
+                params={"variant": "fp16", "execution_profile": "auto"}
             )
         }
 
-    def load_model(self, model_key: str) -> Union[Llama, AutoModelForCausalLM]:
+    def estimate_memory(self, model_key: str) -> int:
+        config = self.model_configs[model_key]
+        if "memory_mb" in config.params:
+            return config.params["memory_mb"] * MB
+
+        if config.type == "gguf":
+            # Weights are mmapped but end up resident; add the KV cache for every context
+            weights = os.path.getsize(config.path) if os.path.exists(config.path) else 0
+            n_ctx = config.params.get("n_ctx", 512)
+            n_seqs = 1 + max(config.params.get("n_parallel", 1), 1)
+            return weights + n_ctx * n_seqs * KV_BYTES_PER_TOKEN
+        return 0
+
+    @staticmethod
+    def measure_memory(model) -> int:
+        # Parameters and buffers of torch modules; None when the size can't be read
+        if not hasattr(model, "parameters"):
+            return None
+        size = sum(p.numel() * p.element_size() for p in model.parameters())
+        if hasattr(model, "buffers"):
+            size += sum(b.numel() * b.element_size() for b in model.buffers())
+        return size
+
+    @property
+    def resident_bytes(self):
+        return sum(self.model_sizes.get(key, 0) for key in self.loaded_models)
+
+    def memory_usage(self):
+        return {
+            "budget_bytes": self.memory_budget,
+            "resident_bytes": self.resident_bytes,
+            "models": {
+                key: {"bytes": self.model_sizes.get(key, 0), "pinned": self.pins.get(key, 0) > 0}
+                for key in self.loaded_models
+            }
+        }
+
+    def _make_room(self, needed: int, keep: str = None, strict: bool = True):
+        if self.memory_budget is None:
+            return
+        for key in list(self.loaded_models):
+            if self.resident_bytes + needed <= self.memory_budget:
+                return
+            if key != keep and self._evictable(key):
+                try:
+                    self.unload_model(key)
+                except RuntimeError as e:
+                    # Went into use since the check; it stays resident and counted
+                    print(f"Not evicting {key}: {e}")
+        if strict and self.resident_bytes + needed > self.memory_budget:
+            raise MemoryError(
+                f"Not enough memory budget for {keep}: need {needed // MB} MB, "
+                f"{self.resident_bytes // MB} of {self.memory_budget // MB} MB held by pinned models"
+            )
+
+    def _evictable(self, model_key: str):
+        model = self.loaded_models[model_key]
+        return not self.pins.get(model_key) and not (isinstance(model, ExternalModel) and model.busy())
+
+    def reserve(self, model_key: str, nbytes: int, unload, busy=None):
+        # Accounts for a model loaded elsewhere. The first call makes room for it (or raises
+        # MemoryError); later calls update its size, e.g. once it has been measured.
+        with self._lock:
+            if model_key in self.loaded_models:
+                self.model_sizes[model_key] = nbytes
+                self._touch(model_key)
+                self._make_room(0, keep=model_key, strict=False)
+                return
+            self._make_room(nbytes, keep=model_key)
+            self.loaded_models[model_key] = ExternalModel(unload, busy)
+            self.model_sizes[model_key] = nbytes
+
+    def touch(self, model_key: str):
+        with self._lock:
+            if model_key in self.loaded_models:
+                self._touch(model_key)
+
+    def _touch(self, model_key: str):
+        self.loaded_models.move_to_end(model_key)
+        return self.loaded_models[model_key]
+
+    def load_model(self, model_key: str) -> Union["Llama", "AutoModelForCausalLM"]:
         if model_key not in self.model_configs:
             raise ValueError(f"Unknown model key: {model_key}")
-        
+
+        with self._lock:
+            if model_key in self.loaded_models:
+                model = self._touch(model_key)
+            else:
+                self._make_room(self.estimate_memory(model_key), keep=model_key)
+                with metrics.span("model_load", model=model_key):
+                    model = self._load(model_key)
+                self.loaded_models[model_key] = model
+                self.model_sizes[model_key] = self.measure_memory(model) or self.estimate_memory(model_key)
+                # The measured size may be larger than estimated
+                self._make_room(0, keep=model_key, strict=False)
+            self.current_model = model
+            self.current_model_key = model_key
+            return model
+
+    def _load(self, model_key: str):
         config = self.model_configs[model_key]
         
         if config.type == "gguf":
+            import llama_cpp
+            from llama_cpp import Llama
+            from speculative import make_draft_model, check_vocab
+
             if not os.path.exists(config.path):
                 raise FileNotFoundError(f"GGUF model not found at {config.path}")
-            
+
+            if config.params.get("autotune"):
+                # Written back so the request scheduler sees the tuned n_batch too
+                config.params.update(load_tuning(config.path))
+            runtime = {key: config.params[key] for key in RUNTIME_KEYS if key in config.params}
+            n_gpu_layers = config.params.get("n_gpu_layers")
+            if n_gpu_layers is None:
+                n_gpu_layers = -1 if llama_cpp.llama_supports_gpu_offload() else 0
+
+            # Opt-in speculative decoding; llama-cpp-python turns on logits_all for it
+            draft_model = make_draft_model(config.params.get("speculative"), config.params)
             model = Llama(
                 model_path=config.path,
                 n_ctx=config.params["n_ctx"],
-                n_gpu_layers=config.params["n_gpu_layers"],
-                verbose=False
+                n_gpu_layers=n_gpu_layers,
+                draft_model=draft_model,
+                verbose=False,
+                **resolve_kv_types(runtime)
             )
+            check_vocab(model, draft_model)
         elif config.type == "transformers":
+            import torch
+            from transformers import AutoModelForCausalLM
+
+            params = dict(config.params)
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            if "execution_profile" in params:
+                profile = detect_profile(params.pop("execution_profile"))
+                profile.configure_torch()
+                params.setdefault("torch_dtype", profile.dtype)
+                device = profile.device
+            if isinstance(params.get("torch_dtype"), str):
+                params["torch_dtype"] = getattr(torch, params["torch_dtype"])
             model = AutoModelForCausalLM.from_pretrained(
                 config.path,
-                **config.params
-            ).to("cuda" if torch.cuda.is_available() else "cpu")
+                **params
+            ).to(device)
         else:
             raise ValueError(f"Unsupported model type: {config.type}")
         
-        self.loaded_models[model_key] = model
-        self.current_model = model
         return model
 
     def unload_model(self, model_key: str):
-        if model_key in self.loaded_models:
+        with self._lock:
+            if model_key not in self.loaded_models:
+                return
+            model = self.loaded_models[model_key]
+            if self.pins.get(model_key) or (isinstance(model, ExternalModel) and model.busy()):
+                raise RuntimeError(f"Model {model_key} is in use and cannot be unloaded")
+
+            # Removed before close(): an external owner's unload calls back in here
             del self.loaded_models[model_key]
-            if self.current_model == model_key:
+            size = self.model_sizes.pop(model_key, None)
+            if self.current_model_key == model_key:
                 self.current_model = None
-            torch.cuda.empty_cache()
+                self.current_model_key = None
+
+            # Free native memory now instead of whenever the last reference is collected
+            if hasattr(model, "close"):
+                try:
+                    model.close()
+                except Exception:
+                    # Nothing was freed, so it keeps its place in the budget
+                    self.loaded_models[model_key] = model
+                    self.model_sizes[model_key] = size
+                    raise
+            del model
+            gc.collect()
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
     def get_model(self, model_key: str):
-        if model_key in self.loaded_models:
-            return self.loaded_models[model_key]
-        return self.load_model(model_key)
+        with self._lock:
+            if model_key in self.loaded_models:
+                return self._touch(model_key)
+            return self.load_model(model_key)
 
     def switch_model(self, model_key: str):
         if model_key not in self.model_configs:
             raise ValueError(f"Unknown model key: {model_key}")
-        if model_key not in self.loaded_models:
-            self.load_model(model_key)
-        self.current_model = self.loaded_models[model_key]
+        with self._lock:
+            self.current_model = self.get_model(model_key)
+            self.current_model_key = model_key
+
+    def pin(self, model_key: str):
+        # Pinned models are never evicted; pins are counted
+        with self._lock:
+            model = self.get_model(model_key)
+            self.pins[model_key] = self.pins.get(model_key, 0) + 1
+            return model
+
+    def unpin(self, model_key: str):
+        with self._lock:
+            if self.pins.get(model_key, 0) > 1:
+                self.pins[model_key] -= 1
+            else:
+                self.pins.pop(model_key, None)
+
+    @contextmanager
+    def use(self, model_key: str):
+        model = self.pin(model_key)
+        try:
+            yield model
+        finally:
+            self.unpin(model_key)
 
     def list_available_models(self):
         return [
@@ -86,7 +322,9 @@ class ModelLoader:
                 "key": key,
                 "type": config.type,
                 "path": config.path,
-                "loaded": key in self.loaded_models
+                "loaded": key in self.loaded_models,
+                "pinned": self.pins.get(key, 0) > 0,
+                "memory_mb": self.model_sizes.get(key, self.estimate_memory(key)) // MB
             }
             for key, config in self.model_configs.items()
         ]
@@ -1,27 +1,48 @@
 # /profile_manager.py
 
 from database import DatabaseManager
+import copy
 import json
 
 class ProfileManager:
-    def __init__(self):
-        self.db = DatabaseManager()
+    def __init__(self, db=None):
+        self.db = db or DatabaseManager()
         self.current_profiles = {
             'chatbot': {'name': 'Default', 'data': {}},
             'user': {'name': 'Guest', 'data': {}}
         }
         self.current_session = None
+        self.current_session_id = None
+
+        # Profile rows are cached until this manager saves or deletes them
+        self._profiles = {}  # (entity_type, name) -> data, None if missing
+        self._profile_names = {}  # entity_type -> names, most recently updated first
+        self._prompt_fragments = {}  # entity_type -> (version, JSON text) of the current profile
+        # Bumped whenever a current profile is replaced or saved
+        self._versions = {'chatbot': 0, 'user': 0}
+
+    def _invalidate(self, entity_type, profile_name=None):
+        self._profile_names.pop(entity_type, None)
+        if profile_name is not None:
+            self._profiles.pop((entity_type, profile_name), None)
+
+    def get_profile_data(self, entity_type, profile_name):
+        # A copy, so callers can't change the cached row
+        key = (entity_type, profile_name)
+        if key not in self._profiles:
+            self._profiles[key] = self.db.get_profile(entity_type, profile_name)
+        return copy.deepcopy(self._profiles[key])
 
     def get_profile_options(self, entity_type):
-        profiles = self.db.get_profiles(entity_type)
-        return ['New Profile'] + list(profiles.keys())
+        if entity_type not in self._profile_names:
+            self._profile_names[entity_type] = self.db.get_profile_names(entity_type)
+        return ['New Profile'] + self._profile_names[entity_type]
 
     def load_profile(self, entity_type, profile_name):
         if profile_name == 'New Profile':
             return {'name': '', 'data': {}}
         
-        profiles = self.db.get_profiles(entity_type)
-        profile_data = profiles.get(profile_name, {})
+        profile_data = self.get_profile_data(entity_type, profile_name) or {}
         
         return {
             'name': profile_name,
@@ -33,15 +54,18 @@ class ProfileManager:
             raise ValueError("Profile name cannot be empty")
         
         self.db.save_profile(entity_type, profile_name, data)
+        self._invalidate(entity_type, profile_name)
         
         if self.current_profiles[entity_type]['name'] == profile_name:
             self.current_profiles[entity_type]['data'] = data
+            self._versions[entity_type] += 1
 
     def delete_profile(self, entity_type, profile_name):
         if profile_name == 'Default' or profile_name == 'Guest':
             raise ValueError("Cannot delete default profiles")
         
         self.db.delete_profile(entity_type, profile_name)
+        self._invalidate(entity_type, profile_name)
         
         if self.current_profiles[entity_type]['name'] == profile_name:
             self.reset_profile(entity_type)
@@ -52,44 +76,86 @@ class ProfileManager:
             'name': default_name,
             'data': {}
         }
+        self._versions[entity_type] += 1
 
-    def save_chat_session(self, session_name, messages):
+    def save_chat_session(self, session_name, messages, replace_session_id=None):
         if not session_name:
             raise ValueError("Session name cannot be empty")
         
-        self.db.save_chat_session(
+        self.current_session_id = self.db.save_chat_session(
             session_name,
             self.current_profiles['chatbot']['name'],
             self.current_profiles['user']['name'],
-            messages
+            messages,
+            replace_session_id=replace_session_id
         )
+        # Saving a session creates any profile it references that didn't exist yet
+        for entity_type in ('chatbot', 'user'):
+            self._invalidate(entity_type, self.current_profiles[entity_type]['name'])
         self.current_session = session_name
+        return self.current_session_id
+
+    def create_chat_session(self, session_name, chatbot_profile, user_profile):
+        # Also creates any profile it references that didn't exist yet
+        session_id = self.db.create_chat_session(session_name, chatbot_profile, user_profile)
+        self._invalidate('chatbot', chatbot_profile)
+        self._invalidate('user', user_profile)
+        return session_id
+
+    def append_chat_messages(self, messages, session_id=None):
+        # Per-turn persistence into a session (the current one by default); cost doesn't grow with its length
+        session_id = session_id if session_id is not None else self.current_session_id
+        if session_id is None:
+            raise ValueError("No active chat session")
+        self.db.append_chat_messages(session_id, messages)
 
     def load_chat_sessions(self):
         return self.db.load_chat_sessions()
 
+    def get_session(self, session_id):
+        return self.db.get_session(session_id)
+
+    def list_chat_sessions(self, limit=50, after=None, query=None):
+        return self.db.list_chat_sessions(limit=limit, after=after, query=query)
+
     def load_chat_history(self, session_id):
         messages = self.db.load_chat_messages(session_id)
-        session_info = next(
-            (s for s in self.db.load_chat_sessions() if s[0] == session_id),
-            None
-        )
+        session_info = self.db.get_session(session_id)
         
         if session_info:
+            self.current_session = session_info[1]
+            self.current_session_id = session_id
             self.current_profiles['chatbot']['name'] = session_info[2]
             self.current_profiles['user']['name'] = session_info[3]
             
-            chatbot_profile = self.db.get_profiles('chatbot').get(session_info[2], {})
-            user_profile = self.db.get_profiles('user').get(session_info[3], {})
+            chatbot_profile = self.get_profile_data('chatbot', session_info[2]) or {}
+            user_profile = self.get_profile_data('user', session_info[3]) or {}
             
             self.current_profiles['chatbot']['data'] = chatbot_profile
             self.current_profiles['user']['data'] = user_profile
+            for entity_type in ('chatbot', 'user'):
+                self._versions[entity_type] += 1
         
         return messages
 
+    def search_chat_history(self, text, limit=20):
+        return self.db.search_messages(text, limit=limit)
+
+    def load_chat_page(self, session_id, limit=50, before_seq=None):
+        return self.db.load_chat_messages(session_id, limit=limit, before_seq=before_seq)
+
     def get_current_profiles(self):
         return self.current_profiles.copy()
 
+    def get_prompt_fragment(self, entity_type):
+        # JSON of the current profile, serialized once per profile change rather than per turn
+        version = self._versions[entity_type]
+        cached = self._prompt_fragments.get(entity_type)
+        if cached is None or cached[0] != version:
+            cached = (version, json.dumps(self.current_profiles[entity_type]['data']))
+            self._prompt_fragments[entity_type] = cached
+        return cached[1]
+
     def set_current_profile(self, entity_type, profile_name, data):
         if entity_type not in ['chatbot', 'user']:
             raise ValueError("Invalid entity type")
@@ -98,4 +164,5 @@ class ProfileManager:
             'name': profile_name,
             'data': data
         }
+        self._versions[entity_type] += 1
 
@@ -0,0 +1,60 @@
+# /prompt_cache.py
+
+from collections import OrderedDict
+import threading
+
+
+class PromptEmbeddingCache:
+    def __init__(self, max_entries=256):
+        # One SD-1.x embedding (77 x 768) is ~120 KB at fp16, so the default stays around 30 MB
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._embeds = OrderedDict()  # (model_name, text) -> tensor of shape (1, tokens, dim)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(pipe):
+        return hasattr(pipe, "encode_prompt")
+
+    def get(self, model_name, pipe, text):
+        key = (model_name, text)
+        with self._lock:
+            if key in self._embeds:
+                self._embeds.move_to_end(key)
+                self.hits += 1
+                return self._embeds[key]
+            self.misses += 1
+
+        import torch
+
+        with torch.no_grad():
+            embeds = pipe.encode_prompt(text, pipe.device, 1, False)[0]
+
+        with self._lock:
+            self._embeds[key] = embeds
+            self._embeds.move_to_end(key)
+            while len(self._embeds) > self.max_entries:
+                self._embeds.popitem(last=False)
+        return embeds
+
+    def encode(self, model_name, pipe, texts):
+        # Stack cached per-text embeddings into one batch for the pipeline
+        import torch
+
+        return torch.cat([self.get(model_name, pipe, text) for text in texts])
+
+    def drop(self, model_name):
+        with self._lock:
+            for key in [key for key in self._embeds if key[0] == model_name]:
+                del self._embeds[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._embeds),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
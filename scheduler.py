@@ -0,0 +1,508 @@
+# /scheduler.py
+
+from collections import OrderedDict, deque
+import codecs
+import ctypes
+import queue
+import threading
+import time
+import metrics
+
+_DONE = object()
+# Tokens the repeat penalty looks back over; llama-cpp-python's last_n_tokens_size default
+REPEAT_LAST_N = 64
+
+
+class ChatRequest:
+    def __init__(self, session_key, prompt, max_tokens=256, stop=None,
+                 temperature=0.8, top_k=40, top_p=0.95, min_p=0.05, repeat_penalty=1.0):
+        self.session_key = session_key
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.stop = stop or []
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repeat_penalty = repeat_penalty
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self._deltas = queue.Queue()
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def wait_time(self):
+        end = self.started_at if self.started_at is not None else time.perf_counter()
+        return end - self.enqueued_at
+
+    def cancel(self):
+        self._cancel.set()
+
+    def put(self, delta):
+        self._deltas.put(delta)
+
+    def finish(self, error=None):
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+            self._deltas.put(error if error is not None else _DONE)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._deltas.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # A consumer that stops reading early frees its decode slot
+            self.cancel()
+
+
+class RequestScheduler:
+    def __init__(self, model, generate_fn, n_parallel=1, n_ctx=2048, n_batch=512, state_cache=None):
+        self.model = model
+        # Serial fallback: generate_fn(request) yields text deltas using the model directly
+        self.generate_fn = generate_fn
+        self.n_parallel = n_parallel
+        self._pending = OrderedDict()  # session_key -> deque of requests
+        self._active = []
+        self._cond = threading.Condition()
+        self._running = True
+        self._wait_times = deque(maxlen=256)
+        self._token_times = deque(maxlen=4096)
+        self.total_requests = 0
+        self.total_tokens = 0
+
+        self.decoder = None
+        if n_parallel > 1:
+            try:
+                self.decoder = BatchDecoder(model, n_parallel, n_ctx, n_batch, state_cache)
+            except (ImportError, AttributeError, RuntimeError) as e:
+                print(f"Batched decoding unavailable, serving requests one at a time: {e}")
+
+        metrics.gauge("chat_queue_depth", "Chat requests waiting for a slot", fn=lambda: self.queue_depth)
+        metrics.gauge("chat_active_requests", "Chat requests being decoded", fn=lambda: len(self._active))
+
+        self._thread = threading.Thread(target=self._run, name="chat-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, session_key, prompt, **kwargs):
+        request = ChatRequest(session_key, prompt, **kwargs)
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Scheduler is shut down")
+            self._pending.setdefault(session_key, deque()).append(request)
+            self._cond.notify()
+        return request
+
+    @property
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(requests) for requests in self._pending.values())
+
+    def stats(self):
+        draft = getattr(self.model, "draft_model", None)
+        with self._cond:
+            depth = sum(len(requests) for requests in self._pending.values())
+            waits = sorted(self._wait_times)
+            now = time.perf_counter()
+            recent = [n for t, n in self._token_times if now - t <= 10.0]
+            return {
+                "mode": "batched" if self.decoder else "serial",
+                "queue_depth": depth,
+                "active": len(self._active),
+                "waiting_sessions": len(self._pending),
+                "wait_avg_s": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95_s": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "tokens_per_s": sum(recent) / 10.0,
+                "total_requests": self.total_requests,
+                "total_tokens": self.total_tokens,
+                "speculative": draft.stats() if hasattr(draft, "stats") else None
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            for requests in self._pending.values():
+                for request in requests:
+                    request.finish(RuntimeError("Scheduler is shut down"))
+            self._pending.clear()
+            self._cond.notify_all()
+        # The scheduler thread finishes its active requests and frees the decoder itself,
+        # so the context is never freed under a running llama_decode
+        self._thread.join(timeout=5)
+        if self._thread.is_alive():
+            print("Chat scheduler is still finishing a decode step; it will free its context when done")
+
+    def _next_request(self, block):
+        # Round-robin over sessions: each session gets one admission per pass
+        with self._cond:
+            while self._running and not self._pending:
+                if not block:
+                    return None
+                self._cond.wait()
+            if not self._running:
+                return None
+
+            session_key, requests = next(iter(self._pending.items()))
+            request = requests.popleft()
+            del self._pending[session_key]
+            if requests:
+                self._pending[session_key] = requests
+
+            request.started_at = time.perf_counter()
+            self._wait_times.append(request.wait_time)
+            metrics.histogram("chat_queue_wait_seconds").observe(request.wait_time)
+            self.total_requests += 1
+            return request
+
+    def _record_tokens(self, n):
+        self.total_tokens += n
+        metrics.counter("chat_tokens_total", "Tokens generated").inc(n)
+        self._token_times.append((time.perf_counter(), n))
+
+    def _run(self):
+        if self.decoder:
+            try:
+                self._run_batched()
+            finally:
+                self.decoder.abort_all(RuntimeError("Scheduler is shut down"))
+                self.decoder.close()
+                self._active = []
+        else:
+            self._run_serial()
+
+    def _run_serial(self):
+        while self._running:
+            request = self._next_request(block=True)
+            if request is None:
+                continue
+            if request.cancelled:
+                request.finish()
+                continue
+
+            self._active = [request]
+            stream = self.generate_fn(request)
+            try:
+                for delta in stream:
+                    if request.cancelled:
+                        break
+                    if not self._running:
+                        raise RuntimeError("Scheduler is shut down")
+                    request.put(delta)
+                    self._record_tokens(1)
+                request.finish()
+            except Exception as e:
+                request.finish(e)
+            finally:
+                stream.close()
+                self._active = []
+
+    def _run_batched(self):
+        while self._running:
+            # Fill free slots first, then advance every active sequence by one batch
+            while self.decoder.has_free_slot():
+                request = self._next_request(block=not self.decoder.busy())
+                if request is None:
+                    break
+                if request.cancelled:
+                    request.finish()
+                    continue
+                try:
+                    self.decoder.admit(request)
+                except Exception as e:
+                    request.finish(e)
+
+            self._active = self.decoder.active_requests()
+            if not self._active:
+                continue
+            try:
+                self._record_tokens(self.decoder.step())
+            except Exception as e:
+                self.decoder.abort_all(e)
+            self._active = self.decoder.active_requests()
+
+
+class _Slot:
+    def __init__(self, seq_id):
+        self.seq_id = seq_id
+        self.tokens = []  # tokens already evaluated into this sequence's KV cells
+        self.pending = []  # tokens to evaluate next
+        self.request = None
+        self.session_key = None
+        self.last_used = 0.0
+        self.n_decoded = 0
+        self.text = ""
+        self.emitted = 0
+        self.utf8 = None
+
+
+class SeqState:
+    # KV cells of one sequence, as saved by llama_state_seq_get_data, and their tokens
+    def __init__(self, tokens, data):
+        self.tokens = tokens
+        self.data = data
+        self.llama_state_size = len(data)
+
+
+class BatchDecoder:
+    # Decodes several sequences per llama_decode call on a dedicated multi-sequence context.
+    # Finished slots keep their KV cells, so a session's next turn only evaluates the new suffix.
+    # When a slot goes to another session, the previous one's cells are parked in the
+    # SessionStateCache and restored when it comes back.
+
+    def __init__(self, model, n_parallel, n_ctx, n_batch, state_cache=None):
+        import llama_cpp
+        import numpy as np
+
+        self.llama_cpp = llama_cpp
+        self.np = np
+        self.model = model
+        self.n_ctx = n_ctx
+        self.n_batch = n_batch
+        self.n_vocab = model.n_vocab()
+        self.eos = model.token_eos()
+        self.rng = np.random.default_rng()
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx * n_parallel
+        params.n_batch = n_batch
+        params.n_seq_max = n_parallel
+        params.n_threads = model.context_params.n_threads
+        params.n_threads_batch = model.context_params.n_threads_batch
+        # Same KV cache layout as the model's own context (see autotune.py)
+        for field in ("type_k", "type_v", "flash_attn", "flash_attn_type"):
+            if hasattr(params, field) and hasattr(model.context_params, field):
+                setattr(params, field, getattr(model.context_params, field))
+        new_context = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+        self.ctx = new_context(model.model, params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create batched llama.cpp context")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_parallel)
+        self._seq_rm = self._resolve_seq_rm()
+        self.slots = [_Slot(i) for i in range(n_parallel)]
+        self.state_cache = state_cache if hasattr(llama_cpp, "llama_state_seq_get_data") else None
+
+    def _resolve_seq_rm(self):
+        llama_cpp = self.llama_cpp
+        if hasattr(llama_cpp, "llama_memory_seq_rm"):
+            memory = llama_cpp.llama_get_memory(self.ctx)
+            return lambda seq_id, p0, p1: llama_cpp.llama_memory_seq_rm(memory, seq_id, p0, p1)
+        if hasattr(llama_cpp, "llama_kv_self_seq_rm"):
+            return lambda seq_id, p0, p1: llama_cpp.llama_kv_self_seq_rm(self.ctx, seq_id, p0, p1)
+        return lambda seq_id, p0, p1: llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, p0, p1)
+
+    def has_free_slot(self):
+        return any(slot.request is None for slot in self.slots)
+
+    def busy(self):
+        return any(slot.request is not None for slot in self.slots)
+
+    def active_requests(self):
+        return [slot.request for slot in self.slots if slot.request is not None]
+
+    def _pick_slot(self, session_key):
+        free = [slot for slot in self.slots if slot.request is None]
+        for slot in free:
+            if slot.session_key == session_key:
+                return slot
+        return min(free, key=lambda slot: slot.last_used)
+
+    def admit(self, request):
+        tokens = self.model.tokenize(request.prompt.encode("utf-8"), add_bos=True)
+        # Keep the prompt and the reply inside this sequence's share of the context
+        limit = self.n_ctx - request.max_tokens
+        if len(tokens) > limit:
+            tokens = tokens[len(tokens) - limit:]
+
+        slot = self._pick_slot(request.session_key)
+        if slot.session_key != request.session_key:
+            self._park(slot)
+            self._restore(slot, request.session_key)
+        n_keep = 0
+        if slot.session_key == request.session_key:
+            while n_keep < min(len(tokens), len(slot.tokens)) and tokens[n_keep] == slot.tokens[n_keep]:
+                n_keep += 1
+        # The last prompt token is always evaluated so there are logits to sample from
+        n_keep = min(n_keep, len(tokens) - 1)
+
+        self._seq_rm(slot.seq_id, n_keep, -1)
+        slot.tokens = tokens[:n_keep]
+        slot.pending = tokens[n_keep:]
+        slot.request = request
+        slot.session_key = request.session_key
+        slot.n_decoded = 0
+        slot.text = ""
+        slot.emitted = 0
+        slot.utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    @staticmethod
+    def _state_key(session_key):
+        # Kept apart from the serial path's whole-context states in the same cache
+        return f"seq:{session_key}"
+
+    def _park(self, slot):
+        if self.state_cache is None or slot.session_key is None or not slot.tokens:
+            return
+        llama_cpp = self.llama_cpp
+        size = llama_cpp.llama_state_seq_get_size(self.ctx, slot.seq_id)
+        buffer = (ctypes.c_uint8 * size)()
+        written = llama_cpp.llama_state_seq_get_data(self.ctx, buffer, size, slot.seq_id)
+        if written:
+            self.state_cache.put(self._state_key(slot.session_key), SeqState(list(slot.tokens), bytes(buffer)[:written]))
+
+    def _restore(self, slot, session_key):
+        # Fills the slot with the session's parked cells, or leaves it empty
+        self._seq_rm(slot.seq_id, -1, -1)
+        slot.tokens = []
+        slot.session_key = None
+        if self.state_cache is None:
+            return
+        key = self._state_key(session_key)
+        state = self.state_cache.get(key)
+        if not isinstance(state, SeqState):
+            return
+        self.state_cache.discard(key)
+        llama_cpp = self.llama_cpp
+        buffer = (ctypes.c_uint8 * len(state.data)).from_buffer_copy(state.data)
+        if llama_cpp.llama_state_seq_set_data(self.ctx, buffer, len(state.data), slot.seq_id):
+            slot.tokens = list(state.tokens)
+            slot.session_key = session_key
+        else:
+            self._seq_rm(slot.seq_id, -1, -1)
+
+    def step(self):
+        batch = self.batch
+        n = 0
+        sample_at = {}
+        # Single decode tokens go in before prompt chunks so prefills can't stall running replies
+        for slot in sorted(self.slots, key=lambda slot: len(slot.pending)):
+            if slot.request is None:
+                continue
+            if slot.request.cancelled:
+                self._finish(slot)
+                continue
+
+            chunk = slot.pending[:self.n_batch - n]
+            for i, token in enumerate(chunk):
+                batch.token[n] = token
+                batch.pos[n] = len(slot.tokens) + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = slot.seq_id
+                batch.logits[n] = False
+                n += 1
+            slot.tokens.extend(chunk)
+            slot.pending = slot.pending[len(chunk):]
+            if chunk and not slot.pending:
+                batch.logits[n - 1] = True
+                sample_at[slot.seq_id] = n - 1
+            if n >= self.n_batch:
+                break
+
+        if not n:
+            return 0
+        batch.n_tokens = n
+        result = self.llama_cpp.llama_decode(self.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed with code {result}")
+
+        generated = 0
+        for slot in self.slots:
+            if slot.request is None or slot.seq_id not in sample_at:
+                continue
+            token = self._sample(slot.request, sample_at[slot.seq_id], slot.tokens)
+            generated += 1
+            slot.n_decoded += 1
+            slot.last_used = time.perf_counter()
+            if token == self.eos:
+                self._finish(slot)
+                continue
+            slot.pending = [token]
+            stopped = self._emit(slot, self.model.detokenize([token]))
+            if stopped or slot.n_decoded >= slot.request.max_tokens \
+                    or len(slot.tokens) + 1 >= self.n_ctx:
+                self._finish(slot)
+        return generated
+
+    def _sample(self, request, index, history):
+        # Same chain as create_completion on the serial path: repeat penalty, top-k, top-p and
+        # min-p on the untempered distribution, then temperature
+        np = self.np
+        logits = np.ctypeslib.as_array(
+            self.llama_cpp.llama_get_logits_ith(self.ctx, index),
+            shape=(self.n_vocab,)
+        ).copy()
+        if request.repeat_penalty != 1.0 and history:
+            recent = np.unique(np.asarray(history[-REPEAT_LAST_N:], dtype=np.intc))
+            values = logits[recent]
+            logits[recent] = np.where(values > 0, values / request.repeat_penalty, values * request.repeat_penalty)
+        if request.temperature <= 0:
+            return int(logits.argmax())
+
+        k = min(request.top_k, self.n_vocab) if request.top_k > 0 else self.n_vocab
+        top = np.argpartition(logits, -k)[-k:]
+        top = top[np.argsort(logits[top])[::-1]]
+        logits = logits[top]
+        probs = np.exp(logits - logits[0])
+        probs /= probs.sum()
+        keep = min(int(np.searchsorted(np.cumsum(probs), request.top_p)) + 1, len(top))
+        if request.min_p > 0:
+            keep = max(1, min(keep, int((probs >= request.min_p * probs[0]).sum())))
+        probs = np.exp((logits[:keep] - logits[0]) / request.temperature)
+        probs /= probs.sum()
+        return int(self.rng.choice(top[:keep], p=probs))
+
+    def _emit(self, slot, piece):
+        request = slot.request
+        slot.text += slot.utf8.decode(piece)
+        text = slot.text
+
+        for stop in request.stop:
+            index = text.find(stop, max(0, slot.emitted - len(stop)))
+            if index != -1:
+                if index > slot.emitted:
+                    request.put(text[slot.emitted:index])
+                slot.emitted = len(text)
+                return True
+
+        # Hold back a tail that could still turn into a stop string
+        hold = 0
+        for stop in request.stop:
+            for k in range(min(len(stop) - 1, len(text)), 0, -1):
+                if text.endswith(stop[:k]):
+                    hold = max(hold, k)
+                    break
+        safe = len(text) - hold
+        if safe > slot.emitted:
+            request.put(text[slot.emitted:safe])
+            slot.emitted = safe
+        return False
+
+    def _finish(self, slot, error=None):
+        request = slot.request
+        if error is None and slot.emitted < len(slot.text) and not request.cancelled:
+            request.put(slot.text[slot.emitted:])
+        request.finish(error)
+        slot.request = None
+        slot.pending = []
+        slot.last_used = time.perf_counter()
+
+    def abort_all(self, error):
+        for slot in self.slots:
+            if slot.request is not None:
+                self._finish(slot, error)
+            # The failed batch may have left partial cells behind
+            self._seq_rm(slot.seq_id, -1, -1)
+            slot.tokens = []
+            slot.session_key = None
+
+    def close(self):
+        self.llama_cpp.llama_batch_free(self.batch)
+        self.llama_cpp.llama_free(self.ctx)
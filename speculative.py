@@ -0,0 +1,150 @@
+# /speculative.py
+
+# Speculative decoding for the GGUF chat model. llama-cpp-python verifies every drafted
+# token against the main model's own sample at that position and keeps only the matching
+# run, so the output distribution is unchanged; drafting only saves main-model passes.
+#
+# ModelConfig.params["speculative"]:
+#   {"mode": "prompt_lookup", "num_pred_tokens": 10, "max_ngram_size": 2}
+#   {"mode": "draft", "path": "gguf/<small model>.gguf", "num_pred_tokens": 4, "n_ctx": 2048}
+
+import os
+import threading
+
+import metrics
+
+try:
+    from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+except ImportError:
+    LlamaDraftModel = object
+    LlamaPromptLookupDecoding = None
+
+
+class CountingDraftModel(LlamaDraftModel):
+    # Wraps a draft model and infers how many of its tokens the main model accepted.
+    # Llama.generate calls the draft with the full sequence so far; between two calls of one
+    # generation the sequence grows by the accepted drafts plus the main model's own token.
+    # The last round of each completion is never observed, so the counts run slightly low.
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+        self._last_len = None
+        self._last_drafted = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids, **kwargs):
+        length = len(input_ids)
+        with self._lock:
+            if self._last_len is not None:
+                accepted = length - self._last_len - 1
+                # A shorter or much longer input means a new completion started
+                if 0 <= accepted <= self._last_drafted:
+                    self.rounds += 1
+                    self.proposed += self._last_drafted
+                    self.accepted += accepted
+                    metrics.counter("chat_draft_tokens_proposed_total").inc(self._last_drafted)
+                    metrics.counter("chat_draft_tokens_accepted_total").inc(accepted)
+
+        drafted = self.inner(input_ids, **kwargs)
+        with self._lock:
+            self._last_len = length
+            self._last_drafted = len(drafted)
+        return drafted
+
+    def stats(self):
+        with self._lock:
+            return {
+                "draft": type(self.inner).__name__,
+                "rounds": self.rounds,
+                "proposed": self.proposed,
+                "accepted": self.accepted,
+                "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+                "accepted_per_round": self.accepted / self.rounds if self.rounds else 0.0
+            }
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    # Greedy drafts from a small GGUF model that shares the main model's vocabulary
+
+    def __init__(self, model, num_pred_tokens=4):
+        import numpy as np
+
+        self.np = np
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+        ctx = model._ctx
+        self._seq_rm = getattr(ctx, "memory_seq_rm", None) or getattr(ctx, "kv_cache_seq_rm")
+
+    def __call__(self, input_ids, **kwargs):
+        np = self.np
+        model = self.model
+        tokens = input_ids.tolist()
+        if len(tokens) + self.num_pred_tokens >= model.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Keep the draft context's matching prefix, as the main model does
+        cached = model.input_ids[:model.n_tokens].tolist()
+        common = 0
+        for a, b in zip(cached, tokens):
+            if a != b:
+                break
+            common += 1
+        # The last token is always re-evaluated so its logits are fresh
+        common = min(common, len(tokens) - 1)
+        model.n_tokens = common
+        self._seq_rm(-1, common, -1)
+        model.eval(tokens[common:])
+
+        drafted = []
+        for _ in range(self.num_pred_tokens):
+            token = int(np.argmax(model.scores[model.n_tokens - 1]))
+            if token == model.token_eos():
+                break
+            drafted.append(token)
+            model.eval([token])
+        return np.array(drafted, dtype=np.intc)
+
+
+def make_draft_model(spec, main_params):
+    # Returns a CountingDraftModel for Llama(draft_model=...), or None when not configured
+    if not spec:
+        return None
+    if LlamaPromptLookupDecoding is None:
+        raise ImportError("This llama-cpp-python build has no speculative decoding support")
+
+    mode = spec.get("mode", "prompt_lookup")
+    if mode == "prompt_lookup":
+        inner = LlamaPromptLookupDecoding(
+            max_ngram_size=spec.get("max_ngram_size", 2),
+            num_pred_tokens=spec.get("num_pred_tokens", 10)
+        )
+    elif mode == "draft":
+        from llama_cpp import Llama
+
+        if not os.path.exists(spec["path"]):
+            raise FileNotFoundError(f"Draft GGUF model not found at {spec['path']}")
+        draft = Llama(
+            model_path=spec["path"],
+            n_ctx=spec.get("n_ctx", main_params.get("n_ctx", 2048)),
+            n_gpu_layers=spec.get("n_gpu_layers", 0),
+            n_threads=spec.get("n_threads"),
+            # Drafting reads the last row of scores, which llama-cpp-python only keeps with logits_all
+            logits_all=True,
+            verbose=False
+        )
+        inner = GGUFDraftModel(draft, spec.get("num_pred_tokens", 4))
+    else:
+        raise ValueError(f"Unknown speculative mode: {mode}")
+    return CountingDraftModel(inner)
+
+
+def check_vocab(model, draft_model):
+    # A separate draft model must tokenize exactly like the main one
+    inner = getattr(draft_model, "inner", None)
+    if isinstance(inner, GGUFDraftModel) and inner.model.n_vocab() != model.n_vocab():
+        raise ValueError(
+            f"Draft model vocabulary ({inner.model.n_vocab()}) doesn't match the chat model ({model.n_vocab()})"
+        )
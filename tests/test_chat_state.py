@@ -0,0 +1,71 @@
+# /tests/test_chat_state.py
+
+from chat_state import ChatStateStore
+from database import DatabaseManager
+
+
+def store(tmp_path, **kwargs):
+    return ChatStateStore(DatabaseManager(tmp_path / "chat.db"), **kwargs)
+
+
+def talk(states, token, *lines):
+    with states.use(token) as state:
+        state.history.extend(lines)
+    return state
+
+
+def test_least_recently_used_states_spill_by_count(tmp_path):
+    states = store(tmp_path, max_states=2)
+    for token in ("a", "b", "c"):
+        talk(states, token, f":User  hi from {token}")
+    states.get("b")
+    talk(states, "d", ":User  hi from d")
+
+    assert list(states._states) == ["b", "d"]
+    assert states.spilled == 2
+    assert states.db.take_client_state("a")["history"] == [":User  hi from a"]
+    assert states.db.take_client_state("c")["history"] == [":User  hi from c"]
+
+
+def test_states_spill_by_size(tmp_path):
+    states = store(tmp_path, max_bytes=2000)
+    talk(states, "a", "x" * 900)
+    talk(states, "b", "y" * 900)
+    assert list(states._states) == ["b"]
+    assert states.size == states._states["b"].nbytes <= 2000
+
+
+def test_pinned_states_are_not_spilled(tmp_path):
+    states = store(tmp_path, max_states=1)
+    with states.use("a") as a:
+        a.history.append(":User  still typing")
+        talk(states, "b", ":User  hello")
+        # The turn in progress stays; the idle one goes instead
+        assert list(states._states) == ["a"]
+    assert states.db.take_client_state("b")["history"] == [":User  hello"]
+    assert states.get("a") is a
+
+
+def test_spilled_state_comes_back_and_leaves_the_database(tmp_path):
+    states = store(tmp_path, max_states=1)
+    a = talk(states, "a", ":User  hi", "Chatbot: hello")
+    a.session_id = 7
+    a.session_name = "Mine"
+    talk(states, "b", ":User  other")
+
+    back = states.get("a")
+    assert back is not a
+    assert (back.history, back.session_key, back.session_id, back.session_name) == \
+        (a.history, a.session_key, 7, "Mine")
+    assert states.rehydrated == 1
+    # Resident again; the spilled row was taken, "b" took its place
+    assert states.db.take_client_state("a") is None
+    assert states.db.take_client_state("b") is not None
+
+
+def test_empty_conversations_are_not_spilled(tmp_path):
+    states = store(tmp_path, max_states=1)
+    states.get("a")
+    talk(states, "b", ":User  hi")
+    assert states.spilled == 0
+    assert states.db.take_client_state("a") is None
@@ -0,0 +1,63 @@
+# /tests/test_chat_writer.py
+
+from chat_state import ChatState
+from chat_writer import ChatWriter
+from database import DatabaseManager
+
+
+def turn(text):
+    return [{"role": "user", "content": text}, {"role": "assistant", "content": f"re: {text}"}]
+
+
+def test_turns_are_group_committed(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    session_id = db.create_chat_session("s1", "Default", "Guest")
+    state = ChatState("tok", session_id=session_id)
+    writer = ChatWriter(db, interval=0.5)
+    for i in range(5):
+        writer.append(state, turn(str(i)), "Default", "Guest")
+    writer.flush()
+
+    assert writer.stats()["backlog"] == 0
+    assert writer.commits == 1
+    assert writer.written == 5
+    assert [m["content"] for m in db.load_chat_messages(session_id)][-2:] == ["4", "re: 4"]
+    assert db.count_chat_messages(session_id) == 10
+    writer.shutdown()
+    db.close()
+
+
+def test_unsaved_conversation_creates_its_session_once(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    state = ChatState("tok", session_name="hello · abc123")
+    writer = ChatWriter(db, interval=0.5)
+    writer.append(state, turn("a"), "Default", "Guest")
+    writer.append(state, turn("b"), "Default", "Guest")
+    writer.flush()
+
+    assert [row[1] for row in db.list_chat_sessions()] == ["hello · abc123"]
+    assert state.session_id == db.list_chat_sessions()[0][0]
+    assert db.count_chat_messages(state.session_id) == 4
+    writer.shutdown()
+    db.close()
+
+
+def test_failed_turn_does_not_take_the_group_with_it(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    session_id = db.create_chat_session("s1", "Default", "Guest")
+    good = ChatState("a", session_id=session_id)
+    # Foreign keys reject messages for a session that doesn't exist
+    bad = ChatState("b", session_id=session_id + 100)
+    writer = ChatWriter(db, interval=0.5)
+    writer.append(good, turn("1"), "Default", "Guest")
+    writer.append(bad, turn("lost"), "Default", "Guest")
+    writer.append(good, turn("2"), "Default", "Guest")
+    writer.flush()
+
+    stats = writer.stats()
+    assert stats["failed"] == 1
+    assert stats["turns_written"] == 2
+    assert stats["backlog"] == 0
+    assert [m["content"] for m in db.load_chat_messages(session_id)] == ["1", "re: 1", "2", "re: 2"]
+    writer.shutdown()
+    db.close()
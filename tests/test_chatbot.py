@@ -0,0 +1,25 @@
+# /tests/test_chatbot.py
+
+from benchmarks.stubs import StubModelLoader
+from chat_state import ChatState
+from chatbot import AIChatbot
+from database import DatabaseManager
+from profile_manager import ProfileManager
+
+
+def test_saving_a_named_session_does_not_duplicate_queued_turns(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    bot = AIChatbot(ProfileManager(db), model_loader=StubModelLoader(), autosave=True)
+    state = ChatState("tok")
+    bot.respond("first", state)
+    bot.save_chat_history("Mine", state)
+    bot.respond("second", state)
+    # The second turn may still be queued in the writer
+    bot.save_chat_history("Mine", state)
+    bot.writer.flush()
+
+    assert [row[1] for row in db.list_chat_sessions()] == ["Mine"]
+    assert db.count_chat_messages(state.session_id) == 4
+    bot.scheduler.shutdown()
+    bot.writer.shutdown()
+    db.close()
@@ -0,0 +1,51 @@
+# /tests/test_context_window.py
+
+from context_window import ContextWindow
+
+# 39 chars: 9 tokens with the len // 4 fallback, 10 with the joining newline
+TURN = "x" * 39
+
+
+def cost(window, lines):
+    return sum(window.count_tokens(line) + 1 for line in lines)
+
+
+def test_history_that_fits_is_unchanged():
+    window = ContextWindow(max_tokens=100)
+    turns = [TURN] * 10
+    assert window.window_start(turns) == 0
+    assert window.render(turns, 0) == turns
+
+
+def test_overflow_slides_down_to_the_low_water_mark():
+    window = ContextWindow(max_tokens=100)
+    turns = [f"{i:02d}" + TURN[2:] for i in range(20)]
+    start = window.window_start(turns)
+
+    rendered = window.render(turns, start)
+    assert rendered[0] == "[14 earlier messages omitted]"
+    assert rendered[1:] == turns[14:]
+    assert cost(window, rendered) <= 75
+    # One turn fewer dropped would be over the mark
+    assert cost(window, window.render(turns, start - 1)) > 75
+
+
+def test_fold_marker_counts_against_the_budget():
+    turns = [TURN] * 12
+    # The ten kept turns fill the budget exactly, so only the marker doesn't fit
+    assert ContextWindow(max_tokens=100, fold_dropped=False).window_start(turns, start=2) == 2
+
+    window = ContextWindow(max_tokens=100)
+    start = window.window_start(turns, start=2)
+    assert start > 2
+    assert cost(window, window.render(turns, start)) <= 100
+
+
+def test_window_holds_still_while_new_turns_fit():
+    window = ContextWindow(max_tokens=100)
+    turns = [TURN] * 20
+    start = window.window_start(turns)
+    turns.append(TURN)
+    assert window.window_start(turns, start=start) == start
+    # A smaller budget for this prompt still applies
+    assert window.window_start(turns, budget=50, start=start) > start
@@ -0,0 +1,123 @@
+# /tests/test_database.py
+
+import json
+import sqlite3
+
+from database import DatabaseManager
+
+
+def make_v0_database(path):
+    # The original schema: messages stored as a JSON blob on the session row, user_version 0
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE chatbot_profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE user_profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            data TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_name TEXT UNIQUE NOT NULL,
+            chatbot_profile_id INTEGER NOT NULL,
+            user_profile_id INTEGER NOT NULL,
+            messages TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO chatbot_profiles (name, data) VALUES ('Default', '{}');
+        INSERT INTO user_profiles (name, data) VALUES ('Guest', '{}');
+    ''')
+    history = [":User  hi", "Chatbot: hello", {"role": "user", "content": "bye"}, "[note]"]
+    conn.execute('''
+        INSERT INTO chat_sessions (session_name, chatbot_profile_id, user_profile_id, messages)
+        VALUES ('old', 1, 1, ?), ('empty', 1, 1, '[]')
+    ''', (json.dumps(history),))
+    conn.commit()
+    conn.close()
+
+
+def test_migration_moves_json_messages_into_rows(tmp_path):
+    path = tmp_path / "v0.db"
+    make_v0_database(path)
+
+    db = DatabaseManager(path)
+    session_id = db.conn.execute("SELECT id FROM chat_sessions WHERE session_name = 'old'").fetchone()[0]
+    messages = [(m["seq"], m["role"], m["content"]) for m in db.load_chat_messages(session_id)]
+    assert messages == [
+        (0, "user", "hi"),
+        (1, "assistant", "hello"),
+        (2, "user", "bye"),
+        (3, "system", "[note]")
+    ]
+    assert db.conn.execute("SELECT DISTINCT messages FROM chat_sessions").fetchall() == [("[]",)]
+    assert db.conn.execute("PRAGMA user_version").fetchone()[0] > 0
+    # Migrated messages are searchable
+    assert [r["session_id"] for r in db.search_messages("bye")] == [session_id]
+    db.close()
+
+    # Opening the file again doesn't migrate twice
+    DatabaseManager._initialized.discard(str(path.resolve()))
+    db = DatabaseManager(path)
+    assert db.count_chat_messages(session_id) == 4
+    db.close()
+
+
+def test_save_rewrites_edited_earlier_messages(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    session_id = db.save_chat_session("s1", "Default", "Guest", [":User  hi", "Chatbot: hello"])
+    db.save_chat_session("s1", "Default", "Guest", [":User  HI", "Chatbot: hello", ":User  more"])
+
+    messages = [(m["role"], m["content"]) for m in db.load_chat_messages(session_id)]
+    assert messages == [("user", "HI"), ("assistant", "hello"), ("user", "more")]
+
+    # A shorter history replaces the longer one
+    db.save_chat_session("s1", "Default", "Guest", [":User  HI"])
+    assert db.count_chat_messages(session_id) == 1
+    db.close()
+
+
+def test_deleting_a_profile_keeps_its_sessions(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    db.save_profile("chatbot", "Aiko", {"name": "Aiko"})
+    session_id = db.save_chat_session("s1", "Aiko", "Guest", [":User  hi", "Chatbot: hello"])
+
+    db.delete_profile("chatbot", "Aiko")
+    assert db.get_profile("chatbot", "Aiko") is None
+    assert [row[1] for row in db.list_chat_sessions()] == ["s1"]
+    assert db.get_session(session_id)[2] == "Default"
+
+    # Foreign keys are enforced, so removing a session removes its messages
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+    assert db.count_chat_messages(session_id) == 0
+    db.close()
+
+
+def test_save_in_place_of_another_session(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    auto_id = db.save_chat_session("hi · 1a2b3c", "Default", "Guest", [":User  hi", "Chatbot: hello"])
+
+    # A free name renames the session
+    session_id = db.save_chat_session("Greeting", "Default", "Guest", [":User  hi", "Chatbot: hello"],
+                                      replace_session_id=auto_id)
+    assert session_id == auto_id
+    assert [row[1] for row in db.list_chat_sessions()] == ["Greeting"]
+
+    # A taken name is overwritten and the replaced session dropped with its messages
+    other_id = db.save_chat_session("other · 4d5e6f", "Default", "Guest", [":User  yo"])
+    session_id = db.save_chat_session("Greeting", "Default", "Guest", [":User  yo"],
+                                      replace_session_id=other_id)
+    assert session_id == auto_id
+    assert [row[1] for row in db.list_chat_sessions()] == ["Greeting"]
+    assert db.count_chat_messages(other_id) == 0
+    assert db.count_chat_messages(auto_id) == 1
+    db.close()
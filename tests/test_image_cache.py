@@ -0,0 +1,74 @@
+# /tests/test_image_cache.py
+
+import os
+
+from PIL import Image
+
+from database import DatabaseManager
+from image_cache import ImageCache
+
+
+def write(path, nbytes, mtime):
+    with open(path, "wb") as f:
+        f.write(b"\0" * nbytes)
+    os.utime(path, (mtime, mtime))
+
+
+def render(cache, db, key, mtime):
+    # A cached image as ImageWriter leaves it: file, thumbnail and history row
+    path = cache.path_for(key)
+    Image.new("RGB", (64, 64), (len(key), 0, 0)).save(path)
+    write(cache.thumbnail_path(path), 500, mtime)
+    os.utime(path, (mtime, mtime))
+    db.save_image_metadata(key, "", "stable_diffusion", {}, path, content_key=key,
+                           thumbnail_path=cache.thumbnail_path(path))
+    cache.add(path)
+    return path
+
+
+def test_thumbnails_count_toward_the_bound(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    cache = ImageCache(db, str(tmp_path / "images"), max_bytes=2500)
+    a = cache.path_for("a")
+    write(a, 1000, 100)
+    write(cache.thumbnail_path(a), 500, 100)
+    cache.add(a)
+    assert cache.size == 1500
+
+    b = cache.path_for("b")
+    write(b, 1000, 200)
+    write(cache.thumbnail_path(b), 500, 200)
+    cache.add(b)
+    assert cache.size == 1500 <= cache.max_bytes
+    assert not os.path.exists(a) and not os.path.exists(cache.thumbnail_path(a))
+    assert os.path.exists(b) and os.path.exists(cache.thumbnail_path(b))
+    db.close()
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    cache = ImageCache(db, str(tmp_path / "images"), max_bytes=10 ** 6)
+    paths = [render(cache, db, key, mtime) for key, mtime in (("a", 100), ("b", 200), ("c", 300))]
+    # A cache hit makes the oldest one the most recently used
+    assert cache.lookup("a") is not None
+
+    cache.max_bytes = cache.size - 1
+    cache.evict()
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    assert cache.lookup("b") is None
+    assert db.find_image("a") is not None
+    db.close()
+
+
+def test_reopened_cache_counts_thumbnails_and_drops_orphans(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    output_dir = str(tmp_path / "images")
+    cache = ImageCache(db, output_dir)
+    render(cache, db, "a", 100)
+    orphan = os.path.join(cache.thumbnail_dir, "gone.jpg")
+    write(orphan, 500, 100)
+
+    reopened = ImageCache(db, output_dir)
+    assert reopened.size == cache.size
+    assert not os.path.exists(orphan)
+    db.close()
@@ -0,0 +1,57 @@
+# /tests/test_kv_cache.py
+
+from benchmarks.stubs import StubState
+from kv_cache import SessionStateCache
+
+KB = 1024
+
+
+def state(n_tokens):
+    # llama_state_size is 1 KB per token
+    return StubState(range(n_tokens))
+
+
+def test_evicted_states_spill_and_come_back(tmp_path):
+    cache = SessionStateCache(max_bytes=10 * KB, spill_dir=tmp_path)
+    cache.put("a", state(6))
+    cache.put("b", state(6))
+    assert "a" in cache and cache.disk_size > 0
+    assert cache.get("a").tokens == list(range(6))
+    # Read back into memory, which spilled "b" in turn
+    assert list(cache._spilled) == [cache._spill_path("b")]
+
+
+def test_spill_directory_is_bounded(tmp_path):
+    cache = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path)
+    cache.put("probe", state(6))
+    cache.put("probe-2", state(6))
+    file_size = cache.disk_size
+
+    cache = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path / "capped", max_disk_bytes=3 * file_size)
+    for i in range(6):
+        cache.put(f"session-{i}", state(6))
+    assert cache.disk_size == 3 * file_size
+    assert sum(p.stat().st_size for p in (tmp_path / "capped").glob("*.state")) == cache.disk_size
+    # Least recently spilled first
+    assert "session-0" not in cache and "session-4" in cache
+
+
+def test_startup_prunes_files_of_earlier_runs(tmp_path):
+    cache = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path)
+    for i in range(4):
+        cache.put(f"session-{i}", state(6))
+    spilled = cache.disk_size
+
+    cache = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path, max_disk_bytes=spilled // 2)
+    assert 0 < cache.disk_size <= spilled // 2
+    assert len(list(tmp_path.glob("*.state"))) == len(cache._spilled)
+    assert cache.get("session-2") is not None
+
+
+def test_states_of_another_model_are_not_loaded(tmp_path):
+    cache = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path, namespace="model-a")
+    cache.put("s", state(6))
+    cache.put("t", state(6))
+
+    other = SessionStateCache(max_bytes=1 * KB, spill_dir=tmp_path, namespace="model-b")
+    assert "s" not in other and other.get("s") is None
@@ -0,0 +1,34 @@
+# /tests/test_metrics.py
+
+import metrics
+
+
+def test_prometheus_rendering(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", True)
+    registry = metrics.Registry()
+    registry.counter("requests_total", "Requests").inc(2, path='a"b\\c\nd')
+    registry.histogram("latency_seconds", buckets=(0.1, 1.0)).observe(0.5)
+
+    lines = registry.render_prometheus().splitlines()
+    assert "# HELP requests_total Requests" in lines
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{path="a\\"b\\\\c\\nd"} 2' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 1' in lines
+    assert "latency_seconds_sum 0.5" in lines
+    assert "latency_seconds_count 1" in lines
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "_enabled", False)
+    before = len(metrics.REGISTRY.metrics())
+    metrics.counter("disabled_total").inc()
+    metrics.histogram("disabled_seconds").observe(1.0)
+    with metrics.span("disabled_span"):
+        pass
+
+    assert metrics.counter("disabled_total") is metrics._NOOP
+    assert len(metrics.REGISTRY.metrics()) == before
+    assert metrics.REGISTRY.render_prometheus().find("disabled") == -1
@@ -0,0 +1,40 @@
+# /tests/test_model_loader.py
+
+import pytest
+
+from model_loader import MB, ModelLoader
+
+
+def refuse():
+    raise RuntimeError("Pipeline is in use and cannot be unloaded")
+
+
+def test_external_model_that_refuses_to_unload_stays_counted():
+    loader = ModelLoader(memory_budget_mb=100)
+    # Not busy when checked, but in use by the time it is closed
+    loader.reserve("image:a", 60 * MB, unload=refuse)
+
+    with pytest.raises(MemoryError):
+        loader.reserve("image:b", 60 * MB, unload=lambda: None)
+    assert loader.model_sizes["image:a"] == 60 * MB
+    assert loader.resident_bytes == 60 * MB
+
+
+def test_busy_external_model_is_not_unloaded():
+    loader = ModelLoader(memory_budget_mb=100)
+    unloaded = []
+    loader.reserve("image:a", 60 * MB, unload=lambda: unloaded.append("a"), busy=lambda: True)
+
+    with pytest.raises(RuntimeError):
+        loader.unload_model("image:a")
+    assert unloaded == [] and "image:a" in loader.loaded_models
+
+
+def test_idle_external_model_is_evicted_for_another():
+    loader = ModelLoader(memory_budget_mb=100)
+    unloaded = []
+    loader.reserve("image:a", 60 * MB, unload=lambda: unloaded.append("a"))
+    loader.reserve("image:b", 60 * MB, unload=lambda: unloaded.append("b"))
+
+    assert unloaded == ["a"]
+    assert list(loader.loaded_models) == ["image:b"]
@@ -0,0 +1,45 @@
+# /tests/test_profile_manager.py
+
+from chat_state import ChatState
+from chat_writer import ChatWriter
+from database import DatabaseManager
+from profile_manager import ProfileManager
+
+
+def test_cached_profiles_are_handed_out_as_copies(tmp_path):
+    pm = ProfileManager(DatabaseManager(tmp_path / "chat.db"))
+    pm.save_profile("chatbot", "Aiko", {"interests": ["tea"]})
+
+    data = pm.get_profile_data("chatbot", "Aiko")
+    data["interests"].append("cats")
+    assert pm.get_profile_data("chatbot", "Aiko") == {"interests": ["tea"]}
+    assert pm.load_profile("chatbot", "Aiko")["data"] == {"interests": ["tea"]}
+
+
+def test_prompt_fragment_follows_the_current_profile(tmp_path):
+    pm = ProfileManager(DatabaseManager(tmp_path / "chat.db"))
+    data = {"mood": "calm"}
+    pm.set_current_profile("chatbot", "Aiko", data)
+    assert pm.get_prompt_fragment("chatbot") == '{"mood": "calm"}'
+
+    # Same dict, edited in place and set again
+    data["mood"] = "cheerful"
+    pm.set_current_profile("chatbot", "Aiko", data)
+    assert pm.get_prompt_fragment("chatbot") == '{"mood": "cheerful"}'
+
+    pm.save_profile("chatbot", "Aiko", {"mood": "sleepy"})
+    assert pm.get_prompt_fragment("chatbot") == '{"mood": "sleepy"}'
+
+
+def test_profiles_created_by_autosave_show_up(tmp_path):
+    db = DatabaseManager(tmp_path / "chat.db")
+    pm = ProfileManager(db)
+    assert "Aiko" not in pm.get_profile_options("chatbot")
+
+    writer = ChatWriter(db, profile_manager=pm)
+    writer.append(ChatState("tok", session_name="hi · abc123"), [{"role": "user", "content": "hi"}],
+                  "Aiko", "Guest")
+    writer.flush()
+    assert "Aiko" in pm.get_profile_options("chatbot")
+    writer.shutdown()
+    db.close()
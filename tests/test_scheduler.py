@@ -0,0 +1,86 @@
+# /tests/test_scheduler.py
+
+from collections import Counter
+import codecs
+import ctypes
+import types
+
+import numpy as np
+
+from scheduler import BatchDecoder, ChatRequest, _Slot
+
+
+def make_decoder(logits):
+    # A BatchDecoder over a stand-in llama.cpp context that returns fixed logits
+    values = (ctypes.c_float * len(logits))(*logits)
+    decoder = BatchDecoder.__new__(BatchDecoder)
+    decoder.np = np
+    decoder.llama_cpp = types.SimpleNamespace(
+        llama_get_logits_ith=lambda ctx, index: ctypes.cast(values, ctypes.POINTER(ctypes.c_float))
+    )
+    decoder.ctx = None
+    decoder.n_vocab = len(logits)
+    decoder.rng = np.random.default_rng(0)
+    return decoder
+
+
+def sample(decoder, n=300, history=(), **kwargs):
+    request = ChatRequest("s", "", **kwargs)
+    return Counter(decoder._sample(request, 0, list(history)) for _ in range(n))
+
+
+def test_repeat_penalty_applies_before_greedy_choice():
+    decoder = make_decoder([0.0, 2.0, 1.9])
+    assert sample(decoder, n=1, temperature=0) == {1: 1}
+    assert sample(decoder, n=1, history=[1], temperature=0, repeat_penalty=1.1) == {2: 1}
+
+
+def test_top_k_and_top_p_limit_the_candidates():
+    decoder = make_decoder([5.0, 4.0, 3.0, 2.0, 1.0])
+    assert set(sample(decoder, top_k=2, top_p=1.0, min_p=0.0, temperature=1.0)) == {0, 1}
+
+    # Untempered probabilities are about 0.67, 0.25, 0.04, 0.04
+    decoder = make_decoder([3.0, 2.0, 0.0, 0.0])
+    assert set(sample(decoder, top_k=0, top_p=0.5, min_p=0.0, temperature=1.0)) == {0}
+    assert set(sample(decoder, top_k=0, top_p=0.9, min_p=0.0, temperature=1.0)) == {0, 1}
+
+
+def test_min_p_filters_before_temperature():
+    # Tempered by 5 the other tokens would reach 0.55 of the top one; untempered they are
+    # at 0.05, below min_p, so a high temperature can't bring them back
+    decoder = make_decoder([3.0, 0.0, 0.0, 0.0])
+    assert set(sample(decoder, top_k=0, top_p=1.0, min_p=0.1, temperature=5.0)) == {0}
+    assert set(sample(decoder, top_k=0, top_p=1.0, min_p=0.0, temperature=5.0)) == {0, 1, 2, 3}
+
+
+def emit_all(pieces, stop):
+    decoder = BatchDecoder.__new__(BatchDecoder)
+    slot = _Slot(0)
+    request = slot.request = ChatRequest("s", "", stop=stop)
+    slot.utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    stopped = False
+    for piece in pieces:
+        stopped = decoder._emit(slot, piece)
+        if stopped:
+            break
+    decoder._finish(slot)
+    return list(request), stopped
+
+
+def test_stop_string_split_across_tokens_is_not_emitted():
+    deltas, stopped = emit_all([b"Hello", b" there\nUs", b"er:", b" more"], stop=["\nUser:"])
+    assert stopped
+    assert "".join(deltas) == "Hello there"
+    # The partial match was held back, not streamed and then taken back
+    assert deltas == ["Hello", " there"]
+
+
+def test_held_back_tail_is_released_when_it_isnt_a_stop():
+    deltas, stopped = emit_all([b"a\nU", b"h, well"], stop=["\nUser:"])
+    assert not stopped
+    assert deltas == ["a", "\nUh, well"]
+
+
+def test_multibyte_characters_split_across_tokens():
+    deltas, _ = emit_all([b"caf\xc3", b"\xa9!"], stop=[])
+    assert "".join(deltas) == "café!"
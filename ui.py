@@ -1,17 +1,54 @@
 # /ui.py
 
+import time
+
+STARTUP_STARTED = time.perf_counter()
+
 import gradio as gr
 from profile_manager import ProfileManager
 from chatbot import AIChatbot
 from database import DatabaseManager
+from image_generator import ImageGenerator
+from chat_state import ChatStateStore
+import atexit
 import json
 import os
+import threading
 from datetime import datetime
 
-# Initialize components
-pm = ProfileManager()
-chatbot = AIChatbot(pm)
-db = DatabaseManager()
+# Set by init_components(), not at import: chat worker processes are spawned and import
+# the main module again, and must not open a second app in there
+db = None
+pm = None
+chatbot = None
+chat_states = None
+
+def init_components():
+    # The chat model warms up in the background so the server binds immediately.
+    # Every module shares one DatabaseManager (one SQLite connection per worker thread).
+    global db, pm, chatbot, chat_states
+    db = DatabaseManager()
+    pm = ProfileManager(db)
+    chatbot = AIChatbot(pm, background=True, autosave=True)
+    # Each browser's conversation lives server-side under a token kept in the browser
+    chat_states = ChatStateStore(db)
+    atexit.register(chat_states.flush)
+
+IMAGE_PREVIEW_EVERY = 5
+
+# Image pipelines are only loaded once someone asks for an image, and dropped after 10 idle minutes
+image_generator = None
+image_generator_lock = threading.Lock()
+
+def get_image_generator():
+    global image_generator
+    with image_generator_lock:
+        if image_generator is None:
+            # Pipelines share the chat model's memory budget
+            image_generator = ImageGenerator(
+                background=True, db=db, idle_timeout=600, model_loader=chatbot.model_loader
+            )
+        return image_generator
 
 def create_profile_panel():
     with gr.Blocks(visible=False) as panel:
@@ -80,6 +117,21 @@ def create_session_panel():
                 filterable=True
             )
             session_name = gr.Textbox(label="New Session Name")
+        with gr.Row():
+            session_search = gr.Textbox(
+                label="Search Sessions",
+                placeholder="Start of a session name..."
+            )
+            more_sessions = gr.Button("More...", variant="secondary")
+        # Choices loaded so far and the keyset cursor for the next page
+        session_page_state = gr.State(None)
+        with gr.Row():
+            message_search = gr.Textbox(
+                label="Search Conversations",
+                placeholder="Words from past messages..."
+            )
+            message_search_btn = gr.Button("🔍", elem_classes="refresh-btn")
+        message_results = gr.Markdown()
         with gr.Row():
             save_session = gr.Button("💾 Save Current", variant="primary")
             load_session = gr.Button("📂 Load Selected", variant="secondary")
@@ -93,12 +145,55 @@ def create_session_panel():
         return panel, {
             "session_dd": session_dd,
             "session_name": session_name,
+            "search": session_search,
+            "more_btn": more_sessions,
+            "page": session_page_state,
+            "message_search": message_search,
+            "message_search_btn": message_search_btn,
+            "message_results": message_results,
             "save_btn": save_session,
             "load_btn": load_session,
             "delete_btn": delete_session,
             "session_info": session_info
         }
 
+def create_image_panel():
+    with gr.Blocks(visible=False) as panel:
+        with gr.Row():
+            with gr.Column():
+                image_prompt = gr.Textbox(label="Prompt", lines=3)
+                image_negative = gr.Textbox(label="Negative Prompt", value="ugly, deformed, cartoonish")
+                image_model = gr.Dropdown(
+                    label="Model",
+                    choices=["stable_diffusion", "waifu_diffusion"],
+                    value="stable_diffusion"
+                )
+                with gr.Row():
+                    image_steps = gr.Slider(1, 100, value=30, step=1, label="Steps")
+                    image_cfg = gr.Slider(1.0, 20.0, value=7.5, step=0.5, label="CFG Scale")
+                image_seed = gr.Number(label="Seed (blank for random)", precision=0)
+                with gr.Row():
+                    image_generate = gr.Button("🎨 Generate", variant="primary")
+                    image_cancel = gr.Button("Cancel", variant="secondary")
+            with gr.Column():
+                image_output = gr.Image(label="Result", type="pil")
+                image_status = gr.Markdown()
+        image_history = gr.Gallery(label="Recent Images", columns=6, height=240)
+
+        return panel, {
+            "prompt": image_prompt,
+            "negative": image_negative,
+            "model": image_model,
+            "steps": image_steps,
+            "cfg": image_cfg,
+            "seed": image_seed,
+            "generate_btn": image_generate,
+            "cancel_btn": image_cancel,
+            "output": image_output,
+            "status": image_status,
+            "history": image_history
+        }
+
 def refresh_profiles():
     return [
         gr.update(choices=pm.get_profile_options('chatbot')),
@@ -119,150 +214,340 @@ def handle_profile_delete(entity_type, name):
     except Exception as e:
         return str(e), False
 
-def handle_session_save(name, history):
+SESSION_PAGE_SIZE = 50
+
+def session_page(query="", page=None):
+    # First page of matching sessions, or the one after `page` when paging on
+    after = page["after"] if page else None
+    rows = pm.list_chat_sessions(limit=SESSION_PAGE_SIZE, after=after, query=query or None)
+    choices = (page["choices"] if page else []) + [f"{s[1]} ({s[0]})" for s in rows]
+    if rows:
+        after = (rows[-1][5], rows[-1][0])
+    return gr.update(choices=choices), {"choices": choices, "after": after}
+
+def handle_message_search(text):
+    # Ranked snippets; the matching sessions become the dropdown choices so they can be loaded
+    results = pm.search_chat_history(text)
+    if not results:
+        return "No matching messages.", gr.update()
+    lines = [f"- **{r['session_name']}** ({r['role']}): {r['snippet']}" for r in results]
+    choices = list(dict.fromkeys(f"{r['session_name']} ({r['session_id']})" for r in results))
+    return "\n".join(lines), gr.update(choices=choices)
+
+def handle_session_save(name, token):
     if not name:
-        return "Session name required!", None
+        return "Session name required!", gr.update(), gr.update()
     try:
-        pm.save_chat_session(name, history)
-        sessions = pm.load_chat_sessions()
-        choices = [f"{s[1]} ({s[0]})" for s in sessions]
-        return f"Session '{name}' saved!", gr.update(choices=choices)
+        with chat_states.use(token) as state:
+            chatbot.save_chat_history(name, state)
+        choices, page = session_page()
+        return f"Session '{name}' saved!", choices, page
     except Exception as e:
-        return str(e), None
+        return str(e), gr.update(), gr.update()
 
-def handle_session_load(session_str):
+def handle_session_load(session_str, token):
     try:
         session_id = int(session_str.split("(")[-1].rstrip(")"))
-        messages = pm.load_chat_history(session_id)
-        session_info = next(s for s in pm.load_chat_sessions() if s[0] == session_id)
+        with chat_states.use(token) as state:
+            chatbot.load_chat_history(session_id, state)
+            pairs = chatbot.get_chat_pairs(state)
+        session_info = pm.get_session(session_id)
         return (
-            messages,
+            pairs,
             gr.update(value=json.dumps(session_info, default=str)),
             ""
         )
     except Exception as e:
         return [], gr.update(), str(e)
 
-with gr.Blocks(
-    title="AI Waifu Companion",
-    css="""
-    .refresh-btn {max-width: 2em; min-width: 2em !important;}
-    .panel {border: 1px solid #666; padding: 1em; margin: 1em 0;}
-    """
-) as ui:
-    # State management
-    current_chat = gr.State([])
-    active_panel = gr.State("chat")
-
-    # Profile panel components
-    profile_panel, profile_comps = create_profile_panel()
-    
-    # Session panel components
-    session_panel, session_comps = create_session_panel()
-
-    # Main chat interface
-    with gr.Column(visible=True) as chat_interface:
-        chatbot_display = gr.Chatbot(
-            label="Conversation History",
-            height=600,
-            show_label=True
-        )
-        msg_input = gr.Textbox(
-            label="Your Message",
-            placeholder="Type your message here...",
-            lines=3
-        )
-        control_row = gr.Row():
-            send_btn = gr.Button("Send", variant="primary")
-            session_btn = gr.Button("Sessions", variant="secondary")
-            profile_btn = gr.Button("Profiles", variant="secondary")
-            clear_btn = gr.Button("Clear Chat", variant="stop")
-
-    # Event handlers
-    profile_btn.click(
-        lambda: [
-            gr.update(visible=False),
-            gr.update(visible=True),
-            gr.update(visible=False)
-        ],
-        outputs=[chat_interface, profile_panel, session_panel]
-    ).then(
-        refresh_profiles,
-        outputs=[profile_comps["chatbot_dd"], profile_comps["user_dd"]]
+def model_status():
+    if not chatbot.ready.is_set():
+        waited = time.perf_counter() - STARTUP_STARTED
+        return f"⏳ Loading chat model... ({waited:.0f}s)", gr.update()
+    if chatbot.load_error:
+        return f"⚠️ Chat model failed to load: {chatbot.load_error}", gr.Timer(active=False)
+
+    cold_start = chatbot.ready_at - STARTUP_STARTED
+    return (
+        f"✅ Chat model ready (cold start {cold_start:.1f}s, model load {chatbot.load_seconds:.1f}s)",
+        gr.Timer(active=False)
     )
 
-    session_btn.click(
-        lambda: [
-            gr.update(visible=False),
-            gr.update(visible=False),
-            gr.update(visible=True)
-        ],
-        outputs=[chat_interface, profile_panel, session_panel]
-    ).then(
-        lambda: gr.update(choices=[
-            f"{s[1]} ({s[0]})" for s in pm.load_chat_sessions()
-        ]),
-        outputs=session_comps["session_dd"]
+def handle_client_load(token):
+    # A returning browser gets its conversation back, from memory or SQLite
+    token = token or chat_states.new_token()
+    with chat_states.use(token) as state:
+        return token, chatbot.get_chat_pairs(state)
+
+def handle_send(msg, token):
+    # The browser sends only its token and the new message; streamed updates go out as diffs
+    with chat_states.use(token) as state:
+        history = chatbot.get_chat_pairs(state) + [[msg, ""]]
+        yield history
+        reply = ""
+        for delta in chatbot.respond_stream(msg, state):
+            reply += delta
+            history[-1][1] = reply.lstrip()
+            yield history
+
+def handle_stop(token):
+    chatbot.cancel(chat_states.get(token))
+
+def handle_image_generate(prompt, negative_prompt, model_name, steps, cfg_scale, seed):
+    # The render runs on the image worker; this handler only polls its job and streams previews
+    if not prompt:
+        yield None, "Prompt required!"
+        return
+    ig = get_image_generator()
+    job = ig.submit(
+        prompt,
+        negative_prompt=negative_prompt,
+        model_name=model_name,
+        steps=steps,
+        cfg_scale=cfg_scale,
+        seed=int(seed) if seed not in (None, "") else None,
+        preview_every=IMAGE_PREVIEW_EVERY
     )
+    shown_step = 0
+    try:
+        while not job.done():
+            position = ig.queue.position(job)
+            preview = gr.update()
+            if position is not None:
+                status = f"⏳ Queued ({position} ahead, {job.wait_time:.0f}s)"
+            elif not ig.is_loaded(model_name):
+                status = f"⏳ Loading {model_name}..."
+            else:
+                status = f"🎨 Rendering... step {job.preview_step}/{job.steps}"
+                if job.preview_step != shown_step:
+                    shown_step = job.preview_step
+                    preview = job.preview
+            yield preview, status
+            job.wait(1.0)
+        image, path = job.result()
+        source = "cached" if job.cached else f"batch of {job.batch_size}, {ig.profile.name}"
+        yield image, f"✅ Saved to {path} (seed {job.seed}, {source})"
+    except Exception as e:
+        yield gr.update(), str(e)
+    finally:
+        # Leaving early (Cancel or a closed tab) drops the job or stops it at the next step
+        job.cancel()
+
+def image_history(limit=24):
+    # Thumbnails only; rows written before thumbnails existed fall back to the full image
+    rows = db.get_generation_history(limit)
+    return [
+        (thumbnail or path, prompt)
+        for prompt, model, path, created_at, thumbnail in rows
+        if os.path.exists(thumbnail or path)
+    ]
+
+def handle_clear(token):
+    with chat_states.use(token) as state:
+        chatbot.reset_chat(state)
+    return []
+
+def build_ui():
+    init_components()
+    with gr.Blocks(
+        title="AI Waifu Companion",
+        css="""
+        .refresh-btn {max-width: 2em; min-width: 2em !important;}
+        .panel {border: 1px solid #666; padding: 1em; margin: 1em 0;}
+        """
+    ) as ui:
+        # State management; BrowserState keeps the token across page reloads where Gradio supports it
+        client_token = getattr(gr, "BrowserState", gr.State)(None)
+        active_panel = gr.State("chat")
+
+        # Profile panel components
+        profile_panel, profile_comps = create_profile_panel()
+    
+        # Session panel components
+        session_panel, session_comps = create_session_panel()
+
+        # Image panel components
+        image_panel, image_comps = create_image_panel()
+
+        # Main chat interface
+        with gr.Column(visible=True) as chat_interface:
+            status_md = gr.Markdown("⏳ Loading chat model...")
+            status_timer = gr.Timer(1.0)
+            chatbot_display = gr.Chatbot(
+                label="Conversation History",
+                height=600,
+                show_label=True
+            )
+            msg_input = gr.Textbox(
+                label="Your Message",
+                placeholder="Type your message here...",
+                lines=3
+            )
+            with gr.Row() as control_row:
+                send_btn = gr.Button("Send", variant="primary")
+                stop_btn = gr.Button("Stop", variant="secondary")
+                session_btn = gr.Button("Sessions", variant="secondary")
+                profile_btn = gr.Button("Profiles", variant="secondary")
+                image_btn = gr.Button("Images", variant="secondary")
+                clear_btn = gr.Button("Clear Chat", variant="stop")
 
-    # Profile save handlers
-    for entity in ["chatbot", "user"]:
-        profile_comps[f"{entity}_save"].click(
-            lambda e=entity: handle_profile_save(
-                e,
-                profile_comps[f"{entity}_name"].value,
-                profile_comps[f"{entity}_data"].value
-            ),
-            outputs=[gr.Markdown(), gr.JSON()]
+        # Event handlers
+        ui.load(
+            handle_client_load,
+            inputs=client_token,
+            outputs=[client_token, chatbot_display]
+        )
+
+        status_timer.tick(
+            model_status,
+            outputs=[status_md, status_timer]
+        )
+
+        profile_btn.click(
+            lambda: [
+                gr.update(visible=False),
+                gr.update(visible=True),
+                gr.update(visible=False),
+                gr.update(visible=False)
+            ],
+            outputs=[chat_interface, profile_panel, session_panel, image_panel]
         ).then(
             refresh_profiles,
             outputs=[profile_comps["chatbot_dd"], profile_comps["user_dd"]]
         )
 
-        profile_comps[f"{entity}_delete"].click(
-            lambda e=entity: handle_profile_delete(
-                e,
-                profile_comps[f"{entity}_dd"].value
-            ),
-            outputs=[gr.Markdown(), gr.JSON()]
+        session_btn.click(
+            lambda: [
+                gr.update(visible=False),
+                gr.update(visible=False),
+                gr.update(visible=True),
+                gr.update(visible=False)
+            ],
+            outputs=[chat_interface, profile_panel, session_panel, image_panel]
         ).then(
-            refresh_profiles,
-            outputs=[profile_comps["chatbot_dd"], profile_comps["user_dd"]]
+            session_page,
+            inputs=session_comps["search"],
+            outputs=[session_comps["session_dd"], session_comps["page"]]
         )
 
-    # Session handlers
-    session_comps["save_btn"].click(
-        handle_session_save,
-        inputs=[session_comps["session_name"], current_chat],
-        outputs=[gr.Markdown(), session_comps["session_dd"]]
-    )
+        image_btn.click(
+            lambda: [
+                gr.update(visible=False),
+                gr.update(visible=False),
+                gr.update(visible=False),
+                gr.update(visible=True)
+            ],
+            outputs=[chat_interface, profile_panel, session_panel, image_panel]
+        ).then(
+            image_history,
+            outputs=image_comps["history"]
+        )
 
-    session_comps["load_btn"].click(
-        handle_session_load,
-        inputs=session_comps["session_dd"],
-        outputs=[chatbot_display, session_comps["session_info"], gr.Markdown()]
-    ).then(
-        lambda x: x,
-        inputs=current_chat,
-        outputs=current_chat
-    )
+        # Profile save handlers
+        for entity in ["chatbot", "user"]:
+            profile_comps[f"{entity}_save"].click(
+                lambda e=entity: handle_profile_save(
+                    e,
+                    profile_comps[f"{entity}_name"].value,
+                    profile_comps[f"{entity}_data"].value
+                ),
+                outputs=[gr.Markdown(), gr.JSON()]
+            ).then(
+                refresh_profiles,
+                outputs=[profile_comps["chatbot_dd"], profile_comps["user_dd"]]
+            )
 
-    # Chat interaction
-    send_btn.click(
-        lambda msg, hist: hist + [(msg, chatbot.respond(msg))],
-        inputs=[msg_input, current_chat],
-        outputs=[chatbot_display, current_chat]
-    ).then(
-        lambda: "",
-        outputs=msg_input
-    )
+            profile_comps[f"{entity}_delete"].click(
+                lambda e=entity: handle_profile_delete(
+                    e,
+                    profile_comps[f"{entity}_dd"].value
+                ),
+                outputs=[gr.Markdown(), gr.JSON()]
+            ).then(
+                refresh_profiles,
+                outputs=[profile_comps["chatbot_dd"], profile_comps["user_dd"]]
+            )
 
-    clear_btn.click(
-        lambda: [],
-        outputs=[current_chat, chatbot_display]
-    )
+        # Session handlers
+        session_comps["search"].change(
+            session_page,
+            inputs=session_comps["search"],
+            outputs=[session_comps["session_dd"], session_comps["page"]]
+        )
+
+        for trigger in (session_comps["message_search"].submit, session_comps["message_search_btn"].click):
+            trigger(
+                handle_message_search,
+                inputs=session_comps["message_search"],
+                outputs=[session_comps["message_results"], session_comps["session_dd"]]
+            )
+
+        session_comps["more_btn"].click(
+            session_page,
+            inputs=[session_comps["search"], session_comps["page"]],
+            outputs=[session_comps["session_dd"], session_comps["page"]]
+        )
+
+        session_comps["save_btn"].click(
+            handle_session_save,
+            inputs=[session_comps["session_name"], client_token],
+            outputs=[gr.Markdown(), session_comps["session_dd"], session_comps["page"]]
+        )
+
+        session_comps["load_btn"].click(
+            handle_session_load,
+            inputs=[session_comps["session_dd"], client_token],
+            outputs=[chatbot_display, session_comps["session_info"], gr.Markdown()]
+        )
+
+        # Chat interaction
+        send_event = send_btn.click(
+            handle_send,
+            inputs=[msg_input, client_token],
+            outputs=chatbot_display
+        )
+        send_event.then(
+            lambda: "",
+            outputs=msg_input
+        )
+
+        # Stop decoding; the partial reply is still committed to the history
+        stop_btn.click(
+            handle_stop,
+            inputs=client_token,
+            cancels=[send_event]
+        )
+
+        # Image generation
+        image_event = image_comps["generate_btn"].click(
+            handle_image_generate,
+            inputs=[
+                image_comps["prompt"],
+                image_comps["negative"],
+                image_comps["model"],
+                image_comps["steps"],
+                image_comps["cfg"],
+                image_comps["seed"]
+            ],
+            outputs=[image_comps["output"], image_comps["status"]]
+        )
+        image_event.then(
+            image_history,
+            outputs=image_comps["history"]
+        )
+        image_comps["cancel_btn"].click(None, cancels=[image_event])
+
+        clear_btn.click(
+            handle_clear,
+            inputs=client_token,
+            outputs=chatbot_display
+        )
+    return ui
 
 if __name__ == "__main__":
+    ui = build_ui()
+    UI_BUILT_SECONDS = time.perf_counter() - STARTUP_STARTED
+    print(f"UI built in {UI_BUILT_SECONDS:.2f}s; chat model is warming up in the background")
     ui.launch(
         server_name="127.0.0.1",
         server_port=7860,
@@ -0,0 +1,387 @@
+# /worker_pool.py
+
+# Chat replicas in separate processes. Each worker loads the chat model with its own
+# ModelLoader, request scheduler and session state cache, pinned to its own slice of CPU
+# cores, and talks to the UI process over a local pipe. Sessions stick to one worker so
+# their KV state stays warm; a monitor thread pings the workers and restarts any that exit
+# or stop answering. WorkerPool has the same submit()/stats()/shutdown() surface as
+# RequestScheduler, so AIChatbot uses either one unchanged.
+#
+# Weights are mmapped, so replicas of the same GGUF file share their pages in memory.
+
+from collections import Counter, OrderedDict
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+from scheduler import ChatRequest
+import metrics
+
+
+def cpu_slices(replicas):
+    # Contiguous, equal core sets per replica; None where affinity can't be set
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return [None] * replicas
+    if replicas > len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(replicas)]
+    size = len(cpus) // replicas
+    return [cpus[i * size:(i + 1) * size] for i in range(replicas)]
+
+
+def _serve(conn, index, loader_class, overrides, cpus):
+    # Worker process entry point
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError, ValueError):
+                pass
+
+    try:
+        from chatbot import AIChatbot
+
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        loader = loader_class()
+        config = loader.model_configs["chat"]
+        params = config.params
+        params.update(overrides)
+        # This process is the replica
+        params["workers"] = 0
+        if params.get("state_cache_dir"):
+            params["state_cache_dir"] = os.path.join(params["state_cache_dir"], f"worker-{index}")
+        if cpus:
+            # Tuned settings apply, except that a replica only has its own cores
+            if params.get("autotune"):
+                from autotune import load_tuning
+                params.update(load_tuning(config.path))
+                params["autotune"] = False
+            params.update(n_threads=len(cpus), n_threads_batch=len(cpus))
+
+        bot = AIChatbot(None, model_loader=loader)
+        "".join(bot.scheduler.submit("warm-up", "Hello", max_tokens=1))
+    except Exception as e:
+        send("failed", f"{type(e).__name__}: {e}")
+        return
+    send("ready", bot.load_seconds)
+
+    requests = {}
+
+    def relay(request_id, request):
+        try:
+            for delta in request:
+                send("delta", request_id, delta)
+            send("done", request_id, None)
+        except Exception as e:
+            send("done", request_id, f"{type(e).__name__}: {e}")
+        finally:
+            requests.pop(request_id, None)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        kind = message[0]
+        if kind == "submit":
+            _, request_id, session_key, prompt, kwargs = message
+            try:
+                request = bot.scheduler.submit(session_key, prompt, **kwargs)
+            except Exception as e:
+                send("done", request_id, f"{type(e).__name__}: {e}")
+                continue
+            requests[request_id] = request
+            threading.Thread(target=relay, args=(request_id, request), daemon=True).start()
+        elif kind == "cancel":
+            request = requests.get(message[1])
+            if request:
+                request.cancel()
+        elif kind == "ping":
+            send("pong", message[1], bot.scheduler.stats())
+        elif kind == "stop":
+            break
+    bot.scheduler.shutdown()
+
+
+class RemoteChatRequest(ChatRequest):
+    # Filled by the pool's reader thread; cancelling also stops decoding in the worker
+    def __init__(self, worker, request_id, session_key, prompt, **kwargs):
+        super().__init__(session_key, prompt, **kwargs)
+        self.worker = worker
+        self.request_id = request_id
+
+    def cancel(self):
+        if not self.cancelled and self.finished_at is None:
+            self.worker.send("cancel", self.request_id)
+        super().cancel()
+
+
+class _Worker:
+    def __init__(self, index, cpus):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.ready = False
+        self.error = None  # last start failure, kept until a start succeeds
+        self.failures = 0
+        self.restarts = 0
+        self.started_at = 0.0
+        self.ready_at = 0.0
+        self.next_start = 0.0
+        self.last_pong = 0.0
+        self.load_seconds = None
+        self.stats = {}
+        self.requests = {}  # request_id -> RemoteChatRequest
+        self._send_lock = threading.Lock()
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def send(self, *message):
+        with self._send_lock:
+            try:
+                self.conn.send(message)
+                return True
+            except (AttributeError, OSError, EOFError, ValueError):
+                return False
+
+
+class WorkerPool:
+    def __init__(self, replicas=2, loader_class=None, overrides=None, health_interval=5.0,
+                 health_timeout=30.0, start_timeout=900.0, max_sessions=4096):
+        if loader_class is None:
+            from model_loader import ModelLoader
+            loader_class = ModelLoader
+        self.loader_class = loader_class
+        self.overrides = dict(overrides or {})
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.start_timeout = start_timeout
+        self.max_sessions = max_sessions
+        # spawn, not fork: the UI process has threads and native state a fork would copy mid-flight
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.RLock()
+        self._ids = itertools.count()
+        self._affinity = OrderedDict()  # session_key -> worker index, least recently used first
+        self._any_ready = threading.Event()
+        self._stop = threading.Event()
+        self._running = True
+
+        self.workers = [_Worker(i, cpus) for i, cpus in enumerate(cpu_slices(replicas))]
+        for worker in self.workers:
+            self._start(worker)
+
+        metrics.gauge("chat_workers_ready", "Chat worker processes serving requests",
+                      fn=lambda: sum(w.ready for w in self.workers))
+        metrics.gauge("chat_queue_depth", "Chat requests waiting for a slot", fn=lambda: self.queue_depth)
+
+        self._monitor_thread = threading.Thread(target=self._monitor, name="chat-worker-monitor", daemon=True)
+        self._monitor_thread.start()
+
+    def _start(self, worker):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_serve,
+            args=(child_conn, worker.index, self.loader_class, self.overrides, worker.cpus),
+            name=f"chat-worker-{worker.index}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = conn
+        worker.ready = False
+        worker.started_at = time.monotonic()
+        threading.Thread(
+            target=self._read, args=(worker, conn), name=f"chat-worker-{worker.index}-reader", daemon=True
+        ).start()
+
+    def _read(self, worker, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "delta":
+                request = worker.requests.get(message[1])
+                if request:
+                    request.put(message[2])
+            elif kind == "done":
+                request = worker.requests.pop(message[1], None)
+                if request:
+                    request.finish(RuntimeError(message[2]) if message[2] else None)
+            elif kind == "pong":
+                worker.last_pong = time.monotonic()
+                worker.stats = message[2]
+            elif kind == "ready":
+                worker.ready = True
+                worker.ready_at = time.monotonic()
+                worker.error = None
+                worker.failures = 0
+                worker.load_seconds = message[1]
+                worker.last_pong = time.monotonic()
+                self._any_ready.set()
+            elif kind == "failed":
+                worker.error = message[1]
+                print(f"Chat worker {worker.index} failed to start: {message[1]}")
+        with self._lock:
+            if worker.conn is conn:
+                worker.ready = False
+                self._fail_requests(worker, "exited")
+
+    def _fail_requests(self, worker, reason):
+        requests, worker.requests = worker.requests, {}
+        for request in requests.values():
+            request.finish(RuntimeError(f"Chat worker {worker.index} {reason}"))
+
+    def _stop_process(self, worker):
+        process, conn = worker.process, worker.conn
+        worker.process = worker.conn = None
+        worker.ready = False
+        if process is None:
+            return
+        if process.is_alive():
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        conn.close()
+
+    def _restart(self, worker, reason):
+        with self._lock:
+            if not self._running:
+                return
+            print(f"Restarting chat worker {worker.index}: {reason}")
+            metrics.counter("chat_worker_restarts_total", "Chat worker restarts").inc(reason=reason)
+            if worker.ready_at < worker.started_at and not worker.error:
+                # Died or hung before it was ever ready, e.g. killed while loading the model
+                exitcode = worker.process.exitcode if worker.process else None
+                worker.error = f"{reason} during start-up" + (f" (exit code {exitcode})" if exitcode else "")
+            self._fail_requests(worker, reason)
+            self._stop_process(worker)
+            worker.restarts += 1
+            if worker.error:
+                # A worker that can't load its model backs off instead of crash-looping
+                worker.next_start = time.monotonic() + min(300.0, 5.0 * 2 ** worker.failures)
+                worker.failures += 1
+            else:
+                self._start(worker)
+
+    def _monitor(self):
+        ping = itertools.count()
+        while not self._stop.wait(self.health_interval):
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None:
+                    if now >= worker.next_start:
+                        with self._lock:
+                            if self._running and worker.process is None:
+                                self._start(worker)
+                elif not worker.alive:
+                    self._restart(worker, "exited")
+                elif worker.ready and now - worker.last_pong > self.health_timeout:
+                    self._restart(worker, "unresponsive")
+                elif not worker.ready and now - worker.started_at > self.start_timeout:
+                    self._restart(worker, "start timeout")
+                elif worker.ready:
+                    worker.send("ping", next(ping))
+
+    def wait_ready(self, timeout=None):
+        # Returns once any replica can serve; raises if every replica failed to load, or
+        # none is ready after timeout (start_timeout by default)
+        deadline = time.monotonic() + (self.start_timeout if timeout is None else timeout)
+        while not self._any_ready.wait(0.5):
+            errors = [w.error for w in self.workers if w.error]
+            if len(errors) == len(self.workers):
+                raise RuntimeError(f"Chat workers failed to start: {errors[0]}")
+            if time.monotonic() > deadline:
+                raise TimeoutError("Chat workers are still loading.")
+
+    def _route(self, session_key):
+        with self._lock:
+            index = self._affinity.get(session_key)
+            if index is not None and self.workers[index].process is not None:
+                self._affinity.move_to_end(session_key)
+                return self.workers[index]
+
+            # New (or orphaned) session: the ready worker with the fewest sessions and requests
+            candidates = [w for w in self.workers if w.ready] or [w for w in self.workers if w.process]
+            if not candidates:
+                raise RuntimeError("No chat workers are running")
+            sessions = Counter(self._affinity.values())
+            worker = min(candidates, key=lambda w: (sessions[w.index], len(w.requests), w.index))
+            self._affinity[session_key] = worker.index
+            while len(self._affinity) > self.max_sessions:
+                self._affinity.popitem(last=False)
+            return worker
+
+    def submit(self, session_key, prompt, **kwargs):
+        if not self._running:
+            raise RuntimeError("Worker pool is shut down")
+        worker = self._route(session_key)
+        request = RemoteChatRequest(worker, next(self._ids), session_key, prompt, **kwargs)
+        worker.requests[request.request_id] = request
+        if not worker.send("submit", request.request_id, session_key, prompt, kwargs):
+            worker.requests.pop(request.request_id, None)
+            request.finish(RuntimeError(f"Chat worker {worker.index} is not reachable"))
+        return request
+
+    @property
+    def queue_depth(self):
+        return sum(w.stats.get("queue_depth", 0) for w in self.workers)
+
+    def stats(self):
+        with self._lock:
+            sessions = Counter(self._affinity.values())
+            workers = [
+                {
+                    "index": w.index,
+                    "pid": w.process.pid if w.process else None,
+                    "cpus": w.cpus,
+                    "ready": w.ready,
+                    "restarts": w.restarts,
+                    "error": w.error,
+                    "load_s": w.load_seconds,
+                    "sessions": sessions[w.index],
+                    "in_flight": len(w.requests),
+                    "scheduler": w.stats
+                }
+                for w in self.workers
+            ]
+        totals = [w["scheduler"] for w in workers]
+        return {
+            "mode": "workers",
+            "replicas": len(workers),
+            "ready": sum(w["ready"] for w in workers),
+            "queue_depth": sum(s.get("queue_depth", 0) for s in totals),
+            "active": sum(s.get("active", 0) for s in totals),
+            "tokens_per_s": sum(s.get("tokens_per_s", 0.0) for s in totals),
+            "total_requests": sum(s.get("total_requests", 0) for s in totals),
+            "total_tokens": sum(s.get("total_tokens", 0) for s in totals),
+            "speculative": None,
+            "workers": workers
+        }
+
+    def shutdown(self):
+        with self._lock:
+            self._running = False
+        self._stop.set()
+        self._monitor_thread.join(timeout=self.health_interval + 1)
+        for worker in self.workers:
+            worker.send("stop")
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(5)
+            with self._lock:
+                self._fail_requests(worker, "shut down")
+                self._stop_process(worker)